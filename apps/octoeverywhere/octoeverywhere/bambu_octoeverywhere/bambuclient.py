@@ -48,6 +48,11 @@ class BambuClient:
         self.Logger = logger
         self.StateTranslator = stateTranslator # BambuStateTranslator
 
+        # The state field change handlers, as a tuple of (fields, callback).
+        # This is replaced, never edited, so the MQTT thread can use it without taking the lock.
+        self.StateChangeHandlersLock = threading.Lock()
+        self.StateChangeHandlers = ()
+
         # Used to keep track of the printer state
         # None means we are disconnected.
         self.State:BambuState = None
@@ -72,6 +77,9 @@ class BambuClient:
         # We use this var to keep track of consecutively failed connections
         self.ConsecutivelyFailedConnectionAttempts = 0
 
+        # Let the state translator subscribe to the state fields it cares about before we start getting messages.
+        self.StateTranslator.SubscribeToStateChanges(self)
+
         # Start a thread to setup and maintain the connection.
         self.Client:mqtt.Client = None
         t = threading.Thread(target=self._ClientWorker)
@@ -88,6 +96,15 @@ class BambuClient:
         return self.State
 
 
+    # Adds a callback that's fired when any of the given BambuState fields change value.
+    # The callback is called on the MQTT thread as callback(bambuState:BambuState, changes:dict, isFirstFullSyncResponse:bool),
+    # where changes maps every field that changed in the message to its old value. See BambuState.OnUpdate.
+    # Note that the State object is rebuilt for each new connection, so the first full sync will report all of the fields it has as changed.
+    def AddStateChangeHandler(self, fields, callback) -> None:
+        with self.StateChangeHandlersLock:
+            self.StateChangeHandlers = self.StateChangeHandlers + ((frozenset(fields), callback),)
+
+
     # Returns the current local Version object which is kept in sync with the printer.
     # Returns None if the printer is not connected and the state is unknown.
     def GetVersion(self) -> BambuVersion:
@@ -314,16 +331,17 @@ class BambuClient:
 
             # Since we keep a track of the state locally from the partial updates, we need to feed all updates to our state object.
             isFirstFullSyncResponse = False
+            changes = None
             if "print" in msg:
                 printMsg = msg["print"]
                 try:
                     if self.State is None:
                         # Build the object before we set it.
                         s = BambuState()
-                        s.OnUpdate(printMsg)
+                        changes = s.OnUpdate(printMsg)
                         self.State = s
                     else:
-                        self.State.OnUpdate(printMsg)
+                        changes = self.State.OnUpdate(printMsg)
                 except Exception as e:
                     Sentry.Exception("Exception calling BambuState.OnUpdate", e)
 
@@ -352,6 +370,24 @@ class BambuClient:
                 except Exception as e:
                     Sentry.Exception("Exception calling BambuVersion.OnUpdate", e)
 
+            # If this is the first full sync of a new connection, let the state translator sync up before any state changes are handled.
+            if isFirstFullSyncResponse and self.State is not None:
+                try:
+                    self.StateTranslator.OnFirstFullStateSync(self.State)
+                except Exception as e:
+                    Sentry.Exception("Exception calling StateTranslator.OnFirstFullStateSync", e)
+
+            # Fire the change handlers for any fields that changed.
+            # This must happen AFTER we update the State object, so it's current.
+            if changes and self.State is not None:
+                for fields, callback in self.StateChangeHandlers:
+                    if fields.isdisjoint(changes):
+                        continue
+                    try:
+                        callback(self.State, changes, isFirstFullSyncResponse)
+                    except Exception as e:
+                        Sentry.Exception("Exception calling a BambuState change handler", e)
+
             # Send all messages to the state translator
             # This must happen AFTER we update the State object, so it's current.
             try:
@@ -16,6 +16,24 @@ class BambuPrintErrors(Enum):
 # and then apply updates on top of it. We basically keep a locally cached version of the state around.
 class BambuState:
 
+    # The flat fields of the print object we keep. We use the same naming as the json in the msg.
+    c_PrintFields = (
+        "stg_cur",
+        "gcode_state",
+        "layer_num",
+        "total_layer_num",
+        "subtask_name",
+        "project_id",
+        "mc_percent",
+        "nozzle_temper",
+        "nozzle_target_temper",
+        "bed_temper",
+        "bed_target_temper",
+        "print_error",
+        "mc_remaining_time",
+    )
+    c_PrintFieldSet = frozenset(c_PrintFields)
+
     def __init__(self) -> None:
         # We only parse out what we currently use.
         # We use the same naming as the json in the msg
@@ -41,30 +59,33 @@ class BambuState:
 
 
     # Called when there's a new print message from the printer.
-    def OnUpdate(self, msg:dict) -> None:
-        # Get a new value or keep the current.
-        # Remember that most of these are partial updates and will only have some values.
-        self.stg_cur = msg.get("stg_cur", self.stg_cur)
-        self.gcode_state = msg.get("gcode_state", self.gcode_state)
-        self.layer_num = msg.get("layer_num", self.layer_num)
-        self.total_layer_num = msg.get("total_layer_num", self.total_layer_num)
-        self.subtask_name = msg.get("subtask_name", self.subtask_name)
-        self.project_id = msg.get("project_id", self.project_id)
-        self.mc_percent = msg.get("mc_percent", self.mc_percent)
-        self.nozzle_temper = msg.get("nozzle_temper", self.nozzle_temper)
-        self.nozzle_target_temper = msg.get("nozzle_target_temper", self.nozzle_target_temper)
-        self.bed_temper = msg.get("bed_temper", self.bed_temper)
-        self.bed_target_temper = msg.get("bed_target_temper", self.bed_target_temper)
-        self.print_error = msg.get("print_error", self.print_error)
+    # Returns the change set for this message, which is a dict of the field names that changed value mapped to their old value.
+    # If nothing we track changed, the dict is empty.
+    def OnUpdate(self, msg:dict) -> dict:
+        # Remember that most of these are partial updates and will only have some values, so we only look at what's in the message.
+        # Most messages are small partial updates, so we walk the message keys, but the full sync is big, so we walk our fields.
+        changes = {}
+        if len(msg) < len(BambuState.c_PrintFields):
+            keys = [k for k in msg if k in BambuState.c_PrintFieldSet]
+        else:
+            keys = [k for k in BambuState.c_PrintFields if k in msg]
+        for key in keys:
+            value = msg[key]
+            oldValue = getattr(self, key)
+            if value != oldValue:
+                setattr(self, key, value)
+                changes[key] = oldValue
         ipCam = msg.get("ipcam", None)
         if ipCam is not None:
-            self.rtsp_url = ipCam.get("rtsp_url", self.rtsp_url)
+            rtspUrl = ipCam.get("rtsp_url", self.rtsp_url)
+            if rtspUrl != self.rtsp_url:
+                changes["rtsp_url"] = self.rtsp_url
+                self.rtsp_url = rtspUrl
 
         # Time remaining has some custom logic, so as it's queried each time it keep counting down in seconds, since Bambu only gives us minutes.
-        old_mc_remaining_time = self.mc_remaining_time
-        self.mc_remaining_time = msg.get("mc_remaining_time", self.mc_remaining_time)
-        if old_mc_remaining_time != self.mc_remaining_time:
+        if "mc_remaining_time" in changes:
             self.LastTimeRemainingWallClock = time.time()
+        return changes
 
 
     # Returns a time reaming value that counts down in seconds, not just minutes.
@@ -27,53 +27,29 @@ class BambuStateTranslator:
         self.LastState = None
 
 
+    # Called by the client when it's created, before it starts getting messages.
+    # Rather than checking the state on every message, we only get called when the gcode_state changes.
+    def SubscribeToStateChanges(self, bambuClient:BambuClient):
+        bambuClient.AddStateChangeHandler(("gcode_state",), self._OnGcodeStateChanged)
+
+
+    # Fired when the first full state sync of a new connection comes in.
+    # This is called before the state change handlers, so the notification handler is in sync before any state changes are handled.
+    def OnFirstFullStateSync(self, bambuState:BambuState):
+        self.NotificationsHandler.OnRestorePrintIfNeeded(bambuState.IsPrinting(False), bambuState.IsPaused(), bambuState.GetPrintCookie())
+
+
     # Fired when any mqtt message comes in.
     # State will always be NOT NONE, since it's going to be created before this call.
     # The isFirstFullSyncResponse flag indicates if this is the first full state sync of a new connection.
+    # Note OnFirstFullStateSync and the state change handlers have already been called for this message.
     def OnMqttMessage(self, msg:dict, bambuState:BambuState, isFirstFullSyncResponse:bool):
 
-        # First, if we have a new connection and we just synced, make sure the notification handler is in sync.
-        if isFirstFullSyncResponse:
-            self.NotificationsHandler.OnRestorePrintIfNeeded(bambuState.IsPrinting(False), bambuState.IsPaused(), bambuState.GetPrintCookie())
-
-        # Bambu does send some commands when actions happen, but they don't always get sent for all state changes.
-        # For example, if a user issues a pause command, we see the command. But if the print goes into an error an pauses, we don't get a pause command.
-        # Thus, we have to rely on keeping track of that state and knowing when it changes.
-        # Note we check state for all messages, not just push_status, but it doesn't matter because it will only change on push_status anyways.
-        # Here's a list of all states: https://github.com/greghesp/ha-bambulab/blob/e72e343acd3279c9bccba510f94bf0e291fe5aaa/custom_components/bambu_lab/pybambu/const.py#L83C1-L83C21
-        if self.LastState != bambuState.gcode_state:
-            # We know the state changed.
-            self.Logger.debug(f"Bambu state change: {self.LastState} -> {bambuState.gcode_state}")
-            if self.LastState is None:
-                # If the last state is None, this is mostly likely the first time we've seen a state.
-                # All we want to do here is update last state to the new state.
-                pass
-            # Check if we are now in a printing state we use the common function so the definition of "printing" stays common.
-            elif bambuState.IsPrinting(False):
-                if self.LastState == "PAUSE":
-                    self.BambuOnResume(bambuState)
-                else:
-                    # We know the state changed and the state is now a printing state.
-                    # If the last state was also a printing state, we don't want to fire this, since we already did.
-                    if BambuState.IsPrintingState(self.LastState, False) is False:
-                        self.BambuOnStart(bambuState)
-            # Check for the paused state
-            elif bambuState.IsPaused():
-                # If the error is temporary, like a filament run out, the printer goes into a paused state
-                # with the printer_error set.
-                self.BambuOnPauseOrTempError(bambuState)
-            # Check for the print ending in failure (like if the user stops it by command)
-            elif bambuState.gcode_state == "FAILED":
-                self.BambuOnFailed(bambuState)
-            # Check for a successful print ending.
-            elif bambuState.gcode_state == "FINISH":
-                self.BambuOnComplete(bambuState)
-
-            # Always capture the new state.
-            self.LastState = bambuState.gcode_state
-
         #
-        # Next - Handle the progress update.
+        # Handle the progress update.
+        #
+        # This isn't a state change handler, because the progress update is fired for every message that has the mc_percent, even if it
+        # didn't change, since the other progress info like the remaining time can change without it.
         #
         # These are harder to get right, because the printer will send full state objects sometimes when IDLE or PRINTING.
         # Thus if we respond to them, it might not be the correct time. For example, the full sync will always include mc_percent, but we
@@ -91,7 +67,7 @@ class BambuStateTranslator:
                     self.BambuOnPrintProgress(bambuState)
 
         # Since bambu doesn't tell us a print duration, we need to figure out when it ends ourselves.
-        # This is different from the state changes above, because if we are ever not printing for any reason,
+        # This is different from the gcode_state change handler, because if we are ever not printing for any reason,
         # We want to finalize any current print.
         if bambuState.IsPrinting(True) is False:
             # See if there's a print info for the last print.
@@ -103,6 +79,46 @@ class BambuStateTranslator:
                     pi.SetFinalPrintDurationSec(int(time.time()-pi.GetLocalPrintStartTimeSec()))
 
 
+    # Fired by the client when the gcode_state changes.
+    def _OnGcodeStateChanged(self, bambuState:BambuState, changes:dict, isFirstFullSyncResponse:bool):
+        # Bambu does send some commands when actions happen, but they don't always get sent for all state changes.
+        # For example, if a user issues a pause command, we see the command. But if the print goes into an error an pauses, we don't get a pause command.
+        # Thus, we have to rely on keeping track of that state and knowing when it changes.
+        # Here's a list of all states: https://github.com/greghesp/ha-bambulab/blob/e72e343acd3279c9bccba510f94bf0e291fe5aaa/custom_components/bambu_lab/pybambu/const.py#L83C1-L83C21
+        if self.LastState == bambuState.gcode_state:
+            return
+
+        # We know the state changed.
+        self.Logger.debug(f"Bambu state change: {self.LastState} -> {bambuState.gcode_state}")
+        if self.LastState is None:
+            # If the last state is None, this is mostly likely the first time we've seen a state.
+            # All we want to do here is update last state to the new state.
+            pass
+        # Check if we are now in a printing state we use the common function so the definition of "printing" stays common.
+        elif bambuState.IsPrinting(False):
+            if self.LastState == "PAUSE":
+                self.BambuOnResume(bambuState)
+            else:
+                # We know the state changed and the state is now a printing state.
+                # If the last state was also a printing state, we don't want to fire this, since we already did.
+                if BambuState.IsPrintingState(self.LastState, False) is False:
+                    self.BambuOnStart(bambuState)
+        # Check for the paused state
+        elif bambuState.IsPaused():
+            # If the error is temporary, like a filament run out, the printer goes into a paused state
+            # with the printer_error set.
+            self.BambuOnPauseOrTempError(bambuState)
+        # Check for the print ending in failure (like if the user stops it by command)
+        elif bambuState.gcode_state == "FAILED":
+            self.BambuOnFailed(bambuState)
+        # Check for a successful print ending.
+        elif bambuState.gcode_state == "FINISH":
+            self.BambuOnComplete(bambuState)
+
+        # Always capture the new state.
+        self.LastState = bambuState.gcode_state
+
+
     def BambuOnStart(self, bambuState:BambuState):
         # We must pass the unique cookie name for this print and any other details we can.
         self.NotificationsHandler.OnStarted(bambuState.GetPrintCookie(), bambuState.GetFileNameWithNoExtension())
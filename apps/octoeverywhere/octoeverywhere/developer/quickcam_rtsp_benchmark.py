@@ -0,0 +1,181 @@
+#
+# Benchmarks the QuickCam RTSP jpeg frame splitter against the old byte by byte scanner.
+#
+# The input is a recorded ffmpeg image2pipe dump, which can be made with the same ffmpeg args QuickCam_RTSP uses:
+#   ffmpeg -rtsp_transport 0 -use_wallclock_as_timestamps 1 -i rtsps://bblp:<code>@<ip>:322/streaming/live/1 -filter:v fps=15 -movflags +faststart -f image2pipe - > dump.mjpeg
+#
+# Usage:
+#   python3 developer/quickcam_rtsp_benchmark.py dump.mjpeg
+#
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+# Allow this to be run from the repo root or the developer folder.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+#pylint: disable=wrong-import-position
+from octoeverywhere.Webcam.jpegframesplitter import JpegFrameSplitter
+
+JpegStartSequence = bytearray([0xff, 0xd8, 0xff, 0xfe, 0x00, 0x10])
+JpegEndSequence = bytearray([0xff, 0xd9])
+
+
+# The frame scanning logic QuickCam_RTSP.GetImage used before the frame splitter, used as the "before" reference.
+class LegacySplitter:
+
+    def __init__(self):
+        self.Buffer = None
+        self.SearchedIndex = 0
+        self.Resets = 0
+
+
+    def _CheckIfFullJpeg(self, buffer) -> bool:
+        if buffer is None or len(buffer) <= len(JpegStartSequence):
+            return False
+        if buffer[:len(JpegStartSequence)] != JpegStartSequence:
+            return False
+        if buffer[-2:] != JpegEndSequence:
+            return False
+        return True
+
+
+    def _Reset(self):
+        self.SearchedIndex = 0
+        self.Buffer = None
+
+
+    def _ResetIfOverLimit(self):
+        if self.Buffer is not None and len(self.Buffer) > 50000:
+            self.Resets += 1
+            self._Reset()
+
+
+    # Returns an image or None, like one pass of the old GetImage loop.
+    def Process(self, buffer):
+        if self.Buffer is None:
+            if self._CheckIfFullJpeg(buffer):
+                self._Reset()
+                return buffer
+        if self.Buffer is None:
+            self.Buffer = buffer
+        else:
+            self.Buffer += buffer
+        buffLen = len(self.Buffer)
+        if buffLen <= len(JpegStartSequence):
+            return None
+        if self._CheckIfFullJpeg(self.Buffer):
+            img = self.Buffer
+            self._Reset()
+            return img
+        newImageStart = -1
+        while self.SearchedIndex < buffLen - len(JpegStartSequence):
+            if self.Buffer[self.SearchedIndex] == JpegEndSequence[0] and self.Buffer[self.SearchedIndex+1] == JpegEndSequence[1]:
+                newImageStart = self.SearchedIndex + 2
+                break
+            self.SearchedIndex += 1
+        if newImageStart != -1:
+            imgBuffer = self.Buffer[:newImageStart]
+            if self._CheckIfFullJpeg(imgBuffer) is False:
+                self._Reset()
+                return None
+            self.Buffer = self.Buffer[newImageStart:]
+            self.SearchedIndex = 0
+            self._ResetIfOverLimit()
+            return imgBuffer
+        self._ResetIfOverLimit()
+        return None
+
+
+def SplitIntoReads(data:bytes, minReadSize:int, maxReadSize:int, seed:int) -> list:
+    # Pipe reads return whatever is ready, so split the dump into random sized reads.
+    rnd = random.Random(seed)
+    reads = []
+    offset = 0
+    while offset < len(data):
+        size = rnd.randint(minReadSize, maxReadSize)
+        reads.append(bytearray(data[offset:offset+size]))
+        offset += size
+    return reads
+
+
+def RunLegacy(reads:list):
+    splitter = LegacySplitter()
+    frames = 0
+    start = time.perf_counter()
+    for r in reads:
+        # The old code owned the buffer it read, so give it a fresh copy like the pipe read did.
+        if splitter.Process(bytearray(r)) is not None:
+            frames += 1
+    return time.perf_counter() - start, frames, splitter.Resets
+
+
+def RunSplitter(reads:list, logger:logging.Logger):
+    splitter = JpegFrameSplitter(logger, JpegStartSequence)
+    frames = 0
+    start = time.perf_counter()
+    for r in reads:
+        splitter.Feed(r)
+        frame = splitter.GetNewestFrame()
+        if frame is not None:
+            # QuickCam_RTSP makes one copy of each frame it returns.
+            with frame:
+                bytearray(frame)
+            frames += 1
+    return time.perf_counter() - start, frames, splitter.GetStats()
+
+
+def Verify(data:bytes, reads:list, logger:logging.Logger) -> bool:
+    # Every frame the splitter returns must be a real frame from the dump, and the last frame in the dump must be returned.
+    allFrames = set()
+    offset = 0
+    while True:
+        end = data.find(JpegEndSequence, offset)
+        if end == -1:
+            break
+        allFrames.add(bytes(data[offset:end+2]))
+        offset = end + 2
+    splitter = JpegFrameSplitter(logger, JpegStartSequence)
+    last = None
+    for r in reads:
+        splitter.Feed(r)
+        frame = splitter.GetNewestFrame()
+        if frame is not None:
+            last = bytes(frame)
+            if last not in allFrames:
+                return False
+    lastEnd = data.rfind(JpegEndSequence)
+    return lastEnd == -1 or (last is not None and data[:lastEnd+2].endswith(last))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QuickCam RTSP frame splitter benchmark.")
+    parser.add_argument("dump", help="A recorded ffmpeg image2pipe jpeg dump.")
+    parser.add_argument("--min-read", type=int, default=4 * 1024, help="The min pipe read size in bytes.")
+    parser.add_argument("--max-read", type=int, default=64 * 1024, help="The max pipe read size in bytes.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of passes, the best is reported.")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("benchmark")
+    with open(args.dump, "rb") as f:
+        data = f.read()
+    reads = SplitIntoReads(data, args.min_read, args.max_read, 1)
+    mb = len(data) / (1024.0 * 1024.0)
+    print(f"Dump {args.dump}: {mb:.1f} MB in {len(reads)} reads")
+
+    if Verify(data, reads, logger) is False:
+        print("The frame splitter returned a frame that's not in the dump!")
+        sys.exit(1)
+
+    legacyTime, legacyFrames, legacyResets = min(RunLegacy(reads) for _ in range(args.repeat))
+    newTime, newFrames, newStats = min((RunSplitter(reads, logger) for _ in range(args.repeat)), key=lambda r: r[0])
+    print(f"before  {legacyTime:8.3f}s {mb / legacyTime:8.1f} MB/s  frames:{legacyFrames} buffer resets:{legacyResets}")
+    print(f"after   {newTime:8.3f}s {mb / newTime:8.1f} MB/s  frames:{newFrames} {newStats}")
+    print(f"speedup {legacyTime / newTime:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
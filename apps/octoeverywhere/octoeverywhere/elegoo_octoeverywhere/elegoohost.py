@@ -76,7 +76,7 @@ class ElegooHost:
             self.Logger.info("Plugin Version: %s", pluginVersionStr)
 
             # Setup the HttpSession cache early, so it can be used whenever
-            HttpSessions.Init(self.Logger)
+            HttpSessions.Init(self.Logger, self.Config.GetIntIfInRange(Config.GeneralSection, Config.GeneralLocalHttpMaxConnections, Config.GeneralLocalHttpMaxConnectionsDefault, 1, 512))
 
             # As soon as we have the plugin version, setup Sentry
             # Enabling profiling and no filtering, since we are the only PY in this process.
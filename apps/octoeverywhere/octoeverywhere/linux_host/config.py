@@ -3,6 +3,8 @@ import threading
 
 import configparser
 
+from octoeverywhere.httpsessions import HttpSessions
+
 # This is what we use as our important settings config.
 # This single config class is used for all of the plugin types, but not all of the values are used for each type.
 # It's a bit heavy handed with the lock and aggressive saving, but these
@@ -23,6 +25,8 @@ class Config:
     GeneralSection = "general"
     GeneralBedCooldownThresholdTempC = "bed_cooldown_threshold_temp_celsius"
     GeneralBedCooldownThresholdTempCDefault = 40.0
+    GeneralLocalHttpMaxConnections = "local_http_max_connections"
+    GeneralLocalHttpMaxConnectionsDefault = HttpSessions.c_DefaultMaxLocalConnectionsPerHost
 
 
     #
@@ -96,6 +100,7 @@ class Config:
         { "Target": WebcamFlipV,  "Comment": "Flips the webcam image vertically. Valid values are True or False"},
         { "Target": WebcamRotation,  "Comment": "Rotates the webcam image. Valid values are 0, 90, 180, or 270"},
         { "Target": GeneralBedCooldownThresholdTempC,  "Comment": "The temperature in Celsius that the bed must be under to be considered cooled down. This is used to fire the Bed Cooldown Complete notification."},
+        { "Target": GeneralLocalHttpMaxConnections,  "Comment": "The max number of connections OctoEverywhere will keep open to each local web server, like Moonraker or the webcam server. Requests over the max wait a short time for a free connection. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
         { "Target": ElegooMainboardId,  "Comment": "This is the mainboard id of the linked printer."},
     ]
 
@@ -1,13 +1,53 @@
+import os
+import json
+import time
 import logging
+import threading
+from collections import OrderedDict
+
+from octoeverywhere.telemetry import Telemetry
 
 # A helper class that caches known file metadata info, so we don't have to pull it often.
+#
+# The cache is keyed by file name and holds the most recently used files, so things like the print history and the notifications
+# can alternate between files without making a server.files.metadata call each time. The cache is also written to disk, so it survives restarts.
+#
+# Entries are invalidated when moonraker tells us the file changed with a notify_filelist_changed event. Since we can miss those events
+# while we are disconnected or not running, after each connect all of the entries are checked against the file list's modified time and size.
+# If that check fails, it's retried with a backoff, and until it succeeds each unchecked entry is refreshed from moonraker once when it's used.
 class FileMetadataCache:
 
+    # The max number of files we keep in the cache. The least recently used files are evicted first.
+    c_MaxEntries = 100
+
+    c_CacheFileName = "FileMetadataCache.json"
+
+    # How long after a change the cache file is written, so a burst of changes only writes the file once.
+    c_SaveDelaySec = 5.0
+
+    # If the file list call to validate the entries fails, how long we wait before trying again. The wait doubles up to the max.
+    c_ValidationRetryMinSec = 30.0
+    c_ValidationRetryMaxSec = 15 * 60.0
+
+    # How often the hit, miss, and eviction stats are logged and reported to telemetry.
+    c_StatsReportIntervalSec = 60 * 60 * 6
+
+    # The entry keys, these are also what's written to disk.
+    c_ModifiedKey = "Modified"
+    c_SizeKey = "Size"
+    c_EstimatedPrintTimeSecKey = "EstimatedPrintTimeSec"
+    c_EstimatedFilamentUsageMmKey = "EstimatedFilamentUsageMm"
+    c_FileSizeKBytesKey = "FileSizeKBytes"
+    c_LayerCountKey = "LayerCount"
+    c_FirstLayerHeightKey = "FirstLayerHeight"
+    c_LayerHeightKey = "LayerHeight"
+    c_ObjectHeightKey = "ObjectHeight"
+
     _Instance = None
 
     @staticmethod
-    def Init(logger:logging.Logger, moonrakerClient):
-        FileMetadataCache._Instance = FileMetadataCache(logger, moonrakerClient)
+    def Init(logger:logging.Logger, moonrakerClient, localStorageDir:str):
+        FileMetadataCache._Instance = FileMetadataCache(logger, moonrakerClient, localStorageDir)
 
 
     @staticmethod
@@ -15,150 +55,325 @@ class FileMetadataCache:
         return FileMetadataCache._Instance
 
 
-    def __init__(self, logger:logging.Logger, moonrakerClient) -> None:
+    def __init__(self, logger:logging.Logger, moonrakerClient, localStorageDir:str) -> None:
         self.Logger = logger
         self.MoonrakerClient = moonrakerClient
-        self.FileName:str = None
-        self.EstimatedPrintTimeSec:float = -1.0
-        self.EstimatedFilamentUsageMm:int = -1
-        self.FileSizeKBytes:int = -1
-        self.LayerCount:float = -1.0
-        self.FirstLayerHeight:float = -1.0
-        self.LayerHeight:float = -1.0
-        self.ObjectHeight:float = -1.0
-        self.ResetCache()
-
-
-    # Clears the cache from all current values.
-    def ResetCache(self):
-        self.FileName = None
-        self.EstimatedPrintTimeSec = -1.0
-        self.EstimatedFilamentUsageMm = -1
-        self.FileSizeKBytes = -1
-        self.LayerCount = -1.0
-        self.FirstLayerHeight = -1.0
-        self.LayerHeight = -1.0
-        self.ObjectHeight = -1.0
+        self.CacheFilePath = os.path.join(localStorageDir, FileMetadataCache.c_CacheFileName)
+        self.Lock = threading.Lock()
+        # Maps the file name to the entry dict, in least recently used to most recently used order.
+        self.Entries = OrderedDict()
+        # The names of the entries that need to be checked against the file list before they can be used.
+        # Entries that are refreshed from moonraker are always valid, so they are removed from this set.
+        self.UnvalidatedNames = set()
+        # When the next file list validation can be tried, and the wait after the next failure.
+        self.NextValidationSec = 0.0
+        self.ValidationRetrySec = FileMetadataCache.c_ValidationRetryMinSec
+        self.HitCount = 0
+        self.MissCount = 0
+        self.EvictionCount = 0
+        self.LastStatsReportSec = time.time()
+        # The cache file is written on a delay, see _SaveCacheFile.
+        self.SaveTimer = None
+        self.SaveFileLock = threading.Lock()
+        self._LoadCacheFile()
+        self.UnvalidatedNames = set(self.Entries.keys())
+
+
+    # Removes a single file from the cache, so the next lookup will get fresh metadata.
+    def InvalidateFile(self, filename:str):
+        with self.Lock:
+            self.UnvalidatedNames.discard(filename)
+            if self.Entries.pop(filename, None) is not None:
+                self._SaveCacheFile()
+
+
+    # Called when the moonraker client connects. We might have missed file list changes while we were disconnected,
+    # so the entries are validated before they are used again.
+    def OnMoonrakerConnected(self):
+        with self.Lock:
+            self.UnvalidatedNames = set(self.Entries.keys())
+            self.NextValidationSec = 0.0
+            self.ValidationRetrySec = FileMetadataCache.c_ValidationRetryMinSec
+
+
+    # Called with the notify_filelist_changed message from moonraker.
+    # https://moonraker.readthedocs.io/en/latest/web_api/#file-list-changed
+    def OnFileListChanged(self, msg:dict):
+        params = msg.get("params", None)
+        if not isinstance(params, list):
+            return
+        with self.Lock:
+            # Moonraker is talking to us, so if the validation failed before, try it again on the next use.
+            self.NextValidationSec = 0.0
+            changed = False
+            for p in params:
+                if not isinstance(p, dict):
+                    continue
+                isDir = str(p.get("action", "")).endswith("_dir")
+                for itemKey in ("item", "source_item"):
+                    item = p.get(itemKey, None)
+                    if not isinstance(item, dict) or item.get("root", "gcodes") != "gcodes" or "path" not in item:
+                        continue
+                    path = item["path"]
+                    if isDir:
+                        # For folder changes, drop everything under the folder.
+                        prefix = path.rstrip("/") + "/"
+                        for name in [n for n in self.Entries if n.startswith(prefix)]:
+                            del self.Entries[name]
+                            self.UnvalidatedNames.discard(name)
+                            changed = True
+                    elif self.Entries.pop(path, None) is not None:
+                        self.UnvalidatedNames.discard(path)
+                        changed = True
+            if changed:
+                self._SaveCacheFile()
 
 
     # If the estimated time for the print can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1.0
     def GetEstimatedPrintTimeSec(self, filename:str) -> float:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.EstimatedPrintTimeSec
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.EstimatedPrintTimeSec
+        entry = self._GetEntry(filename)
+        if entry is None:
+            return -1.0
+        return entry.get(FileMetadataCache.c_EstimatedPrintTimeSecKey, -1.0)
 
 
     # If the filament usage can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1
     def GetEstimatedFilamentUsageMm(self, filename:str) -> int:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.EstimatedFilamentUsageMm
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.EstimatedFilamentUsageMm
+        entry = self._GetEntry(filename)
+        if entry is None:
+            return -1
+        return entry.get(FileMetadataCache.c_EstimatedFilamentUsageMmKey, -1)
 
 
     # If the file size can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1
     def GetFileSizeKBytes(self, filename:str) -> int:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.FileSizeKBytes
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.FileSizeKBytes
+        entry = self._GetEntry(filename)
+        if entry is None:
+            return -1
+        return entry.get(FileMetadataCache.c_FileSizeKBytesKey, -1)
 
 
     # If the file size can be gotten from the file metadata, this will return it.
     # Any of the values will return -1 if they are unknown.
     def GetLayerInfo(self, filename:str):
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return (self.LayerCount, self.LayerHeight, self.FirstLayerHeight, self.ObjectHeight)
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return (self.LayerCount, self.LayerHeight, self.FirstLayerHeight, self.ObjectHeight)
-
-
-    # Does a refresh of the file name metadata cache.
-    def _RefreshFileMetaDataCache(self, filename:str) -> None:
-
-        # Reset everything.
-        self.ResetCache()
-
+        entry = self._GetEntry(filename)
+        if entry is None:
+            return (-1.0, -1.0, -1.0, -1.0)
+        return (entry.get(FileMetadataCache.c_LayerCountKey, -1.0), entry.get(FileMetadataCache.c_LayerHeightKey, -1.0),
+                entry.get(FileMetadataCache.c_FirstLayerHeightKey, -1.0), entry.get(FileMetadataCache.c_ObjectHeightKey, -1.0))
+
+
+    # Returns a dict of the cache stats since they were last reported.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return self._GetStatsLocked()
+
+
+    # Must be called under lock.
+    def _GetStatsLocked(self) -> dict:
+        return {
+            "Entries": len(self.Entries),
+            "Hits": self.HitCount,
+            "Misses": self.MissCount,
+            "Evictions": self.EvictionCount,
+        }
+
+
+    # Every so often, logs the stats and reports them to telemetry, then starts the counts over.
+    def _ReportStatsIfNeeded(self) -> None:
+        with self.Lock:
+            if time.time() - self.LastStatsReportSec < FileMetadataCache.c_StatsReportIntervalSec:
+                return
+            report = self._GetStatsLocked()
+            self.HitCount = 0
+            self.MissCount = 0
+            self.EvictionCount = 0
+            self.LastStatsReportSec = time.time()
+        # Report outside of the lock.
+        self.Logger.info(f"FileMetadataCache stats; hits: {report['Hits']}, misses: {report['Misses']}, evictions: {report['Evictions']}, entries: {report['Entries']}")
+        Telemetry.Write("PluginFileMetadataCache", report["Hits"], report)
+
+
+    # Returns the cache entry for the file, refreshing it if needed. Returns None if the metadata can't be gotten.
+    def _GetEntry(self, filename:str):
+        self._ReportStatsIfNeeded()
+
+        # If the entry hasn't been validated since we connected, try to validate all of the entries.
+        # Only one thread tries at a time, and after a failure it's not tried again until the retry time.
+        validate = False
+        with self.Lock:
+            if filename in self.UnvalidatedNames and time.time() >= self.NextValidationSec:
+                validate = True
+                self.NextValidationSec = time.time() + self.ValidationRetrySec
+        if validate:
+            self._ValidateEntries()
+
+        # If the entry still isn't validated, we don't trust it, but a refresh will replace it with a valid one.
+        with self.Lock:
+            entry = self.Entries.get(filename, None)
+            if entry is not None and filename not in self.UnvalidatedNames:
+                self.Entries.move_to_end(filename)
+                self.HitCount += 1
+                return entry
+            self.MissCount += 1
+
+        # The file isn't in the cache, do a refresh now.
+        return self._RefreshFileMetaDataCache(filename)
+
+
+    # Checks all of the entries against the modified time and size moonraker has for the files, removing any that changed or are gone.
+    # Returns False if the validation couldn't be done, in which case the next try is pushed back.
+    def _ValidateEntries(self) -> bool:
+        with self.Lock:
+            if len(self.UnvalidatedNames) == 0:
+                return True
+
+        # Make the call outside of the lock, it returns all of the files in the gcode root, including subfolders.
+        result = self.MoonrakerClient.SendJsonRpcRequest("server.files.list",
+        {
+            "root": "gcodes"
+        })
+        if result.HasError():
+            with self.Lock:
+                retrySec = self.ValidationRetrySec
+                self.NextValidationSec = time.time() + retrySec
+                self.ValidationRetrySec = min(retrySec * 2, FileMetadataCache.c_ValidationRetryMaxSec)
+            self.Logger.warn(f"FileMetadataCache failed to get the file list to validate the cache, trying again in {int(retrySec)}s. "+result.GetLoggingErrorStr())
+            return False
+
+        files = {}
+        for f in result.GetResult():
+            if isinstance(f, dict) and "path" in f:
+                files[f["path"]] = f
+
+        with self.Lock:
+            removed = 0
+            for name in list(self.UnvalidatedNames):
+                entry = self.Entries.get(name, None)
+                if entry is None:
+                    continue
+                f = files.get(name, None)
+                if f is None or f.get("modified", None) != entry.get(FileMetadataCache.c_ModifiedKey, None) or f.get("size", None) != entry.get(FileMetadataCache.c_SizeKey, None):
+                    del self.Entries[name]
+                    removed += 1
+            if removed > 0:
+                self._SaveCacheFile()
+            self.UnvalidatedNames.clear()
+            self.ValidationRetrySec = FileMetadataCache.c_ValidationRetryMinSec
+            self.Logger.info(f"FileMetadataCache validated, {len(self.Entries)} entries are valid and {removed} were removed.")
+        return True
+
+
+    # Does a refresh of the file name metadata cache. Returns the new entry, or None if the call failed.
+    def _RefreshFileMetaDataCache(self, filename:str):
         # Make the call.
         result = self.MoonrakerClient.SendJsonRpcRequest("server.files.metadata",
         {
             "filename": filename
         })
 
-        # If we fail this call, just return, which will keep the cache invalid.
+        # If we fail this call, just return, which will keep the file out of the cache.
         if result.HasError():
             self.Logger.error("_RefreshFileMetaDataCache failed to get file meta. "+result.GetLoggingErrorStr())
-            return
+            return None
 
         # If we got here, we know we got a good result.
-        # Set the cached vars so we don't call again, even though we might not be able to get them, meaning the file doesn't have them.
-        self.FileName = filename
+        # Add the entry so we don't call again, even though we might not be able to get the values, meaning the file doesn't have them.
+        entry = {}
 
         # Get the value, if it exists and it's valid.
         res = result.GetResult()
-        if "estimated_time" in res:
+        entry[FileMetadataCache.c_ModifiedKey] = res.get("modified", None)
+        entry[FileMetadataCache.c_SizeKey] = res.get("size", None)
+        if "estimated_time" in res and res["estimated_time"] is not None:
             value = float(res["estimated_time"])
             if value > 0.001:
-                self.EstimatedPrintTimeSec = value
-        if "size" in res:
+                entry[FileMetadataCache.c_EstimatedPrintTimeSecKey] = value
+        if "size" in res and res["size"] is not None:
             value = int(res["size"])
             if value > 0:
-                self.FileSizeKBytes = int(value / 1024)
-        if "filament_total" in res:
+                entry[FileMetadataCache.c_FileSizeKBytesKey] = int(value / 1024)
+        if "filament_total" in res and res["filament_total"] is not None:
             value = int(res["filament_total"])
             if value > 0:
-                self.EstimatedFilamentUsageMm = value
+                entry[FileMetadataCache.c_EstimatedFilamentUsageMmKey] = value
         if "layer_count" in res and res["layer_count"] is not None:
             value = float(res["layer_count"])
             if value > 0:
-                self.LayerCount = value
+                entry[FileMetadataCache.c_LayerCountKey] = value
         if "first_layer_height" in res and res["first_layer_height"] is not None:
             value = float(res["first_layer_height"])
             if value > 0:
-                self.FirstLayerHeight = value
+                entry[FileMetadataCache.c_FirstLayerHeightKey] = value
         if "layer_height" in res and res["layer_height"] is not None:
             value = float(res["layer_height"])
             if value > 0:
-                self.LayerHeight = value
+                entry[FileMetadataCache.c_LayerHeightKey] = value
         if "object_height" in res and res["object_height"] is not None:
             value = float(res["object_height"])
             if value > 0:
-                self.ObjectHeight = value
-
-        self.Logger.info(f"FileMetadataCache updated for file [{filename}]; est time: {str(self.EstimatedPrintTimeSec)}, size: {str(self.FileSizeKBytes)}, filament usage: {str(self.EstimatedFilamentUsageMm)}")
+                entry[FileMetadataCache.c_ObjectHeightKey] = value
+
+        with self.Lock:
+            self.Entries[filename] = entry
+            self.Entries.move_to_end(filename)
+            self.UnvalidatedNames.discard(filename)
+            while len(self.Entries) > FileMetadataCache.c_MaxEntries:
+                name, _ = self.Entries.popitem(last=False)
+                self.UnvalidatedNames.discard(name)
+                self.EvictionCount += 1
+            self._SaveCacheFile()
+            hits = self.HitCount
+            misses = self.MissCount
+            evictions = self.EvictionCount
+
+        self.Logger.info(f"FileMetadataCache updated for file [{filename}]; est time: {str(entry.get(FileMetadataCache.c_EstimatedPrintTimeSecKey, -1.0))}, size: {str(entry.get(FileMetadataCache.c_FileSizeKBytesKey, -1))}, filament usage: {str(entry.get(FileMetadataCache.c_EstimatedFilamentUsageMmKey, -1))}, hits: {hits}, misses: {misses}, evictions: {evictions}")
+        return entry
+
+
+    # Must be called under lock.
+    # The file isn't written right away, a save is scheduled so a burst of changes only writes the file once.
+    def _SaveCacheFile(self):
+        if self.SaveTimer is not None:
+            return
+        self.SaveTimer = threading.Timer(FileMetadataCache.c_SaveDelaySec, self._WriteCacheFile)
+        self.SaveTimer.daemon = True
+        self.SaveTimer.start()
+
+
+    # Writes the cache file now, on the save timer thread.
+    def _WriteCacheFile(self):
+        try:
+            # Only one write at a time, so two writes can't race on the temp file.
+            with self.SaveFileLock:
+                with self.Lock:
+                    self.SaveTimer = None
+                    data = json.dumps({
+                        "Entries": [ [name, entry] for name, entry in self.Entries.items() ]
+                    })
+                # Write to a temp file and then move it, so a crash while writing can't leave a partial file.
+                tempPath = self.CacheFilePath + ".tmp"
+                with open(tempPath, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tempPath, self.CacheFilePath)
+        except Exception as e:
+            self.Logger.error(f"FileMetadataCache failed to write the cache file. {e}")
+
+
+    def _LoadCacheFile(self):
+        try:
+            if os.path.exists(self.CacheFilePath) is False:
+                return
+            with open(self.CacheFilePath, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            # The entries are saved as a list, so the LRU order is kept.
+            for name, entry in data["Entries"][-FileMetadataCache.c_MaxEntries:]:
+                if isinstance(name, str) and isinstance(entry, dict):
+                    self.Entries[name] = entry
+            self.Logger.info(f"FileMetadataCache loaded {len(self.Entries)} entries from disk.")
+        except Exception as e:
+            self.Logger.error(f"FileMetadataCache failed to load the cache file, starting empty. {e}")
+            self.Entries.clear()
@@ -11,6 +11,7 @@ import octowebsocket
 
 from octoeverywhere.compat import Compat
 from octoeverywhere.sentry import Sentry
+from octoeverywhere.telemetry import Telemetry
 from octoeverywhere.websocketimpl import Client
 from octoeverywhere.notificationshandler import NotificationsHandler
 from octoeverywhere.exceptions import NoSentryReportException
@@ -19,6 +20,7 @@ from octoeverywhere.debugprofiler import DebugProfiler, DebugProfilerFeatures
 from linux_host.config import Config
 
 from .filemetadatacache import FileMetadataCache
+from .printerstatemirror import PrinterStateMirror
 from .moonrakercredentailmanager import MoonrakerCredentialManager
 
 # The response object for a json rpc request.
@@ -69,12 +71,34 @@ class MoonrakerClient:
     # For some reason, some calls seem to take a really long time to complete (like database calls), so we make this timeout quite high.
     RequestTimeoutSec = 60.0
 
+    # How often the json rpc stats are logged and reported to telemetry.
+    JsonRpcStatsReportIntervalSec = 60 * 60 * 6
+
     # Logic for a static singleton
     _Instance = None
 
     # If enabled, this prints all of the websocket messages sent and received.
     WebSocketMessageDebugging = False
 
+    # The printer objects we subscribe to when the websocket connects.
+    # https://moonraker.readthedocs.io/en/latest/web_api/#subscribe-to-printer-object-status
+    # https://moonraker.readthedocs.io/en/latest/printer_objects/
+    # Using None allows us to get all of the data from the notification types.
+    # For some types, using None has way too many updates, so we filter them down.
+    # Beyond the notifications, this includes most of what the MoonrakerCompat printer state functions need,
+    # so they can be served from the state mirror instead of doing a query each time.
+    # The toolhead and gcode positions are left out on purpose, they change with every move so moonraker would push them a few times a second
+    # while printing. They are only needed for the z offset and layer checks, so those do a real query when they are called.
+    SubscribedPrinterObjects = {
+        "print_stats": [ "state", "filename", "message", "print_duration", "total_duration", "info" ],
+        "webhooks": None,
+        "virtual_sdcard": None,
+        "history" : None,
+        "gcode_move": [ "speed_factor" ],
+        "extruder": [ "temperature" ],
+        "heater_bed": [ "temperature" ],
+    }
+
     @staticmethod
     def Init(logger, config, moonrakerConfigFilePath:str, printerId:str, connectionStatusHandler, pluginVersionStr:str):
         MoonrakerClient._Instance = MoonrakerClient(logger, config, moonrakerConfigFilePath, printerId, connectionStatusHandler, pluginVersionStr)
@@ -98,6 +122,13 @@ class MoonrakerClient:
         self.JsonRpcIdLock = threading.Lock()
         self.JsonRpcIdCounter = 0
         self.JsonRpcWaitingContexts = {}
+        # Per method latency stats, these are logged and reported to telemetry every so often, see _RecordJsonRpcStats.
+        self.JsonRpcStatsLock = threading.Lock()
+        self.JsonRpcStats = {}
+        self.JsonRpcStatsLastReportSec = time.time()
+
+        # The local mirror of the printer objects we are subscribed to, see QueryPrinterObjects.
+        self.StateMirror = PrinterStateMirror(self.Logger)
 
         # Setup the Moonraker compat helper object.
         cooldownThresholdTempC = self.Config.GetFloat(Config.GeneralSection, Config.GeneralBedCooldownThresholdTempC, Config.GeneralBedCooldownThresholdTempCDefault)
@@ -252,6 +283,18 @@ class MoonrakerClient:
     # Below this is websocket logic.
     #
 
+    # Returns the current state of the given printer objects, in the same format as a printer.objects.query result.
+    # The objects dict is the same as the printer.objects.query request, the object name maps to a list of fields or None for all fields.
+    # If all of the objects and fields are covered by our subscription, this is served from the local state mirror without a round trip to moonraker.
+    # Otherwise, or if the mirror isn't fresh, this falls back to a printer.objects.query request.
+    # This will not throw, it will always return a JsonRpcResponse which can be checked for errors or success.
+    def QueryPrinterObjects(self, objects:dict) -> JsonRpcResponse:
+        result = self.StateMirror.Query(objects)
+        if result is not None:
+            return JsonRpcResponse(result)
+        return self.SendJsonRpcRequest("printer.objects.query", { "objects": objects })
+
+
     # Sends a rpc request via the connected websocket. This request will block until a response is received or the request times out.
     # This will not throw, it will always return a JsonRpcResponse which can be checked for errors or success.
     #
@@ -260,6 +303,14 @@ class MoonrakerClient:
     # https://moonraker.readthedocs.io/en/latest/web_api/#websocket-setup
     #
     def SendJsonRpcRequest(self, method:str, paramsDict = None) -> JsonRpcResponse:
+        return self.SendJsonRpcRequestAsync(method, paramsDict).GetResponse()
+
+
+    # Sends a rpc request via the connected websocket, but doesn't wait for the response.
+    # Any number of requests can be in flight on the websocket at once, the responses are matched to the requests by id when they arrive.
+    # This returns a JsonRpcPendingRequest, GetResponse() must be called on it to get the JsonRpcResponse and clean up the request.
+    # This will not throw.
+    def SendJsonRpcRequestAsync(self, method:str, paramsDict = None):
         msgId = 0
         waitContext = None
         with self.JsonRpcIdLock:
@@ -268,9 +319,14 @@ class MoonrakerClient:
             self.JsonRpcIdCounter += 1
 
             # Add our waiting context.
-            waitContext = JsonRpcWaitingContext(msgId)
+            waitContext = JsonRpcWaitingContext(msgId, method)
             self.JsonRpcWaitingContexts[msgId] = waitContext
 
+            # Every so often, wake up any requests that are way past the timeout.
+            # This only happens if someone sent a request and never asked for the response.
+            if msgId % 200 == 0:
+                self._ExpireAbandonedJsonRpcRequests()
+
         # From now on, we need to always make sure to clean up the wait context, even in error.
         try:
             # Create the request object
@@ -287,15 +343,76 @@ class MoonrakerClient:
             jsonStr = json.dumps(obj, default=str)
             if self._WebSocketSend(jsonStr) is False:
                 self.Logger.info("Moonraker client failed to send JsonRPC request "+method)
-                return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_WS_NOT_CONNECTED)
+                self._RemoveJsonRpcWaitingContext(msgId)
+                return JsonRpcPendingRequest(self, waitContext, JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_WS_NOT_CONNECTED))
 
+            # The request is in flight.
+            return JsonRpcPendingRequest(self, waitContext)
+
+        except Exception as e:
+            Sentry.Exception("Moonraker client json rpc request failed to send.", e)
+            self._RemoveJsonRpcWaitingContext(msgId)
+            return JsonRpcPendingRequest(self, waitContext, JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, str(e)))
+
+
+    # Sends all of the requests at once and then waits for all of them, so the total time is about one round trip instead of one per request.
+    # The requests are a list of (method, paramsDict) tuples, the params can be None.
+    # Returns a list of JsonRpcResponse in the same order as the requests. This will not throw.
+    def SendJsonRpcRequestBatch(self, requests:list) -> list:
+        pending = []
+        for method, paramsDict in requests:
+            pending.append(self.SendJsonRpcRequestAsync(method, paramsDict))
+        # All of the requests share the same deadline.
+        deadlineSec = time.time() + MoonrakerClient.RequestTimeoutSec
+        results = []
+        for p in pending:
+            results.append(p.GetResponse(max(0.0, deadlineSec - time.time())))
+        return results
+
+
+    # Returns a dict of the json rpc stats since the last report, keyed by method.
+    # Each value has the count, error count (including timeouts), and the average and max latency in ms.
+    # Must be called under the JsonRpcStatsLock.
+    def _GetJsonRpcStatsLocked(self) -> dict:
+        ret = {}
+        for method, (count, errors, totalSec, maxSec) in self.JsonRpcStats.items():
+            ret[method] = {
+                "Count": count,
+                "Errors": errors,
+                "AvgMs": int((totalSec / count) * 1000.0) if count > 0 else 0,
+                "MaxMs": int(maxSec * 1000.0),
+            }
+        return ret
+
+
+    # Logs the json rpc stats and sends them to telemetry.
+    # Telemetry fields must be flat, so each method's values are prefixed with the method name.
+    def _ReportJsonRpcStats(self, stats:dict):
+        totalCount = 0
+        totalErrors = 0
+        fields = {}
+        for method, s in stats.items():
+            totalCount += s["Count"]
+            totalErrors += s["Errors"]
+            for key, value in s.items():
+                fields[f"{method}_{key}"] = value
+        fields["Count"] = totalCount
+        fields["Errors"] = totalErrors
+        self.Logger.info(f"Moonraker json rpc stats; requests: {totalCount}, errors: {totalErrors}, by method: {json.dumps(stats)}")
+        Telemetry.Write("PluginMoonrakerJsonRpcStats", totalCount, fields)
+
+
+    # Called by JsonRpcPendingRequest, this waits for the response and always cleans up the waiting context.
+    def _WaitForJsonRpcResponse(self, waitContext, timeoutSec:float) -> JsonRpcResponse:
+        try:
             # Wait for a response
-            waitContext.GetEvent().wait(MoonrakerClient.RequestTimeoutSec)
+            waitContext.GetEvent().wait(timeoutSec)
 
             # Check if we got a result.
             result = waitContext.GetResult()
             if result is None:
-                self.Logger.info("Moonraker client timeout while waiting for request. "+str(id)+" "+method)
+                self.Logger.info("Moonraker client timeout while waiting for request. "+str(waitContext.Id)+" "+waitContext.Method)
+                self._RecordJsonRpcStats(waitContext.Method, time.time() - waitContext.StartSec, True)
                 return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_TIMEOUT)
 
             # Check for an error if found, return the error state.
@@ -318,14 +435,55 @@ class MoonrakerClient:
             return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, "No result or error object")
 
         except Exception as e:
-            Sentry.Exception("Moonraker client json rpc request failed to send.", e)
+            Sentry.Exception("Moonraker client json rpc request failed to get the response.", e)
             return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, str(e))
 
         finally:
             # Before leaving, always clean up any waiting contexts.
-            with self.JsonRpcIdLock:
-                if msgId in self.JsonRpcWaitingContexts:
-                    del self.JsonRpcWaitingContexts[msgId]
+            self._RemoveJsonRpcWaitingContext(waitContext.Id)
+
+
+    def _RemoveJsonRpcWaitingContext(self, msgId:int):
+        with self.JsonRpcIdLock:
+            if msgId in self.JsonRpcWaitingContexts:
+                del self.JsonRpcWaitingContexts[msgId]
+
+
+    # Must be called under the JsonRpcIdLock.
+    def _ExpireAbandonedJsonRpcRequests(self):
+        nowSec = time.time()
+        for msgId in list(self.JsonRpcWaitingContexts.keys()):
+            context = self.JsonRpcWaitingContexts[msgId]
+            if nowSec - context.StartSec > MoonrakerClient.RequestTimeoutSec * 2:
+                self.Logger.warn("Moonraker client expiring json rpc request that was never waited on. "+str(msgId)+" "+context.Method)
+                context.SetSocketClosed()
+                del self.JsonRpcWaitingContexts[msgId]
+
+
+    def _RecordJsonRpcStats(self, method:str, durationSec:float, isError:bool):
+        with self.JsonRpcStatsLock:
+            stats = self.JsonRpcStats.get(method, None)
+            if stats is None:
+                # [count, error count, total time, max time]
+                stats = [0, 0, 0.0, 0.0]
+                self.JsonRpcStats[method] = stats
+            stats[0] += 1
+            if isError:
+                stats[1] += 1
+            stats[2] += durationSec
+            if durationSec > stats[3]:
+                stats[3] = durationSec
+
+            # Check if it's time to report, if so take the stats and start over.
+            report = None
+            if time.time() - self.JsonRpcStatsLastReportSec > MoonrakerClient.JsonRpcStatsReportIntervalSec:
+                report = self._GetJsonRpcStatsLocked()
+                self.JsonRpcStats = {}
+                self.JsonRpcStatsLastReportSec = time.time()
+
+        # Report outside of the lock.
+        if report is not None:
+            self._ReportJsonRpcStats(report)
 
 
     # Sends a string to the connected websocket.
@@ -363,28 +521,28 @@ class MoonrakerClient:
     def _OnWsOpenAndKlippyReady(self):
         self.Logger.info("Moonraker client setting up default notification hooks")
         # First, we need to setup our notification subs
-        # https://moonraker.readthedocs.io/en/latest/web_api/#subscribe-to-printer-object-status
-        # https://moonraker.readthedocs.io/en/latest/printer_objects/
+        # The state mirror will hold any updates that come in before the subscribe response, so none are lost.
         #result = self.SendJsonRpcRequest("printer.objects.list")
+        self.StateMirror.Reset(MoonrakerClient.SubscribedPrinterObjects)
         result = self.SendJsonRpcRequest("printer.objects.subscribe",
         {
-            "objects":
-            {
-                # Using None allows us to get all of the data from the notification types.
-                # For some types, using None has way too many updates, so we filter them down.
-                "print_stats": { "state", "filename", "message" },
-                "webhooks": None,
-                "virtual_sdcard": None,
-                "history" : None,
-            }
+            "objects": MoonrakerClient.SubscribedPrinterObjects
         })
 
         # Verify success.
         if result.HasError():
             self.Logger.error("Failed to setup moonraker notification subs. "+result.GetLoggingErrorStr())
+            self.StateMirror.Invalidate()
             self._RestartWebsocket()
             return
 
+        # The subscribe result has the full current state of the objects, which is the starting point of the mirror.
+        self.StateMirror.SetSnapshot(result.GetResult())
+
+        # We might have missed file changes while disconnected, so the file metadata cache needs to check its entries.
+        if FileMetadataCache.Get() is not None:
+            FileMetadataCache.Get().OnMoonrakerConnected()
+
         # Call the event handler
         self.MoonrakerCompat.OnMoonrakerClientConnected()
 
@@ -401,6 +559,9 @@ class MoonrakerClient:
             return
         method = msg["method"].lower()
 
+        # Any message means the connection is healthy, which the state mirror uses to know it's fresh.
+        self.StateMirror.OnMessageReceived()
+
         # These objects can come in all shapes and sizes. So we only look for exactly what we need, if we don't find it
         # We ignore the object, someone else might match it.
 
@@ -437,6 +598,9 @@ class MoonrakerClient:
                                         return
 
         if method == "notify_status_update":
+            # Always update the state mirror first, since the logic below returns early.
+            self.StateMirror.OnStatusUpdate(msg)
+
             # This is shared by a few things, so get it once.
             progressFloat_CanBeNone = self._GetProgressFromMsg(msg)
 
@@ -468,6 +632,12 @@ class MoonrakerClient:
             if progressFloat_CanBeNone is not None:
                 self.MoonrakerCompat.OnPrintProgress(progressFloat_CanBeNone)
 
+        # When files are added, removed, or changed, drop them from the metadata cache.
+        if method == "notify_filelist_changed":
+            if FileMetadataCache.Get() is not None:
+                FileMetadataCache.Get().OnFileListChanged(msg)
+            return
+
         # When the webcams change, kick the webcam helper.
         if method == "notify_webcams_changed":
             self.ConnectionStatusHandler.OnWebcamSettingsChanged()
@@ -534,6 +704,9 @@ class MoonrakerClient:
                 self.WebSocketConnected = False
                 self.WebSocketKlippyReady = False
 
+            # We will miss updates until we subscribe again, so the mirror can't be used.
+            self.StateMirror.Invalidate()
+
             # When the websocket closes, we need to clear out all pending waiting contexts.
             with self.JsonRpcIdLock:
                 for context in self.JsonRpcWaitingContexts.values():
@@ -688,14 +861,19 @@ class MoonrakerClient:
             # Check if this is a response to a request
             # info: https://moonraker.readthedocs.io/en/latest/web_api/#json-rpc-api-overview
             if "id" in msgObj:
+                context = None
                 with self.JsonRpcIdLock:
                     idInt = int(msgObj["id"])
                     if idInt in self.JsonRpcWaitingContexts:
-                        self.JsonRpcWaitingContexts[idInt].SetResultAndEvent(msgObj)
+                        context = self.JsonRpcWaitingContexts[idInt]
+                        context.SetResultAndEvent(msgObj)
                     else:
                         self.Logger.warn("Moonraker RPC response received for request "+str(idInt) + ", but there is no waiting context.")
-                    # If once the response is handled, we are done.
-                    return
+                # Record the latency outside of the lock.
+                if context is not None:
+                    self._RecordJsonRpcStats(context.Method, time.time() - context.StartSec, "error" in msgObj)
+                # If once the response is handled, we are done.
+                return
 
             # Check for a special message that indicates the klippy connection has been lost.
             # According to the docs, in this case, we should restart the klippy ready process, so we will
@@ -759,8 +937,10 @@ class MoonrakerClient:
 # A helper class used for waiting rpc requests
 class JsonRpcWaitingContext:
 
-    def __init__(self, msgId) -> None:
+    def __init__(self, msgId, method:str) -> None:
         self.Id = msgId
+        self.Method = method
+        self.StartSec = time.time()
         self.WaitEvent = threading.Event()
         self.Result = None
 
@@ -783,6 +963,32 @@ class JsonRpcWaitingContext:
         self.WaitEvent.set()
 
 
+# Returned by MoonrakerClient.SendJsonRpcRequestAsync, this is a request that's in flight.
+# GetResponse must always be called, since it's what cleans up the request.
+class JsonRpcPendingRequest:
+
+    def __init__(self, client:MoonrakerClient, waitContext:JsonRpcWaitingContext, response:JsonRpcResponse = None) -> None:
+        self.Client = client
+        self.WaitContext = waitContext
+        # If the request failed to send, the response is already known.
+        self.Response = response
+
+
+    # Returns True if the response is ready, so GetResponse won't block.
+    def IsDone(self) -> bool:
+        return self.Response is not None or self.WaitContext.GetEvent().is_set()
+
+
+    # Blocks until the response is received or the timeout is hit, and returns the JsonRpcResponse.
+    # If no timeout is given, the default request timeout is used. This will not throw.
+    def GetResponse(self, timeoutSec:float = None) -> JsonRpcResponse:
+        if self.Response is None:
+            if timeoutSec is None:
+                timeoutSec = MoonrakerClient.RequestTimeoutSec
+            self.Response = self.Client._WaitForJsonRpcResponse(self.WaitContext, timeoutSec) #pylint: disable=protected-access
+        return self.Response
+
+
 # The goal of this class it add any needed compatibility logic to allow the moonraker system plugin into the
 # common OctoEverywhere logic.
 class MoonrakerCompat:
@@ -888,9 +1094,9 @@ class MoonrakerCompat:
         if self.IsReadyToProcessNotifications is False:
             return
 
-        # Since this is a new print, reset the cache. The file name might be the same as the last, but have
-        # different props, so we will always reset. We know when we are printing the same file name will have the same props.
-        FileMetadataCache.Get().ResetCache()
+        # Since this is a new print, invalidate the file in the cache. The file name might be the same as the last, but have
+        # different props, so we will always refresh it. We know when we are printing the same file name will have the same props.
+        FileMetadataCache.Get().InvalidateFile(fileName)
 
         # Try to get the starting file info if we can.
         filamentUsageMm = FileMetadataCache.Get().GetEstimatedFilamentUsageMm(fileName)
@@ -979,13 +1185,11 @@ class MoonrakerCompat:
     # This function will get the estimated time remaining for the current print.
     # Returns -1 if the estimate is unknown.
     def GetPrintTimeRemainingEstimateInSeconds(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+        result = MoonrakerClient.Get().QueryPrinterObjects(
         {
-            "objects": {
-                "virtual_sdcard": None,
-                "print_stats": None,
-                "gcode_move": None,
-            }
+            "virtual_sdcard": [ "progress" ],
+            "print_stats": [ "print_duration", "filename" ],
+            "gcode_move": [ "speed_factor" ],
         })
         # Like on OctoPrint, this logic is complicated.
         # So we use a shared common function to handle it.
@@ -996,12 +1200,10 @@ class MoonrakerCompat:
     # If the printer is warming up, this value would be -1. The First Layer Notification logic depends upon this!
     # Returns the current zoffset if known, otherwise -1.
     def GetCurrentZOffset(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+        result = MoonrakerClient.Get().QueryPrinterObjects(
         {
-            "objects": {
-                "toolhead": None,
-                "print_stats": None
-            }
+            "toolhead": [ "position" ],
+            "print_stats": [ "state", "print_duration" ]
         })
         if result.HasError():
             self.Logger.error("GetCurrentZOffset failed to query toolhead objects: "+result.GetLoggingErrorStr())
@@ -1029,12 +1231,10 @@ class MoonrakerCompat:
     #          Note that total layers will always be > 0, but current layer can be 0!
     def GetCurrentLayerInfo(self):
         try:
-            result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+            result = MoonrakerClient.Get().QueryPrinterObjects(
             {
-                "objects": {
-                    "print_stats": None,
-                    "gcode_move": None
-                }
+                "print_stats": [ "filename", "info", "print_duration" ],
+                "gcode_move": [ "gcode_position" ]
             })
             if result.HasError():
                 self.Logger.error("GetCurrentLayerInfo failed to query toolhead objects: "+result.GetLoggingErrorStr())
@@ -1125,11 +1325,9 @@ class MoonrakerCompat:
         # For moonraker, we have found that if the print_stats reports a state of "printing"
         # but the "print_duration" is still 0, it means we are warming up. print_duration is the time actually spent printing
         # so it doesn't increment while the system is heating.
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+        result = MoonrakerClient.Get().QueryPrinterObjects(
         {
-            "objects": {
-                "print_stats": None
-            }
+            "print_stats": [ "state", "print_duration" ]
         })
         # Use the common helper function.
         return self.CheckIfPrinterIsWarmingUp_WithPrintStats(result)
@@ -1138,12 +1336,10 @@ class MoonrakerCompat:
     # ! Interface Function ! The entire interface must change if the function is changed.
     # Returns the current hotend temp and bed temp as a float in celsius if they are available, otherwise None.
     def GetTemps(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+        result = MoonrakerClient.Get().QueryPrinterObjects(
         {
-            "objects": {
-                "extruder": None,       # Needed for temps
-                "heater_bed": None,     # Needed for temps
-            }
+            "extruder": [ "temperature" ],      # Needed for temps
+            "heater_bed": [ "temperature" ],    # Needed for temps
         })
         # Validate
         if result.HasError():
@@ -1204,14 +1400,12 @@ class MoonrakerCompat:
         self.NotificationHandler.OnRestorePrintIfNeeded(state == "printing", state == "paused", self._GetPrintCookie(fileName_CanBeNone))
 
 
-    # Queries moonraker for the current printer stats.
+    # Gets the current printer stats, from the state mirror if possible.
     # Returns null if the call falls or the resulting object DOESN'T contain at least: filename, state, total_duration, print_duration
     def _GetCurrentPrintStats(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+        result = MoonrakerClient.Get().QueryPrinterObjects(
         {
-            "objects": {
-                "print_stats": None
-            }
+            "print_stats": [ "state", "filename", "total_duration", "print_duration" ]
         })
         # Validate
         if result.HasError():
@@ -20,23 +20,26 @@ class MoonrakerDatabase:
 
         # We use a few database entries under our own name space to share information with apps and other plugins.
         # Note that since these are used by 3rd party systems, they must never change. We also use this for our frontend.
-        result = MoonrakerClient.Get().SendJsonRpcRequest("server.database.post_item",
-        {
-            "namespace": "octoeverywhere",
-            "key": "public.printerId",
-            "value": self.PrinterId
-        })
-        if result.HasError():
-            self.Logger.error("Ensure database entry item post failed. "+result.GetLoggingErrorStr())
+        # Both items are sent at once, so we only wait for one round trip.
+        results = MoonrakerClient.Get().SendJsonRpcRequestBatch([
+            ("server.database.post_item",
+            {
+                "namespace": "octoeverywhere",
+                "key": "public.printerId",
+                "value": self.PrinterId
+            }),
+            ("server.database.post_item",
+            {
+                "namespace": "octoeverywhere",
+                "key": "public.pluginVersion",
+                "value": self.PluginVersion
+            }),
+        ])
+        if results[0].HasError():
+            self.Logger.error("Ensure database entry item post failed. "+results[0].GetLoggingErrorStr())
             return
-        result = MoonrakerClient.Get().SendJsonRpcRequest("server.database.post_item",
-        {
-            "namespace": "octoeverywhere",
-            "key": "public.pluginVersion",
-            "value": self.PluginVersion
-        })
-        if result.HasError():
-            self.Logger.error("Ensure database entry item plugin version failed. "+result.GetLoggingErrorStr())
+        if results[1].HasError():
+            self.Logger.error("Ensure database entry item plugin version failed. "+results[1].GetLoggingErrorStr())
             return
         self.Logger.debug("Ensure database items posted successfully.")
 
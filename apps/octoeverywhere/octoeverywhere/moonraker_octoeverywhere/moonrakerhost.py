@@ -7,6 +7,7 @@ from octoeverywhere.deviceid import DeviceId
 from octoeverywhere.telemetry import Telemetry
 from octoeverywhere.hostcommon import HostCommon
 from octoeverywhere.compression import Compression
+from octoeverywhere.staticassetcache import StaticAssetCache
 from octoeverywhere.octopingpong import OctoPingPong
 from octoeverywhere.httpsessions import HttpSessions
 from octoeverywhere.Webcam.webcamhelper import WebcamHelper
@@ -89,7 +90,7 @@ class MoonrakerHost:
             self.Logger.info("Plugin Version: %s", pluginVersionStr)
 
             # Setup the HttpSession cache early, so it can be used whenever
-            HttpSessions.Init(self.Logger)
+            HttpSessions.Init(self.Logger, self.Config.GetIntIfInRange(Config.GeneralSection, Config.GeneralLocalHttpMaxConnections, Config.GeneralLocalHttpMaxConnectionsDefault, 1, 512))
 
             # As soon as we have the plugin version, setup Sentry
             # Enabling profiling and no filtering, since we are the only PY in this process.
@@ -129,6 +130,9 @@ class MoonrakerHost:
             # Init compression
             Compression.Init(self.Logger, localStorageDir)
 
+            # Init the static asset cache, this must be after compression since it stores compressed assets.
+            StaticAssetCache.Init(self.Logger, localStorageDir)
+
             # Init the mdns client
             MDns.Init(self.Logger, localStorageDir)
 
@@ -185,7 +189,7 @@ class MoonrakerHost:
             MoonrakerClient.Init(self.Logger, self.Config, moonrakerConfigFilePath, printerId, self, pluginVersionStr)
 
             # Init our file meta data cache helper
-            FileMetadataCache.Init(self.Logger, MoonrakerClient.Get())
+            FileMetadataCache.Init(self.Logger, MoonrakerClient.Get(), localStorageDir)
 
             # Setup the command handler
             CommandHandler.Init(self.Logger, MoonrakerClient.Get().GetNotificationHandler(), MoonrakerCommandHandler(self.Logger), self)
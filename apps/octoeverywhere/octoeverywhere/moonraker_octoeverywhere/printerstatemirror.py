@@ -0,0 +1,145 @@
+import time
+import logging
+import threading
+
+# A local mirror of the printer objects we subscribe to with printer.objects.subscribe.
+#
+# Moonraker sends the full state of the subscribed objects in the subscribe response, and after that it only sends the fields that
+# changed in notify_status_update messages. By applying those deltas here, we can answer most printer.objects.query calls from memory
+# instead of doing a websocket round trip for each one. The notification timers and Gadget call these queries a lot while printing.
+class PrinterStateMirror:
+
+    # If we haven't gotten any message from moonraker in this long, we don't trust the mirror and the caller should do a real query.
+    # Moonraker sends a notify_proc_stat_update to all clients about every second, so when the connection is healthy we get messages often,
+    # even if nothing on the printer is changing.
+    MaxStalenessSec = 5.0
+
+
+    def __init__(self, logger:logging.Logger) -> None:
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        # Maps the object name to the set of subscribed fields, or None if all fields are subscribed.
+        self.SubscribedObjects = {}
+        # Maps the object name to a dict of the current field values.
+        self.Status = {}
+        self.EventTime = 0.0
+        self.IsSynced = False
+        # While we are waiting on the subscribe response, updates are held here, so they can be applied on top of the snapshot.
+        # When this is None, updates are dropped.
+        self.PendingUpdates = None
+        self.LastMessageTimeSec = 0.0
+
+
+    # Called right before the subscribe request is sent, with the same objects dict used for the request.
+    # The mirror won't serve anything until SetSnapshot is called.
+    def Reset(self, subscribedObjects:dict):
+        with self.Lock:
+            self.SubscribedObjects = {}
+            for name, fields in subscribedObjects.items():
+                self.SubscribedObjects[name] = None if fields is None else set(fields)
+            self.Status = {}
+            self.EventTime = 0.0
+            self.IsSynced = False
+            self.PendingUpdates = []
+
+
+    # Called with the result of the subscribe request, which has the full state of all of the subscribed objects.
+    def SetSnapshot(self, result:dict):
+        if result is None or "status" not in result:
+            self.Logger.warn("PrinterStateMirror got a subscribe result with no status, the mirror will not be used.")
+            self.Invalidate()
+            return
+        snapshotEventTime = result.get("eventtime", 0.0)
+        with self.Lock:
+            self.Status = {}
+            for name, fields in result["status"].items():
+                if isinstance(fields, dict):
+                    self.Status[name] = dict(fields)
+            self.EventTime = snapshotEventTime
+            # Apply any updates that came in while we were waiting for the response, if they are newer than the snapshot.
+            pending = self.PendingUpdates
+            self.PendingUpdates = None
+            if pending is not None:
+                for update, eventTime in pending:
+                    if eventTime is None or eventTime >= snapshotEventTime:
+                        self._ApplyUpdate(update, eventTime)
+            self.IsSynced = True
+            self.LastMessageTimeSec = time.time()
+
+
+    # Called when the websocket is lost or the subscription fails, since we will miss updates until we subscribe again.
+    def Invalidate(self):
+        with self.Lock:
+            self.IsSynced = False
+            self.PendingUpdates = None
+            self.Status = {}
+
+
+    # Called for every non response message we get from moonraker, this is how we know the connection is still healthy.
+    def OnMessageReceived(self):
+        self.LastMessageTimeSec = time.time()
+
+
+    # Called with a notify_status_update message, which has the changed fields of the subscribed objects.
+    def OnStatusUpdate(self, msg:dict):
+        params = msg.get("params", None)
+        if not isinstance(params, list) or len(params) == 0 or not isinstance(params[0], dict):
+            return
+        update = params[0]
+        eventTime = None
+        if len(params) > 1 and isinstance(params[1], (int, float)):
+            eventTime = params[1]
+        with self.Lock:
+            self.LastMessageTimeSec = time.time()
+            if self.IsSynced:
+                self._ApplyUpdate(update, eventTime)
+            elif self.PendingUpdates is not None:
+                self.PendingUpdates.append((update, eventTime))
+
+
+    # Returns a result in the same format as the printer.objects.query result if all of the requested objects and fields are subscribed
+    # and the mirror is fresh. Otherwise returns None, and the caller should do a real query.
+    # The objects dict is the same format as the printer.objects.query request, the object name maps to a list of fields or None for all fields.
+    def Query(self, objects:dict):
+        with self.Lock:
+            if self.IsSynced is False or time.time() - self.LastMessageTimeSec > PrinterStateMirror.MaxStalenessSec:
+                return None
+            status = {}
+            for name, fields in objects.items():
+                if name not in self.SubscribedObjects:
+                    return None
+                subscribedFields = self.SubscribedObjects[name]
+                current = self.Status.get(name, {})
+                if fields is None:
+                    # All fields were asked for, which we only have if we subscribed to all of them.
+                    if subscribedFields is not None:
+                        return None
+                    # The values are replaced, never edited, when updates are applied, so a shallow copy is enough.
+                    status[name] = dict(current)
+                else:
+                    if subscribedFields is not None and subscribedFields.issuperset(fields) is False:
+                        return None
+                    obj = {}
+                    for f in fields:
+                        if f in current:
+                            obj[f] = current[f]
+                    status[name] = obj
+            return {
+                "eventtime": self.EventTime,
+                "status": status
+            }
+
+
+    # Must be called under lock.
+    def _ApplyUpdate(self, update:dict, eventTime):
+        for name, fields in update.items():
+            if not isinstance(fields, dict):
+                continue
+            current = self.Status.get(name, None)
+            if current is None:
+                current = {}
+                self.Status[name] = current
+            # Klipper only sends the top level fields that changed, and always sends the entire value of the field, so we can just replace them.
+            current.update(fields)
+        if eventTime is not None:
+            self.EventTime = eventTime
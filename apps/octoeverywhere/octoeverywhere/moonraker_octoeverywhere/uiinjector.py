@@ -6,6 +6,7 @@ import random
 import string
 
 from octoeverywhere.sentry import Sentry
+from octoeverywhere.staticassetcache import StaticAssetCache
 from octoeverywhere.ostypeidentifier import OsTypeIdentifier
 from octoeverywhere.debugprofiler import DebugProfiler, DebugProfilerFeatures
 
@@ -155,6 +156,10 @@ class UiInjector():
         # we won't update the static assets.
         if wasUpdatedOrAdded:
             self._UpdateSwHash(staticHtmlRootPath)
+            # The index changed, which usually means the frontend or our UI was updated, so drop any static assets we have cached.
+            staticAssetCache = StaticAssetCache.Get()
+            if staticAssetCache is not None:
+                staticAssetCache.Invalidate("ui injection updated")
 
         # Success!
         return True
@@ -0,0 +1,146 @@
+import logging
+
+
+# An incremental, byte level reader for multipart (boundary) http bodies, like mjpeg webcam streams.
+#
+# All of the parsing is done directly on the bytes in the read buffer, nothing is decoded into a str.
+# Frames are always returned at the start of the buffer, so the caller can use a memoryview over the buffer to send
+# the frame without copying it. If a read goes past the end of a frame, the extra bytes are kept and used as the start
+# of the next frame, instead of being dropped.
+class MultipartFrameReader:
+
+    # 3/24/24 - After a lot of testing, it seems most times we get the full headers in 120 chars.
+    # So we will target that much, hoping we can do one read and get them.
+    # We want to read enough that hopefully we get all of the headers, but not so much that we block waiting on the next frame.
+    c_HeaderProbeSizeBytes = 120
+
+    # If we can't find the end of the headers after this much data, we declare there are no headers.
+    c_MaxHeaderSearchSizeBytes = 5 * 1024
+
+    c_EndOfAllHeaders = b"\r\n\r\n"
+    c_ContentLengthHeader = b"content-length"
+
+
+    # readFunc must take a size and return a bytes like object of up to that size, or None when the body is complete.
+    def __init__(self, logger:logging.Logger, boundaryStr:str, readFunc):
+        self.Logger = logger
+        self.ReadFunc = readFunc
+        boundary = boundaryStr.encode()
+        # These are in order of how common they are, for perf.
+        self.BoundaryPrefixes = (b"--" + boundary, boundary, b"\r\n--" + boundary)
+        self.BoundaryStr = boundaryStr
+        self.MissingBoundaryWarningCounter = 0
+
+        # The buffer holds [0:DataEnd] of read data. [0:FrameEnd] is the last frame returned, the rest is carry over.
+        self.Buffer = bytearray(10 * 1024)
+        self.FrameEnd = 0
+        self.DataEnd = 0
+
+
+    # Reads the next frame from the body.
+    # Returns a tuple of (frameSize, hasContentLength). The frame is in Buffer[0:frameSize] and is valid until the next call.
+    # The frame size will be 0 when the body has been fully read.
+    # If hasContentLength is False, no content-length header was found, and all of the data read so far was returned.
+    # In that case the caller should stop using this reader and read the rest of the body in fixed size chunks.
+    def ReadFrame(self):
+        # Move anything we read past the end of the last frame to the front of the buffer.
+        self._Compact()
+
+        # Read until we find the end of the headers.
+        headerEnd = self.Buffer.find(self.c_EndOfAllHeaders, 0, self.DataEnd)
+        while headerEnd == -1:
+            if self.DataEnd >= self.c_MaxHeaderSearchSizeBytes:
+                return (self._TakeAll(), False)
+            # Back up a few bytes, in case the end sequence was split between reads.
+            searchStart = max(0, self.DataEnd - len(self.c_EndOfAllHeaders) + 1)
+            if self._Read(self.c_HeaderProbeSizeBytes) is False:
+                # The body read is complete, return whatever we have.
+                return (self._TakeAll(), True)
+            headerEnd = self.Buffer.find(self.c_EndOfAllHeaders, searchStart, self.DataEnd)
+
+        self._CheckBoundary()
+
+        # Find the content length, if the headers have it.
+        contentLength = self._ParseContentLength(headerEnd)
+        if contentLength is None:
+            # It's ok if there isn't one, since it's not required for boundary chunks.
+            return (self._TakeAll(), False)
+
+        # Add 4 bytes for the \r\n\r\n end of header sequence. Also add two bytes for the \r\n at the end of this boundary chunk.
+        frameSize = headerEnd + len(self.c_EndOfAllHeaders) + 2 + contentLength
+
+        # Read the remainder of the frame, if we don't already have it.
+        while self.DataEnd < frameSize:
+            if self._Read(frameSize - self.DataEnd) is False:
+                # If we hit the end of the body, return how much we read already.
+                return (self._TakeAll(), True)
+
+        # Anything past the frame size is carried over into the next frame.
+        self.FrameEnd = frameSize
+        return (frameSize, True)
+
+
+    def _ParseContentLength(self, headerEnd:int):
+        # The header block is small, so the lower() copy is cheap.
+        headers = bytes(self.Buffer[0:headerEnd]).lower()
+        headerStart = 0
+        if headers.startswith(self.c_ContentLengthHeader) is False:
+            headerStart = headers.find(b"\r\n" + self.c_ContentLengthHeader)
+            if headerStart == -1:
+                return None
+            headerStart += 2
+        lineEnd = headers.find(b"\r\n", headerStart)
+        if lineEnd == -1:
+            lineEnd = len(headers)
+        p = headers[headerStart:lineEnd].split(b":")
+        if len(p) != 2:
+            return None
+        try:
+            # int() will parse ascii digits from bytes and strip the whitespace.
+            return int(p[1])
+        except ValueError:
+            return None
+
+
+    def _CheckBoundary(self):
+        # Validate the frame starts with what we expect.
+        # According the the RFC, the boundary should start with the boundary string or '--' + boundary string.
+        # However, we have also seen \r\n--<str> and also no boundary string for the first frame as well. So this might fire once or twice, and that's fine.
+        if self.Buffer.startswith(self.BoundaryPrefixes):
+            return
+        # Always report the first time we find this, otherwise, report only occasionally.
+        if self.MissingBoundaryWarningCounter % 120 == 0:
+            outputStr = bytes(self.Buffer[:min(40, self.DataEnd)]).decode(errors="ignore")
+            self.Logger.warn("We read a web stream body frame, but it didn't start with the expected boundary header. expected:'"+self.BoundaryStr+"' got:^^"+outputStr+"^^")
+        self.MissingBoundaryWarningCounter += 1
+
+
+    # Returns all of the data in the buffer as the frame.
+    def _TakeAll(self) -> int:
+        self.FrameEnd = self.DataEnd
+        return self.DataEnd
+
+
+    def _Compact(self):
+        carryOver = self.DataEnd - self.FrameEnd
+        if carryOver > 0 and self.FrameEnd > 0:
+            self.Buffer[0:carryOver] = self.Buffer[self.FrameEnd:self.DataEnd]
+        self.DataEnd = carryOver
+        self.FrameEnd = 0
+
+
+    # Reads up to readSize more bytes into the end of the buffer. Returns False if the body read is complete.
+    def _Read(self, readSize:int) -> bool:
+        data = self.ReadFunc(readSize)
+        if data is None or len(data) == 0:
+            return False
+        dataLen = len(data)
+        newDataEnd = self.DataEnd + dataLen
+        if newDataEnd > len(self.Buffer):
+            # Grow into a new buffer, so any memoryviews the caller might still hold on the old buffer aren't affected.
+            newBuffer = bytearray(max(newDataEnd, len(self.Buffer) * 2))
+            newBuffer[0:self.DataEnd] = self.Buffer[0:self.DataEnd]
+            self.Buffer = newBuffer
+        self.Buffer[self.DataEnd:newDataEnd] = data
+        self.DataEnd = newDataEnd
+        return True
@@ -8,6 +8,7 @@ import octoflatbuffers
 
 from .octoheaderimpl import HeaderHelper
 from .octoheaderimpl import BaseProtocol
+from .multipartframereader import MultipartFrameReader
 from ..octohttprequest import OctoHttpRequest
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from ..Webcam.webcamhelper import WebcamHelper
@@ -15,6 +16,7 @@ from ..commandhandler import CommandHandler
 from ..compression import Compression, CompressionContext
 from ..sentry import Sentry
 from ..compat import Compat
+from ..staticassetcache import StaticAssetCache
 from ..Proto import HttpHeader
 from ..Proto import WebStreamMsg
 from ..Proto import MessageContext
@@ -58,11 +60,10 @@ class OctoWebStreamHttpHelper:
         self.CompressionContext = CompressionContext(self.Logger)
 
         # Vars for response reading
-        self.BodyReadTempBuffer:bytearray = None
+        self.MultipartReader:MultipartFrameReader = None
         self.ChunkedBodyHasNoContentLengthHeaders = False
         self.CompressionType:DataCompression.DataCompression = None
         self.CompressionTimeSec = -1
-        self.MissingBoundaryWarningCounter = 0
         self.IsUsingFullBodyBuffer = False
         self.IsUsingCustomBodyStreamCallbacks = False
 
@@ -223,7 +224,7 @@ class OctoWebStreamHttpHelper:
                 isFromCache = True
             else:
                 # If we don't have a valid result yet, do the normal http path.
-                octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, self.UploadBuffer)
+                octoHttpResult = self.makeHttpCallWithStaticAssetCache(httpInitialContext, method, sendHeaders)
 
 
         # If None is returned, it failed.
@@ -645,6 +646,35 @@ class OctoWebStreamHttpHelper:
         return Compression.Get().Decompress(self.CompressionContext, dataByteArray, webStreamMsg.OriginalDataSize(), webStreamMsg.IsDataTransmissionDone(), compressionType)
 
 
+    # Makes the http call, using the static asset cache if there is one.
+    # If the asset is cached, the web server is asked if it changed, and if not, the result will have the cached compressed body.
+    # If the asset isn't cached but can be, the result will have the compressed body, which is now cached.
+    def makeHttpCallWithStaticAssetCache(self, httpInitialContext, method:str, sendHeaders:dict) -> OctoHttpRequest.Result:
+        staticAssetCache = StaticAssetCache.Get()
+        if staticAssetCache is None:
+            return OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, self.UploadBuffer)
+
+        # If the response handler might edit this response, we can't cache it.
+        path = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Path())
+        if path is None or (Compat.HasWebRequestResponseHandler() and Compat.GetWebRequestResponseHandler().CheckIfResponseNeedsToBeHandled(path) is not None):
+            return OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, self.UploadBuffer)
+
+        entryKey = StaticAssetCache.GetEntryKey(path, httpInitialContext.PathType())
+        requestHeaders = staticAssetCache.AddConditionalHeadersIfCached(entryKey, method, sendHeaders)
+        addedConditionalHeaders = requestHeaders is not sendHeaders
+        octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, requestHeaders, self.UploadBuffer)
+        if staticAssetCache.UpdateResult(entryKey, method, addedConditionalHeaders, octoHttpResult):
+            return octoHttpResult
+
+        # If we asked if the asset changed but the cached body couldn't be used, the browser didn't ask for a 304, so make the request again as it was sent.
+        if addedConditionalHeaders and octoHttpResult is not None and octoHttpResult.StatusCode == 304:
+            with octoHttpResult:
+                pass
+            octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, self.UploadBuffer)
+            staticAssetCache.UpdateResult(entryKey, method, False, octoHttpResult)
+        return octoHttpResult
+
+
     def checkForNotModifiedCacheAndUpdateResponseIfSo(self, sentHeaders, octoHttpResult:OctoHttpRequest.Result):
         # Check if the sent headers have any conditional http headers.
         requestEtag = None
@@ -747,6 +777,10 @@ class OctoWebStreamHttpHelper:
         if contentTypeLower is None:
             return False
 
+        # Never compress things that are already compressed, like images, video, or archives.
+        if Compression.IsAlreadyCompressedContentType(contentTypeLower):
+            return False
+
         # We will compress...
         #   - Any thing that has text/ in it
         #   - Anything that says it's javascript
@@ -810,7 +844,7 @@ class OctoWebStreamHttpHelper:
                         # We create a memory view from the buffer, which is a zero copy operation and zero copy slicing.
                         # This allows us to pass the buffer around without copying it, but we do have to be sure to release the
                         # memory views when we are done.
-                        finalDataBufferMv_CanBeNone = memoryview(self.BodyReadTempBuffer)
+                        finalDataBufferMv_CanBeNone = memoryview(self.MultipartReader.Buffer)
                         finalDataBuffer = finalDataBufferMv_CanBeNone[0:readLength]
                 else:
                     if self.UnknownBodyChunkReadContext is not None or (responseHandlerContext is None and self.shouldDoUnknownBodyChunkRead(contentTypeLower_NoneIfNotKnown, contentLength_NoneIfNotKnown)):
@@ -872,7 +906,7 @@ class OctoWebStreamHttpHelper:
 
             # Otherwise, check if we should compress
             elif shouldCompress:
-                compressionResult = Compression.Get().Compress(self.CompressionContext, finalDataBuffer)
+                compressionResult = Compression.Get().Compress(self.CompressionContext, finalDataBuffer, contentTypeLower_NoneIfNotKnown)
                 finalDataBuffer = compressionResult.Bytes
                 # Init and update the total compression time if needed.
                 if self.CompressionTimeSec < 0:
@@ -901,93 +935,19 @@ class OctoWebStreamHttpHelper:
 
 
     # Reads a single chunk from the http response.
-    # This function uses the BodyReadTempBuffer to store the data.
+    # This function uses the MultipartReader buffer to store the data, the chunk is at the start of the buffer.
     # Returns the read size, 0 if the body read is complete.
     def readStreamChunk(self, octoHttpResult:OctoHttpRequest.Result, boundaryStr):
-        frameSize = 0
-        headerSize = 0
-        foundContentLength = False
-
-        # If the temp array isn't setup, do it now.
-        if self.BodyReadTempBuffer is None:
-            self.BodyReadTempBuffer = bytearray(10*1024)
+        # If the reader isn't setup, do it now.
+        # The reader is kept for the life of the stream, since it holds any data read past the end of the last chunk.
+        if self.MultipartReader is None:
+            self.MultipartReader = MultipartFrameReader(self.Logger, boundaryStr, lambda readSize: self.doBodyRead(octoHttpResult, readSize))
 
         # Note. OctoPrint webcam streams have content-length headers in each chunk. However, the standard
         # says it's not required. So if we can find them use them, but if not we will set the
         # ChunkedBodyHasNoContentLengthHeaders so that future body reads don't attempt to find the headers again.
-
-        # First, we need to see if we can find the content length header.
-        # We will keep grabbing more and more data in loop until we find the header
-        # If we can't find it after our max size, we declare it's not there (which is fine)
-        # and will use a different read method going forward.
-        c_maxHeaderSearchSizeBytes = 5 * 1024
-        tempBufferFilledSize = 0
         try:
-            # Loop until found or we have hit the search limit.
-            while foundContentLength is False and tempBufferFilledSize < c_maxHeaderSearchSizeBytes:
-                # Read a small chunk to try to read the header
-                # We want to read enough that hopefully we get all of the headers, but not so much that
-                # we accidentally read two boundary messages at once.
-                # 3/24/24 - After a lot of testing, it seems most times we get the full headers in 120 chars.
-                # So we will target that much, hoping we can do one read and get them.
-                headerBuffer = self.doBodyRead(octoHttpResult, 120)
-
-                # If this returns 0, the body read is complete
-                if headerBuffer is None:
-                    # We should return the length of the buffer we have read so far.
-                    return tempBufferFilledSize
-
-                # Add the header buffer to the temp output
-                self.BodyReadTempBuffer[tempBufferFilledSize:tempBufferFilledSize+len(headerBuffer)] = headerBuffer
-                tempBufferFilledSize += len(headerBuffer)
-
-                # Convert the entire buffer read so far into a string for parsing.
-                # We must use the decode function here, not just str(), because in py3 str() will make a "ToString" the object,
-                # and not actually return us the contents of the buffer as a string.
-                headerStr = self.BodyReadTempBuffer[:tempBufferFilledSize].decode(errors="ignore")
-
-                # Validate the headers starts with what we expect.
-                # According the the RFC, the boundary should start with the boundary string or '--' + boundary string.
-                # However, we have also seen \r\n--<str> and also no boundary string for the first frame as well. So this might fire once or twice, and that's fine.
-                # These are in order of how common they are, for perf.
-                if headerStr.startswith("--"+boundaryStr) is False and headerStr.startswith(boundaryStr) is False and headerStr.startswith("\r\n--"+boundaryStr) is False:
-                    # Always report the first time we find this, otherwise, report only occasionally.
-                    if self.MissingBoundaryWarningCounter % 120 == 0:
-                        # Trim the string to print it.
-                        outputStr = headerStr
-                        if len(outputStr) > 40:
-                            outputStr = outputStr[:40]
-                        self.Logger.warn("We read a web stream body frame, but it didn't start with the expected boundary header. expected:'"+boundaryStr+"' got:^^"+outputStr+"^^")
-                    self.MissingBoundaryWarningCounter += 1
-
-                # Find out how long the headers are. The \r\n\r\n sequence ends the headers.
-                endOfAllHeadersMatch = "\r\n\r\n"
-                endOfHeaderMatch = "\r\n"
-
-                # Try to find headers
-                # This logic checks for errors, and if found, don't stop the logic because of them
-                # This will cause us to loop again and read more. The reason for this is since we read random
-                # chunks, we could read a chunk that splits the content-length header in half, which would cause errors.
-                # So we just allow the system to keep reading until we hit the limit, because the next read would then have the full
-                # header we are looking for.
-                headerSize = headerStr.find(endOfAllHeadersMatch)
-                if headerSize != -1:
-                    # We found at least some headers!
-
-                    # Add 4 bytes for the \r\n\r\n end of header sequence. Also add two bytes for the \r\n at the end of this boundary chunk.
-                    headerSize += 4 + 2
-
-                    # Split out the headers
-                    headers = headerStr.split(endOfHeaderMatch)
-                    for header in headers:
-                        if header.lower().startswith("content-length"):
-                            # We found the content-length header!
-                            p = header.split(':')
-                            if len(p) == 2:
-                                frameSize = int(p[1].strip())
-                                foundContentLength = True
-                            break
-
+            frameSize, foundContentLength = self.MultipartReader.ReadFrame()
         except Exception as e:
             Sentry.Exception(self.getLogMsgPrefix()+ " exception thrown in http stream chunk reader", e)
             return 0
@@ -996,37 +956,13 @@ class OctoWebStreamHttpHelper:
         if foundContentLength is False:
             # It ok if we didn't find it, since it's not required for boundary chunks
             # In this case, we will set the flag so future reads don't try again.
+            # The reader returns everything it read in this case, so no data is left behind in it.
             self.ChunkedBodyHasNoContentLengthHeaders = True
-            # And return the length of whatever we read
-            return tempBufferFilledSize
-
-        # We have a content-length!
-        # Compute how much more we need to read.
-        toRead = (frameSize + headerSize) - tempBufferFilledSize
-        if toRead < 0:
-            # Oops. This means we read into the next chunk.
-            # TODO - we could update this logic to correct itself by appending this chunk data
-            # on the next chunk, but as it stands it won't work.
-            # So just put the stream into the no content-length mode and return what we read.
-            self.Logger.error(self.getLogMsgPrefix()+ " http stream to read size is less than 0. FrameSize:"+str(frameSize) + " HeaderSize:"+str(headerSize) + " Read:"+str(tempBufferFilledSize))
-            self.ChunkedBodyHasNoContentLengthHeaders = True
-            return tempBufferFilledSize
-
-        # Read the remainder of the chunk.
-        if toRead > 0:
-            data = self.doBodyRead(octoHttpResult, toRead)
+            return frameSize
 
-            # If we hit the end of the body, return how much we read already.
-            if data is None:
-                return tempBufferFilledSize
-
-            # Warn if twe didn't read it all
-            if len(data) != toRead:
-                self.Logger.warn(self.getLogMsgPrefix()+" while reading a boundary chunk, doBodyRead didn't return the full size we requested.")
-
-            # Copy this data into the temp buffer
-            self.BodyReadTempBuffer[tempBufferFilledSize:tempBufferFilledSize+len(data)] = data
-            tempBufferFilledSize += len(data)
+        # If the body is done, there's no frame to count.
+        if frameSize == 0:
+            return 0
 
         # Update our read rate. This is a metric we send along in the stream if the it's a multipart stream, to know how fast we are reading it.
         # Basically for webcams streamed via http, it's the frame rate.
@@ -1044,15 +980,15 @@ class OctoWebStreamHttpHelper:
             # Note if this spins multiple times, it will be zeroed out. That would mean there's a more than 1s gap in reading.
             if isFirstIncrement is False and self.MultipartReadsPerSecond == 0:
                 self.Logger.warn("Multipart read per second stats hit a period where 0 reads happened for more than second.")
-            self.MultipartReadsPerSecond = self.MissingBoundaryWarningCounter
-            self.MissingBoundaryWarningCounter = 0
+            self.MultipartReadsPerSecond = self.MultipartReadsPerSecondCounter
+            self.MultipartReadsPerSecondCounter = 0
             isFirstIncrement = False
 
         # Now increment our counter, to account for the frame we just processed.
-        self.MissingBoundaryWarningCounter += 1
+        self.MultipartReadsPerSecondCounter += 1
 
-        # Finally, return how much we put into the temp buffer!
-        return tempBufferFilledSize
+        # Finally, return how much we put into the buffer!
+        return frameSize
 
 
     def doBodyRead(self, octoHttpResult:OctoHttpRequest.Result, readSize:int):
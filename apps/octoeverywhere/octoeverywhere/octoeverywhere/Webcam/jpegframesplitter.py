@@ -0,0 +1,136 @@
+import logging
+
+# Splits a continuous stream of back to back jpeg images, like the ffmpeg image2pipe output, into frames.
+#
+# The data is read directly into a preallocated buffer, and the jpeg end markers are found with bytearray.find, which runs in native code.
+# Frames are returned as memoryviews over the buffer, so there's no copy. Because of that, a frame is only valid until the next call to GetWriteView.
+# If more than one full frame is in the buffer, only the newest frame is returned and the older ones are dropped, so we never fall behind the stream.
+#
+# The buffer is linear and compacted when space is needed, rather than a wrapping ring buffer, so every frame is contiguous and can be returned without a copy.
+# Compacting only moves the partial frame at the end of the buffer, which is small compared to the frames we return.
+class JpegFrameSplitter:
+
+    c_JpegEndSequence = b"\xff\xd9"
+
+    # The default buffer size, this is big enough for a few 1080p frames.
+    c_DefaultBufferSizeBytes = 512 * 1024
+
+    # If a single frame gets bigger than this, the data is thrown away and we wait for the next frame.
+    c_DefaultMaxBufferSizeBytes = 8 * 1024 * 1024
+
+
+    # The start sequence is the expected start of every frame, any frame that doesn't start with it is dropped.
+    def __init__(self, logger:logging.Logger, startSequence:bytes, bufferSizeBytes:int = c_DefaultBufferSizeBytes, maxBufferSizeBytes:int = c_DefaultMaxBufferSizeBytes) -> None:
+        self.Logger = logger
+        self.StartSequence = bytes(startSequence)
+        self.MaxBufferSizeBytes = maxBufferSizeBytes
+        self.Buffer = bytearray(bufferSizeBytes)
+        # [FrameStart:DataEnd] is the data that's not part of a returned frame yet.
+        self.FrameStart = 0
+        self.DataEnd = 0
+        # Where the next end sequence search starts, so we never scan the same data twice.
+        self.ScanIndex = 0
+
+        # Stats
+        self.FramesReturned = 0
+        self.FramesDropped = 0
+        self.BytesDiscarded = 0
+
+
+    # Returns a writable memoryview of at least minFreeBytes at the end of the buffer, for the caller to read data into.
+    # Once the data is written, CommitWrite must be called with the number of bytes written.
+    # This invalidates any frame returned before.
+    def GetWriteView(self, minFreeBytes:int) -> memoryview:
+        self._Compact()
+        if len(self.Buffer) - self.DataEnd < minFreeBytes:
+            newSize = len(self.Buffer)
+            while newSize - self.DataEnd < minFreeBytes and newSize < self.MaxBufferSizeBytes:
+                newSize = min(newSize * 2, self.MaxBufferSizeBytes)
+            if newSize - self.DataEnd < minFreeBytes:
+                # A single frame filled the max buffer without an end sequence, so the stream is broken. Drop it all and resync on the next frame.
+                self.Logger.warn(f"JpegFrameSplitter dropped {self.DataEnd} bytes, since no frame end was found.")
+                self.BytesDiscarded += self.DataEnd
+                self.DataEnd = 0
+                self.ScanIndex = 0
+            else:
+                # Grow into a new buffer, so any memoryviews the caller might still hold on the old buffer aren't affected.
+                newBuffer = bytearray(newSize)
+                newBuffer[0:self.DataEnd] = self.Buffer[0:self.DataEnd]
+                self.Buffer = newBuffer
+        return memoryview(self.Buffer)[self.DataEnd:]
+
+
+    # Commits bytes written into the view returned by GetWriteView.
+    def CommitWrite(self, writtenBytes:int) -> None:
+        self.DataEnd += writtenBytes
+
+
+    # Copies the data into the buffer. This is useful when the data is already in a bytes object.
+    def Feed(self, data) -> None:
+        dataLen = len(data)
+        with self.GetWriteView(dataLen) as view:
+            view[0:dataLen] = data
+        self.CommitWrite(dataLen)
+
+
+    # Returns a memoryview of the newest full frame in the buffer, or None if there isn't one yet.
+    # Any older full frames are dropped. The frame is only valid until the next call to GetWriteView or Feed.
+    def GetNewestFrame(self):
+        buffer = self.Buffer
+        dataEnd = self.DataEnd
+        endSeq = JpegFrameSplitter.c_JpegEndSequence
+        startSeq = self.StartSequence
+        frameStart = self.FrameStart
+        newestStart = -1
+        newestEnd = -1
+        found = 0
+        while True:
+            endIndex = buffer.find(endSeq, self.ScanIndex, dataEnd)
+            if endIndex == -1:
+                break
+            frameEnd = endIndex + 2
+            self.ScanIndex = frameEnd
+            # Make sure the frame starts where we expect, if not, look for the start sequence in the data.
+            if buffer.startswith(startSeq, frameStart) is False:
+                realStart = buffer.find(startSeq, frameStart, frameEnd)
+                if realStart == -1:
+                    # There's no frame start in this data, so it's not a full frame.
+                    self.BytesDiscarded += frameEnd - frameStart
+                    frameStart = frameEnd
+                    continue
+                self.BytesDiscarded += realStart - frameStart
+                frameStart = realStart
+            newestStart = frameStart
+            newestEnd = frameEnd
+            found += 1
+            frameStart = frameEnd
+
+        self.FrameStart = frameStart
+        # Back up one byte, so we find an end sequence that's split between reads.
+        self.ScanIndex = max(frameStart, dataEnd - 1)
+        if found == 0:
+            return None
+        self.FramesReturned += 1
+        self.FramesDropped += found - 1
+        return memoryview(buffer)[newestStart:newestEnd]
+
+
+    # Returns a dict of the stats.
+    def GetStats(self) -> dict:
+        return {
+            "FramesReturned": self.FramesReturned,
+            "FramesDropped": self.FramesDropped,
+            "BytesDiscarded": self.BytesDiscarded,
+        }
+
+
+    # Moves any pending data to the front of the buffer.
+    def _Compact(self) -> None:
+        if self.FrameStart == 0:
+            return
+        pending = self.DataEnd - self.FrameStart
+        if pending > 0:
+            self.Buffer[0:pending] = self.Buffer[self.FrameStart:self.DataEnd]
+        self.ScanIndex = max(0, self.ScanIndex - self.FrameStart)
+        self.DataEnd = pending
+        self.FrameStart = 0
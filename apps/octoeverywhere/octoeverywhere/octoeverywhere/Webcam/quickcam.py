@@ -14,6 +14,8 @@ from enum import Enum
 from octoeverywhere.sentry import Sentry
 
 from .webcamutil import WebcamUtil
+from .jpegframesplitter import JpegFrameSplitter
+from .quickcambroadcaster import QuickCamBroadcaster, QuickCamFrameMailbox
 from ..octohttprequest import OctoHttpRequest
 from .webcamsettingitem import WebcamSettingItem
 from .webcamstreaminstance import WebcamStreamInstance
@@ -170,8 +172,8 @@ class QuickCam:
         self.CurrentImage:bytearray = None
         self.ImageCounter = 0 # Used to monitor stalls
         self.LastImageRequestTimeSec:float = 0.0
-        self.ImageStreamCallbacks = []
-        self.ImageStreamCallbackLock = threading.Lock()
+        # Fans out each new image to the attached streams, without the capture thread waiting on any of them.
+        self.Broadcaster = QuickCamBroadcaster(logger)
 
 
     # Given a URL, this function returns the quick cam type that will be used and if it's supported.
@@ -221,22 +223,19 @@ class QuickCam:
         return self.CurrentImage
 
 
-    # Used to attach a new stream handler to receive callbacks when an image is ready.
+    # Used to attach a new stream client, which gets a mailbox that will always hold the newest image.
     # Note a call to detach must be called as well!
-    def AttachImageStreamCallback(self, callback):
-        # Add our callback to the list.
-        with self.ImageStreamCallbackLock:
-            self.ImageStreamCallbacks.append(callback)
+    def AttachFrameMailbox(self) -> QuickCamFrameMailbox:
+        mailbox = self.Broadcaster.Attach()
 
         # Ensure that the capture thread is running.
         self._ensureCaptureThreadRunning()
+        return mailbox
 
 
-    # Used to detach a new stream handler to receive callbacks when an image is ready.
-    def DetachImageStreamCallback(self, callback):
-        # Remove our callback.
-        with self.ImageStreamCallbackLock:
-            self.ImageStreamCallbacks.remove(callback)
+    # Used to detach a stream client, this will close the mailbox.
+    def DetachFrameMailbox(self, mailbox:QuickCamFrameMailbox):
+        self.Broadcaster.Detach(mailbox)
 
 
     # Called when there's a new image from the capture thread.
@@ -246,13 +245,12 @@ class QuickCam:
         self.ImageCounter += 1
         # Release anyone waiting on it.
         self.ImageReady.set()
-        # Fire the callbacks, if there are any.
-        with self.ImageStreamCallbackLock:
-            if len(self.ImageStreamCallbacks) > 0:
-                # Update the last image request time to ensure the stream keeps going.
-                self.LastImageRequestTimeSec = time.time()
-                for callback in self.ImageStreamCallbacks:
-                    callback(self.CurrentImage)
+        # Hand the image to the stream clients, if there are any. This only swaps the image into each client's mailbox,
+        # so a slow client will drop frames rather than slowing down the capture thread.
+        if self.Broadcaster.HasClients():
+            # Update the last image request time to ensure the stream keeps going.
+            self.LastImageRequestTimeSec = time.time()
+            self.Broadcaster.Publish(img)
 
 
     # Call to make sure the capture thread is running.
@@ -606,6 +604,10 @@ class QuickCam_RTSP:
     # How long we will wait for data on each read before timing out.
     c_ReadTimeoutSec = 5.0
 
+    # The min amount of free space we want in the buffer for each pipe read.
+    # This is a few frames worth of data, so most reads get everything that's ready at once.
+    c_ReadSizeBytes = 256 * 1024
+
     # Adds a ton of logging useful for debugging.
     c_DebugLogging = False
 
@@ -615,11 +617,9 @@ class QuickCam_RTSP:
         self.Process:subprocess.Popen = None
 
         # Image getting stuff
-        self.Buffer = bytearray()
-        self.SearchedIndex = 0
+        # ffmpeg writes the jpegs back to back on stdout, the splitter finds the frames.
         self.JpegStartSequence = bytearray([0xff, 0xd8, 0xff, 0xfe, 0x00, 0x10])
-        self.JpegStartSequenceLen = len(self.JpegStartSequence)
-        self.JpegEndSequence = bytearray([0xff, 0xd9])
+        self.FrameSplitter = JpegFrameSplitter(logger, self.JpegStartSequence)
         self.PipeSelect = selectors.DefaultSelector()
         self.TimeSinceLastImg = time.time()
 
@@ -687,8 +687,8 @@ class QuickCam_RTSP:
             # We timeout after 5 seconds, which is plenty of time for the stream to be ready.
             self.PipeSelect.select(QuickCam_RTSP.c_ReadTimeoutSec)
 
-            # Read all of the data we can.
-            buffer = self.Process.stdout.read(100000000)
+            # Read all of the data we can, directly into the frame splitter's buffer.
+            readBytes = self._ReadIntoFrameSplitter()
 
             # Check for a timeout. This can happen because the select timeout, or it's been too long since we got an image parsed.
             # This usually means that ffmpeg has died or is not running correctly.
@@ -697,89 +697,51 @@ class QuickCam_RTSP:
                     self.StdErrBuffer = "<None>"
                 raise Exception(f"Ffmpeg read timeout. ffmpeg output:\n{self.StdErrBuffer}")
 
-            # If we get an empty buffer, we just need to wait for more.
-            if buffer is None or len(buffer) == 0:
+            # If we didn't read anything, we just need to wait for more.
+            if readBytes == 0:
                 if QuickCam_RTSP.c_DebugLogging:
                     self.Logger.debug("RTSP read empty buffer from stdin.")
                 continue
 
-            # If there's no pending buffered data do a quick exit if we were able to read the entire buffer in our first read.
-            # If the full buffer is only one jpeg images, we don't need to do any scanning and can just return it.
-            if self.Buffer is None:
-                if self._CheckIfFullJpeg(buffer):
-                    self._ResetLocalBuffer(True)
-                    if QuickCam_RTSP.c_DebugLogging:
-                        self.Logger.debug("RTSP fast path image received.")
-                    return buffer
-
-            # Append this buffer to the current pending buffer.
-            if self.Buffer is None:
-                self.Buffer = buffer
-            else:
-                self.Buffer += buffer
-
-            # Ensure the buffer is long enough to check.
-            buffLen = len(self.Buffer)
-            if buffLen <= self.JpegStartSequenceLen:
-                continue
-
-            # Check if the buffer is a full image now
-            if self._CheckIfFullJpeg(self.Buffer):
-                img = self.Buffer
-                self._ResetLocalBuffer(True)
+            # Get the newest full frame, if there is one. If we are running behind and there are multiple, the older ones are dropped.
+            frame = self.FrameSplitter.GetNewestFrame()
+            if frame is None:
                 if QuickCam_RTSP.c_DebugLogging:
-                    self.Logger.debug("RTSP second quick path image received.")
-                return img
-
-            # Scan the buffer for the jpeg end sequence.
-            newImageStart = -1
-            while self.SearchedIndex < buffLen - self.JpegStartSequenceLen:
-                if self.Buffer[self.SearchedIndex] == self.JpegEndSequence[0] and self.Buffer[self.SearchedIndex+1] == self.JpegEndSequence[1]:
-                    newImageStart = self.SearchedIndex + 2
-                    break
-                self.SearchedIndex += 1
-
-            # See if we found a complete image.
-            if newImageStart != -1:
-                # Get the image and check it's a full image.
-                imgBuffer = self.Buffer[:newImageStart]
-                if self._CheckIfFullJpeg(imgBuffer) is False:
-                    # If we don't have a correct buffer, we got off in out counting.
-                    # So reset the buffer and continue. Note after we reset the buffer, we might
-                    # hit this, since we could have a partial image in the Buffer
-                    self._ResetLocalBuffer()
-                    if QuickCam_RTSP.c_DebugLogging:
-                        self.Logger.debug("RTSP we found a jpeg end sequence, but the buffer didn't start with a jpeg start sequence.")
-                    continue
-                # Take the image off the buffer.
-                self.Buffer = self.Buffer[newImageStart:]
-                self.SearchedIndex = 0
-                self.TimeSinceLastImg = time.time()
-                # Ensure the buffer isn't too long.
-                self._ResetLocalBufferIfOverLimit()
-                if QuickCam_RTSP.c_DebugLogging:
-                    self.Logger.debug("RTSP slow path image received.")
-                return imgBuffer
+                    self.Logger.debug("We got a new buffer with no image match.")
+                continue
 
-            # If we didn't find anything, check the limit.
+            # The frame is a view into the splitter's buffer, which is reused on the next read.
+            # Since the image is held on to by QuickCam after we return it, we need to make our own copy.
+            with frame:
+                img = bytearray(frame)
+            self.TimeSinceLastImg = time.time()
             if QuickCam_RTSP.c_DebugLogging:
-                self.Logger.debug("We got a new buffer with no image match.")
-            self._ResetLocalBufferIfOverLimit()
-
-
-    def _ResetLocalBufferIfOverLimit(self):
-        # A normal image is around 37,000, so if the buffer is too long, reset it so
-        # we can try to recover the buffer.
-        if self.Buffer is not None and len(self.Buffer) > 50000:
-            self.Logger.info("Quick cam rtsp buffer reset. This means we are running behind.")
-            self._ResetLocalBuffer()
+                self.Logger.debug(f"RTSP image received. {self.FrameSplitter.GetStats()}")
+            return img
 
 
-    def _ResetLocalBuffer(self, hasNewImage:bool = False):
-        self.SearchedIndex = 0
-        self.Buffer = None
-        if hasNewImage:
-            self.TimeSinceLastImg = time.time()
+    # Reads all of the data that's ready on the stdout pipe into the frame splitter.
+    # Returns the number of bytes read, which can be 0.
+    def _ReadIntoFrameSplitter(self) -> int:
+        # We use the raw file to read directly into the splitter's buffer, the buffered reader would copy it first.
+        raw = self.Process.stdout.raw
+        total = 0
+        while True:
+            with self.FrameSplitter.GetWriteView(QuickCam_RTSP.c_ReadSizeBytes) as view:
+                try:
+                    readBytes = raw.readinto(view)
+                except BlockingIOError:
+                    readBytes = None
+                viewLen = len(view)
+            # None means there's no data ready and 0 means the pipe is closed, either way we are done for now.
+            if readBytes is None or readBytes == 0:
+                return total
+            self.FrameSplitter.CommitWrite(readBytes)
+            total += readBytes
+            # If we didn't fill the buffer, we read everything that's ready.
+            # We also stop after a few reads, so frames are pulled out of the buffer before it grows too big. Anything left will be read on the next call.
+            if readBytes < viewLen or total >= QuickCam_RTSP.c_ReadSizeBytes * 4:
+                return total
 
 
     # Reads the error stream from ffmpeg.
@@ -812,17 +774,6 @@ class QuickCam_RTSP:
                 Sentry.Exception("RTSP error reader thread failed.", e)
 
 
-    # Checks if the buffer is only one image, from start to end.
-    def _CheckIfFullJpeg(self, buffer:bytearray) -> bool:
-        if buffer is None or len(buffer) <= self.JpegStartSequenceLen:
-            return False
-        if buffer[:self.JpegStartSequenceLen] != self.JpegStartSequence:
-            return False
-        if buffer[-2:] != self.JpegEndSequence:
-            return False
-        return True
-
-
     # Allows us to using the with: scope.
     def __enter__(self):
         return self
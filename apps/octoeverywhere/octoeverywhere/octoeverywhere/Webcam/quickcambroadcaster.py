@@ -0,0 +1,110 @@
+import logging
+import threading
+
+
+# A single slot mailbox that holds the newest frame for one QuickCam stream client.
+#
+# The capture thread posts every frame into the mailbox, which never blocks, and the client takes frames on its own thread.
+# If the client is slower than the camera, the frame in the slot is replaced by the newer one and counted as dropped.
+# This way a slow client only ever skips frames, it never holds up the capture thread or any other client.
+class QuickCamFrameMailbox:
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        self.FrameReady = threading.Event()
+        self.Frame:bytearray = None
+        self.IsClosed = False
+
+        # Stats
+        self.FramesPosted = 0
+        self.FramesTaken = 0
+        self.FramesDropped = 0
+
+
+    # Called by the capture thread with each new frame. This never blocks on the client.
+    def Post(self, img:bytearray) -> None:
+        with self.Lock:
+            if self.IsClosed:
+                return
+            # If the last frame wasn't taken yet, the client is behind and it's replaced.
+            if self.Frame is not None:
+                self.FramesDropped += 1
+            self.Frame = img
+            self.FramesPosted += 1
+            self.FrameReady.set()
+
+
+    # Called by the client to get the next frame. This blocks until a new frame is ready.
+    # Returns None if the mailbox was closed.
+    def Take(self) -> bytearray:
+        while True:
+            with self.Lock:
+                if self.IsClosed:
+                    return None
+                img = self.Frame
+                if img is not None:
+                    self.Frame = None
+                    self.FrameReady.clear()
+                    self.FramesTaken += 1
+                    return img
+            self.FrameReady.wait()
+
+
+    # Closes the mailbox, any blocked Take call will return None.
+    def Close(self) -> None:
+        with self.Lock:
+            self.IsClosed = True
+            self.Frame = None
+            self.FrameReady.set()
+
+
+    # Returns a dict of the stats.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "FramesPosted": self.FramesPosted,
+                "FramesTaken": self.FramesTaken,
+                "FramesDropped": self.FramesDropped,
+            }
+
+
+# Fans out the frames from a single QuickCam capture thread to all of the attached clients.
+#
+# Each client gets its own QuickCamFrameMailbox, so publishing a frame is just a slot swap per client.
+# The capture time stays flat no matter how many clients are attached or how slow they are.
+class QuickCamBroadcaster:
+
+    def __init__(self, logger:logging.Logger) -> None:
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        # This is replaced, never edited, so Publish can use it without taking the lock.
+        self.Mailboxes = ()
+
+
+    # Attaches a new client and returns its mailbox.
+    # Note that Detach must be called when the client is done!
+    def Attach(self) -> QuickCamFrameMailbox:
+        mailbox = QuickCamFrameMailbox()
+        with self.Lock:
+            self.Mailboxes = self.Mailboxes + (mailbox,)
+        return mailbox
+
+
+    # Detaches a client and closes its mailbox.
+    def Detach(self, mailbox:QuickCamFrameMailbox) -> None:
+        with self.Lock:
+            self.Mailboxes = tuple(m for m in self.Mailboxes if m is not mailbox)
+        mailbox.Close()
+        # Log the stats at info, so we can see how many frames slow clients are dropping.
+        self.Logger.info(f"QuickCam stream client detached. {mailbox.GetStats()}")
+
+
+    # Returns True if there are any clients attached.
+    def HasClients(self) -> bool:
+        return len(self.Mailboxes) > 0
+
+
+    # Called by the capture thread with each new frame.
+    def Publish(self, img:bytearray) -> None:
+        for mailbox in self.Mailboxes:
+            mailbox.Post(img)
@@ -1,6 +1,5 @@
 import time
 import logging
-import threading
 
 from ..octohttprequest import OctoHttpRequest
 
@@ -16,7 +15,7 @@ class WebcamStreamInstance:
         self.QuickCam = quickCam
         self.IsFirstSend = True
         self.StreamOpenTimeSec = time.time()
-        self.ImageReadyEvent = threading.Event()
+        self.Mailbox = None
         self.AwaitingImage:bytearray = None
 
 
@@ -31,8 +30,9 @@ class WebcamStreamInstance:
         if self.AwaitingImage is None:
             return None
 
-        # Note! We must be sure to call DetachImageStreamCallback to remove this stream callback!
-        self.QuickCam.AttachImageStreamCallback(self._NewImageCallback)
+        # Note! We must be sure to call DetachFrameMailbox to remove this stream from QuickCam!
+        # The mailbox always holds the newest image, so if we send slower than the camera captures, we skip images instead of falling behind.
+        self.Mailbox = self.QuickCam.AttachFrameMailbox()
 
         # We must set the content type so that the web browser knows what kind of stream to expect.
         headers = {
@@ -43,39 +43,34 @@ class WebcamStreamInstance:
         return OctoHttpRequest.Result(200, headers, WebcamStreamInstance.c_OeStreamBoundaryString, False, customBodyStreamCallback=self._CustomBodyStreamRead, customBodyStreamClosedCallback=self._CustomBodyStreamClosed)
 
 
-    # Define the callback we will get from QuickCam when there's a new image ready for us to send.
-    def _NewImageCallback(self, imgBuffer:bytearray):
-        self.AwaitingImage = imgBuffer
-        self.ImageReadyEvent.set()
-
-
     # Define a callback for our http body reading system to call when it needs data.
     def _CustomBodyStreamRead(self) -> bytearray:
-        while True:
-            # See if we can capture an image. There might already be a new image we don't even have to wait for.
-            capturedImage = self.AwaitingImage
-            if capturedImage is not None:
-                # If so, clear the awaiting image and reset the event.
-                self.AwaitingImage = None
-                self.ImageReadyEvent.clear()
-
-                # Build the buffer to send
-                header = f"--{WebcamStreamInstance.c_OeStreamBoundaryString}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(capturedImage)}\r\n\r\n"
-                imageChunkBuffer = header.encode('utf-8') + capturedImage + b"\r\n" + header.encode('utf-8') + capturedImage + b"\r\n"
-
-                # TODO - I don't know why, but chrome seems to delay the rendering of the image until it gets two?
-                # This could be something in the pipeline not flushing correctly, or other things. But for now, on the first send we double the image to make it render instantly.
-                if self.IsFirstSend:
-                    imageChunkBuffer = imageChunkBuffer + imageChunkBuffer
-                    self.IsFirstSend = False
-                    if self.Logger.isEnabledFor(logging.DEBUG):
-                        self.Logger.debug(f"QuickCam took {round(time.time()-self.StreamOpenTimeSec, 3)} seconds from octostream stream open to first image sent.")
-                return imageChunkBuffer
-            # If we didn't get an image, wait on the event for a new one.
-            self.ImageReadyEvent.wait()
+        # The first image is the snapshot we got when the stream started, after that we wait on the mailbox for the newest image.
+        capturedImage = self.AwaitingImage
+        if capturedImage is not None:
+            self.AwaitingImage = None
+        else:
+            capturedImage = self.Mailbox.Take()
+            if capturedImage is None:
+                # The mailbox was closed, so the stream is done.
+                return None
+
+        # Build the buffer to send
+        header = f"--{WebcamStreamInstance.c_OeStreamBoundaryString}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(capturedImage)}\r\n\r\n"
+        imageChunkBuffer = header.encode('utf-8') + capturedImage + b"\r\n" + header.encode('utf-8') + capturedImage + b"\r\n"
+
+        # TODO - I don't know why, but chrome seems to delay the rendering of the image until it gets two?
+        # This could be something in the pipeline not flushing correctly, or other things. But for now, on the first send we double the image to make it render instantly.
+        if self.IsFirstSend:
+            imageChunkBuffer = imageChunkBuffer + imageChunkBuffer
+            self.IsFirstSend = False
+            if self.Logger.isEnabledFor(logging.DEBUG):
+                self.Logger.debug(f"QuickCam took {round(time.time()-self.StreamOpenTimeSec, 3)} seconds from octostream stream open to first image sent.")
+        return imageChunkBuffer
 
 
     # Define a callback for when the http stream is closed.
     def _CustomBodyStreamClosed(self) -> None:
         # It's important this is called so the stream will be detached!
-        self.QuickCam.DetachImageStreamCallback(self._NewImageCallback)
+        if self.Mailbox is not None:
+            self.QuickCam.DetachFrameMailbox(self.Mailbox)
@@ -7,8 +7,10 @@ import logging
 import threading
 import subprocess
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 from .sentry import Sentry
+from .telemetry import Telemetry
 from .zstandarddictionary import ZStandardDictionary
 
 from .Proto.DataCompression import DataCompression
@@ -40,6 +42,9 @@ class CompressionContext:
 
         # Compression - can't be shared to be thread safe
         self.Compressor = None
+        # The level is picked when the compressor is rented and is used for the life of this context,
+        # since a zstandard stream must be written by the same compressor.
+        self.CompressorLevel:int = None
         self.StreamWriter = None
         self.CompressionByteBuffer:bytes = None
         # The compression is more efficient if we know the size of the data of the og data.
@@ -91,7 +96,7 @@ class CompressionContext:
         if streamWriter is not None:
             streamWriter.__exit__(exc_type, exc_value, traceback)
         if compressor is not None:
-            Compression.Get().ReturnZStandardCompressor(compressor)
+            Compression.Get().ReturnZStandardCompressor(compressor, self.CompressorLevel)
         if streamReader is not None:
             streamReader.__exit__(exc_type, exc_value, traceback)
         if decompressor is not None:
@@ -117,15 +122,17 @@ class CompressionContext:
 
 
     # Compresses the data.
+    # The level is only used for the first call, when the compressor is rented. After that the context keeps using the same level.
     # Returns a successful CompressionResult or throws
-    def Compress(self, data:bytes) -> CompressionResult:
+    def Compress(self, data:bytes, level:int) -> CompressionResult:
         # Ensure we are setup.
         startSec = time.time()
         with self.ResourceLock:
             if self.IsClosed:
                 raise Exception("The compression context is closed, we can't compress data")
             if self.Compressor is None:
-                self.Compressor = Compression.Get().RentZStandardCompressor()
+                self.CompressorLevel = level
+                self.Compressor = Compression.Get().RentZStandardCompressor(level)
                 if self.Compressor is None:
                     raise Exception("CompressionContext failed to rent a compressor")
 
@@ -234,6 +241,41 @@ class Compression:
     ZStandardPipPackageString = "zstandard>=0.21.0,<0.23.0"
     ZStandardMinCoreCountForInstall = 3
 
+    # The compression levels we pick between, depending on how busy the CPU is and what's being compressed.
+    # Level 3 is the zstandard default and what we always used before. When the CPU is busy (like when a webcam stream is being relayed)
+    # we drop to the fastest level, and when the CPU is mostly idle we spend a bit more time on text, since it compresses really well.
+    LevelFast = 1
+    LevelDefault = 3
+    LevelText = 6
+    # zlib gets much slower above 3 for very little gain, see the benchmarks at the bottom of this file.
+    ZlibMaxLevel = 3
+
+    # The fraction of the CPU that's idle, below which we use the fast level and above which we use the text level.
+    LowCpuHeadroom = 0.25
+    HighCpuHeadroom = 0.60
+    # How often we sample the CPU usage, it's only sampled when we are compressing something.
+    CpuHeadroomSampleIntervalSec = 1.0
+
+    # On devices with this many cores or less, the compression worker threads run with a lower priority,
+    # so compression doesn't take CPU time away from things like the webcam relay.
+    # The increment is added to the nice value the worker thread starts with.
+    LowPriorityMaxCoreCount = 3
+    LowPriorityNiceIncrement = 5
+
+    # Content types that are already compressed, so compressing them again only costs CPU time and makes them bigger.
+    AlreadyCompressedContentTypePrefixes = ("image/", "video/", "audio/", "font/woff")
+    AlreadyCompressedContentTypes = ("application/zip", "application/gzip", "application/x-gzip", "application/zstd", "application/x-zstd",
+                                     "application/x-bzip2", "application/x-xz", "application/x-7z-compressed", "application/x-rar-compressed",
+                                     "application/vnd.rar", "application/font-woff", "application/font-woff2", "application/x-font-woff")
+
+    # The histogram bucket upper bounds for the stats. Anything larger goes into the last "inf" bucket.
+    LatencyHistogramBucketsMs = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+    RatioHistogramBuckets = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+    # Limit how many content types we track, so odd content types can't grow the stats forever.
+    MaxStatsContentTypes = 40
+    # How often the stats are written to the log and reported to telemetry, after which they are reset.
+    StatsReportIntervalSec = 60 * 60 * 6
+
     _Instance = None
 
     @staticmethod
@@ -249,7 +291,8 @@ class Compression:
     def __init__(self, logger: logging.Logger, localFileStoragePath:str) -> None:
         self.Logger = logger
         self.LocalFileStoragePath = localFileStoragePath
-        self.ZStandardCompressorPool = []
+        # The compressor pools are keyed by compression level.
+        self.ZStandardCompressorPool = {}
         self.ZStandardCompressorPoolLock = threading.Lock()
         self.ZStandardCompressorCreatedCount = 0
 
@@ -267,6 +310,33 @@ class Compression:
         else:
             self.ZStandardThreadCount = cpuCores - 2
 
+        # The number of compressions running at once is bounded, if all of the slots are taken the caller waits for one.
+        # Before this, every web stream compressed on its own thread, so a page load could have many compressions fighting with the webcam relay.
+        # If there are 3 or less cores, we only allow one compression at a time, otherwise two.
+        self.CompressionWorkerCount = 1 if cpuCores <= 3 else 2
+        self.CompressionSlots = threading.BoundedSemaphore(self.CompressionWorkerCount)
+        # On devices with only a few cores, the compression runs on worker threads with a lower priority.
+        # The caller's thread can't be used for this, because without privileges a thread can't raise its priority back up once it's lowered.
+        # On other devices, the compression runs on the caller's thread, so there's no hand off to a worker.
+        self.CompressionExecutor = None
+        if cpuCores <= Compression.LowPriorityMaxCoreCount:
+            self.CompressionExecutor = ThreadPoolExecutor(max_workers=self.CompressionWorkerCount, thread_name_prefix="OeCompression", initializer=self._CompressionWorkerInit)
+
+        # The CPU headroom is the fraction of the CPU that was idle since the last sample.
+        # We start assuming there's headroom, until we have two samples to compare.
+        self.CpuHeadroomLock = threading.Lock()
+        self.CpuHeadroom = 1.0
+        self.CpuHeadroomSampleTimeSec = 0.0
+        self.CpuStatLastTotal = None
+        self.CpuStatLastIdle = 0
+        self.CpuStatSupported = True
+
+        # The per content type stats, see GetStats.
+        self.StatsLock = threading.Lock()
+        self.Stats = {}
+        self.StatsWaitCount = 0
+        self.StatsLastReportSec = time.time()
+
         # Always init the zstandard singleton, even if we aren't using zstandard.
         ZStandardDictionary.Init(logger)
 
@@ -286,10 +356,10 @@ class Compression:
             self.Logger.info(f"Compression is using zstandard with {self.ZStandardThreadCount} threads")
 
             # Once the state is set, make a few compressors and decompressors so they are cached and ready to go.
-            c = self.RentZStandardCompressor()
-            c2 = self.RentZStandardCompressor()
-            self.ReturnZStandardCompressor(c)
-            self.ReturnZStandardCompressor(c2)
+            c = self.RentZStandardCompressor(Compression.LevelDefault)
+            c2 = self.RentZStandardCompressor(Compression.LevelDefault)
+            self.ReturnZStandardCompressor(c, Compression.LevelDefault)
+            self.ReturnZStandardCompressor(c2, Compression.LevelDefault)
 
             d = self.RentZStandardDecompressor()
             d2 = self.RentZStandardDecompressor()
@@ -306,19 +376,234 @@ class Compression:
 
 
     # Given a buffer of data, compress it using the best available compression library.
-    def Compress(self, compressionContext:CompressionContext, data: bytes) -> CompressionResult:
+    # The content type is optional, but if it's known it's used to pick the compression level and for the stats.
+    # If the max number of compressions are already running, this waits for one to finish. This call blocks until the compression is done.
+    def Compress(self, compressionContext:CompressionContext, data: bytes, contentTypeLower:str = None) -> CompressionResult:
+        startSec = time.time()
+        level = self.GetCompressionLevel(contentTypeLower)
+
         # If we have zstandard lib, use that, since it's better.
         if self.CanUseZStandardLib:
             # If we are training, submit the data to be sampled.
             # ZStandardDictionary.Get().SubmitData(data)
-            return compressionContext.Compress(data)
+            func = compressionContext.Compress
+        else:
+            # If we can't use zStandard lib, fallback to zlib
+            func = self._CompressZlib
+            level = min(level, Compression.ZlibMaxLevel)
+
+        # Take a slot, waiting if they are all in use. Since the executor has as many workers as there are slots, work never queues in the executor.
+        waited = self.CompressionSlots.acquire(blocking=False) is False
+        if waited:
+            self.CompressionSlots.acquire()
+        try:
+            if self.CompressionExecutor is not None:
+                result = self.CompressionExecutor.submit(func, data, level).result()
+            else:
+                result = func(data, level)
+        finally:
+            self.CompressionSlots.release()
+
+        # Record the stats, the latency includes any time spent waiting for a slot or handing the work to a worker.
+        try:
+            self._RecordStats(contentTypeLower, len(data), len(result.Bytes), time.time() - startSec, waited)
+        except Exception as e:
+            Sentry.Exception("Compression failed to record stats.", e)
+        return result
 
-        # If we can't use zStandard lib, fallback to zlib
+
+    def _CompressZlib(self, data:bytes, level:int) -> CompressionResult:
         startSec = time.time()
-        compressed = zlib.compress(data, 3)
+        compressed = zlib.compress(data, level)
         return CompressionResult(compressed, time.time() - startSec, DataCompression.Zlib)
 
 
+    # Returns true if the content type is something that's already compressed, like images, video, or archives.
+    # The content type should be lower case, if it's None, we return False.
+    @staticmethod
+    def IsAlreadyCompressedContentType(contentTypeLower:str) -> bool:
+        if contentTypeLower is None:
+            return False
+        # svg is the one image type that's text.
+        if contentTypeLower.find("svg") != -1:
+            return False
+        baseType = contentTypeLower.split(";", 1)[0].strip()
+        return baseType.startswith(Compression.AlreadyCompressedContentTypePrefixes) or baseType in Compression.AlreadyCompressedContentTypes
+
+
+    # Returns true if the content type is text based, which compresses well enough that it's worth more CPU time.
+    @staticmethod
+    def IsTextContentType(contentTypeLower:str) -> bool:
+        if contentTypeLower is None:
+            return False
+        return (contentTypeLower.find("text/") != -1 or contentTypeLower.find("javascript") != -1
+                or contentTypeLower.find("json") != -1 or contentTypeLower.find("xml") != -1 or contentTypeLower.find("svg") != -1)
+
+
+    # Picks the compression level, based on the current CPU headroom and what kind of data it is.
+    def GetCompressionLevel(self, contentTypeLower:str) -> int:
+        headroom = self.GetCpuHeadroom()
+        if headroom < Compression.LowCpuHeadroom:
+            return Compression.LevelFast
+        if headroom > Compression.HighCpuHeadroom and Compression.IsTextContentType(contentTypeLower):
+            return Compression.LevelText
+        return Compression.LevelDefault
+
+
+    # Returns the fraction of the CPU that was idle since the last sample, from 0.0 to 1.0.
+    # This is sampled from /proc/stat at most once every CpuHeadroomSampleIntervalSec. If we can't read it, we assume there's headroom.
+    def GetCpuHeadroom(self) -> float:
+        now = time.time()
+        with self.CpuHeadroomLock:
+            if self.CpuStatSupported is False or now - self.CpuHeadroomSampleTimeSec < Compression.CpuHeadroomSampleIntervalSec:
+                return self.CpuHeadroom
+            self.CpuHeadroomSampleTimeSec = now
+            try:
+                # The first line is the total of all cores: cpu user nice system idle iowait irq softirq steal ...
+                with open("/proc/stat", "rb") as f:
+                    values = [int(v) for v in f.readline().split()[1:9]]
+                total = sum(values)
+                idle = values[3] + (values[4] if len(values) > 4 else 0)
+                if self.CpuStatLastTotal is not None:
+                    totalDelta = total - self.CpuStatLastTotal
+                    if totalDelta > 0:
+                        self.CpuHeadroom = min(1.0, max(0.0, (idle - self.CpuStatLastIdle) / totalDelta))
+                self.CpuStatLastTotal = total
+                self.CpuStatLastIdle = idle
+            except Exception as e:
+                # This is expected on non-linux systems, so we just stop trying.
+                self.CpuStatSupported = False
+                self.Logger.info(f"Compression can't sample the cpu usage, so we will always assume there's headroom. {e}")
+            return self.CpuHeadroom
+
+
+    # Returns a dict of the compression stats, keyed by content type.
+    # Each value has the total count and byte sizes, plus a latency histogram in ms and a compression ratio (compressed / original) histogram.
+    # The histograms are dicts of bucket upper bound -> count, the last bucket is "inf".
+    def GetStats(self) -> dict:
+        with self.StatsLock:
+            return self._GetStatsLocked()
+
+
+    # Must be called under the stats lock.
+    def _GetStatsLocked(self) -> dict:
+        ret = {}
+        for contentType, stat in self.Stats.items():
+            ret[contentType] = {
+                "Count": stat["Count"],
+                "InputBytes": stat["InputBytes"],
+                "OutputBytes": stat["OutputBytes"],
+                "LatencyMs": self._HistogramToDict(Compression.LatencyHistogramBucketsMs, stat["LatencyMs"]),
+                "Ratio": self._HistogramToDict(Compression.RatioHistogramBuckets, stat["Ratio"]),
+            }
+        return ret
+
+
+    # Writes the given stats to the log, if no stats are passed the current stats are used.
+    def LogStats(self, stats:dict = None):
+        if stats is None:
+            stats = self.GetStats()
+        for contentType, stat in stats.items():
+            ratio = 0.0
+            if stat["InputBytes"] > 0:
+                ratio = float(stat["OutputBytes"]) / float(stat["InputBytes"])
+            self.Logger.info(f"Compression stats [{contentType}] count:{stat['Count']} ratio:{format(ratio, '.2f')} latency_ms:{stat['LatencyMs']} ratios:{stat['Ratio']}")
+
+
+    # Logs the stats and sends a summary of them to telemetry, then resets them.
+    # This is called from _RecordStats once the report interval has passed.
+    def _ReportStats(self, stats:dict, waitCount:int):
+        self.LogStats(stats)
+        # Telemetry fields must be flat, so we send the totals over all content types and the histograms summed over all content types.
+        fields = {"InputBytes": 0, "OutputBytes": 0, "WaitCount": waitCount, "ContentTypes": len(stats)}
+        count = 0
+        for stat in stats.values():
+            count += stat["Count"]
+            fields["InputBytes"] += stat["InputBytes"]
+            fields["OutputBytes"] += stat["OutputBytes"]
+            for bucket, c in stat["LatencyMs"].items():
+                key = "LatencyMs_" + bucket
+                fields[key] = fields.get(key, 0) + c
+            for bucket, c in stat["Ratio"].items():
+                key = "Ratio_" + bucket
+                fields[key] = fields.get(key, 0) + c
+        if count > 0:
+            Telemetry.Write("PluginCompressionStats", count, fields)
+
+
+    def _RecordStats(self, contentTypeLower:str, inputSize:int, outputSize:int, durationSec:float, waited:bool = False):
+        key = "unknown"
+        if contentTypeLower is not None:
+            key = contentTypeLower.split(";", 1)[0].strip()
+        ratio = 1.0
+        if inputSize > 0:
+            ratio = float(outputSize) / float(inputSize)
+        with self.StatsLock:
+            stat = self.Stats.get(key, None)
+            if stat is None:
+                if len(self.Stats) >= Compression.MaxStatsContentTypes:
+                    key = "other"
+                    stat = self.Stats.get(key, None)
+                if stat is None:
+                    stat = {
+                        "Count": 0,
+                        "InputBytes": 0,
+                        "OutputBytes": 0,
+                        "LatencyMs": [0] * (len(Compression.LatencyHistogramBucketsMs) + 1),
+                        "Ratio": [0] * (len(Compression.RatioHistogramBuckets) + 1),
+                    }
+                    self.Stats[key] = stat
+            stat["Count"] += 1
+            stat["InputBytes"] += inputSize
+            stat["OutputBytes"] += outputSize
+            stat["LatencyMs"][self._GetBucketIndex(Compression.LatencyHistogramBucketsMs, durationSec * 1000.0)] += 1
+            stat["Ratio"][self._GetBucketIndex(Compression.RatioHistogramBuckets, ratio)] += 1
+            if waited:
+                self.StatsWaitCount += 1
+
+            # Check if it's time to report.
+            report = None
+            if time.time() - self.StatsLastReportSec > Compression.StatsReportIntervalSec:
+                report = self._GetStatsLocked()
+                waitCount = self.StatsWaitCount
+                self.Stats = {}
+                self.StatsWaitCount = 0
+                self.StatsLastReportSec = time.time()
+
+        # Report outside of the lock.
+        if report is not None:
+            self._ReportStats(report, waitCount)
+
+
+    @staticmethod
+    def _GetBucketIndex(buckets, value) -> int:
+        for i, upperBound in enumerate(buckets):
+            if value <= upperBound:
+                return i
+        return len(buckets)
+
+
+    @staticmethod
+    def _HistogramToDict(buckets, counts) -> dict:
+        ret = {}
+        for i, upperBound in enumerate(buckets):
+            ret[str(upperBound)] = counts[i]
+        ret["inf"] = counts[len(buckets)]
+        return ret
+
+
+    # Called on each compression worker thread when it starts, the workers are only used on devices with only a few cores.
+    def _CompressionWorkerInit(self):
+        # Lower the priority of the compression threads so they don't compete with things like the webcam relay.
+        # On linux, setpriority with a thread id only applies to that thread.
+        try:
+            if hasattr(os, "setpriority") and hasattr(threading, "get_native_id"):
+                tid = threading.get_native_id()
+                os.setpriority(os.PRIO_PROCESS, tid, os.getpriority(os.PRIO_PROCESS, tid) + Compression.LowPriorityNiceIncrement)
+        except Exception as e:
+            self.Logger.debug(f"Compression failed to lower the worker thread priority. {e}")
+
+
     # Given a buffer of data and the compression type, decompresses it.
     def Decompress(self, compressionContext:CompressionContext, data:bytes, thisMsgUncompressedDataSize:int, isLastMessage:bool, compressionType: DataCompression) -> bytes:
         # Decompress depending on what type of compression was used.
@@ -336,15 +621,16 @@ class Compression:
             raise Exception(f"Unknown compression type: {compressionType}")
 
 
-    # Returns a compressor or None if it fails to load.
+    # Returns a compressor for the given level or None if it fails to load.
     # The compressor warps the zstandard lib context, they are reusable but not thread safe.
-    def RentZStandardCompressor(self):
+    def RentZStandardCompressor(self, level:int):
         if self.CanUseZStandardLib is False:
             return None
         try:
             with self.ZStandardCompressorPoolLock:
-                if len(self.ZStandardCompressorPool) > 0:
-                    return self.ZStandardCompressorPool.pop()
+                pool = self.ZStandardCompressorPool.get(level, None)
+                if pool is not None and len(pool) > 0:
+                    return pool.pop()
 
                 # Report how many we have created for leak detection.
                 self.ZStandardCompressorCreatedCount += 1
@@ -354,18 +640,22 @@ class Compression:
                 #pylint: disable=import-outside-toplevel
                 import zstandard as zstd
                 # We must use the pre-trained dict, since the service uses it as well and it must match.
-                return zstd.ZstdCompressor(threads=self.ZStandardThreadCount, dict_data=ZStandardDictionary.Get().PreTrainedDict)
+                return zstd.ZstdCompressor(level=level, threads=self.ZStandardThreadCount, dict_data=ZStandardDictionary.Get().PreTrainedDict)
         except Exception as e:
             self.Logger.error(f"Failed to rent zstandard compressor. Error: {e}")
         return None
 
 
-    # Puts the compressor back into the pool
-    def ReturnZStandardCompressor(self, compressor):
+    # Puts the compressor back into the pool for its level
+    def ReturnZStandardCompressor(self, compressor, level:int):
         if compressor is None:
             return
         with self.ZStandardCompressorPoolLock:
-            self.ZStandardCompressorPool.append(compressor)
+            pool = self.ZStandardCompressorPool.get(level, None)
+            if pool is None:
+                pool = []
+                self.ZStandardCompressorPool[level] = pool
+            pool.append(compressor)
 
 
     # Returns a decompressor or None if it fails to load.
@@ -1,6 +1,93 @@
+import time
+import queue
 import logging
 import threading
+import ipaddress
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ClosedPoolError
+from urllib3.util.connection import is_connection_dropped
+
+
+# Holds the timing breakdown of one http request, all values are in seconds.
+# QueueWaitSec - The time spent waiting for a free connection in the pool.
+# ConnectSec - The time spent opening a new connection, this is 0 if a kept alive connection was used.
+# TtfbSec - The time from sending the request until the response headers were received, not including the two above.
+# BodySec - The time from the response headers until the response was closed, or None if it's unknown.
+class HttpRequestTiming:
+    def __init__(self) -> None:
+        self.StartSec = time.perf_counter()
+        self.QueueWaitSec = 0.0
+        self.ConnectSec = 0.0
+        self.TtfbSec = 0.0
+        self.BodySec:float = None
+
+
+# Used for local targets, this connection pool limits how many connections can be used at once, and keeps them alive to be reused.
+#
+# The frontends (Mainsail, Fluidd, OctoPrint) fire a lot of requests in parallel when they load. The default pool only keeps 10 connections,
+# and any extra connections are closed after each request, so most requests paid for a new connection.
+# This pool keeps up to the max number of connections alive, and requests over the max wait for a connection to be free.
+# Some requests, like webcam streams, hold a connection for a long time. So if we wait too long, we open an extra connection
+# rather than stalling the request. The extra connection is closed when the request is done.
+class _LocalConnectionPoolMixin:
+
+    # The max time a request will wait for a pooled connection before it uses an extra connection.
+    c_MaxQueueWaitSec = 2.0
+
+    def _get_conn(self, timeout=None):
+        conn = None
+        startSec = time.perf_counter()
+        try:
+            conn = self.pool.get(block=True, timeout=_LocalConnectionPoolMixin.c_MaxQueueWaitSec)
+        except AttributeError:
+            raise ClosedPoolError(self, "Pool is closed.") from None
+        except queue.Empty:
+            pass
+        timing = HttpSessions.GetCurrentRequestTiming()
+        if timing is not None:
+            timing.QueueWaitSec += time.perf_counter() - startSec
+
+        # If this is a kept alive connection, check if it got disconnected.
+        if conn and is_connection_dropped(conn):
+            conn.close()
+        return conn or self._new_conn()
+
+
+# Adds the connect time to the current request timing.
+class _TimedConnectMixin:
+    def connect(self):
+        startSec = time.perf_counter()
+        super().connect()
+        timing = HttpSessions.GetCurrentRequestTiming()
+        if timing is not None:
+            timing.ConnectSec += time.perf_counter() - startSec
+
+
+class _LocalHTTPConnection(_TimedConnectMixin, HTTPConnection):
+    pass
+
+
+class _LocalHTTPSConnection(_TimedConnectMixin, HTTPSConnection):
+    pass
+
+
+class _LocalHTTPConnectionPool(_LocalConnectionPoolMixin, HTTPConnectionPool):
+    ConnectionCls = _LocalHTTPConnection
+
+
+class _LocalHTTPSConnectionPool(_LocalConnectionPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _LocalHTTPSConnection
+
+
+# The requests adapter we use for local targets, see _LocalHTTPConnectionPool
+class _LocalHttpAdapter(HTTPAdapter):
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _LocalHTTPConnectionPool, "https": _LocalHTTPSConnectionPool}
 
 # A common class to cache http sessions per host.
 # This makes the connections more efficient as we can reuse the connections and the session isn't created every time.
@@ -8,9 +95,15 @@ class HttpSessions:
 
     _Instance = None
 
+    # The default max number of connections we will keep open to each local target.
+    c_DefaultMaxLocalConnectionsPerHost = 32
+
+    # Holds the timing object of the request being made on the current thread, if there is one.
+    _ThreadLocal = threading.local()
+
     @staticmethod
-    def Init(logger:logging.Logger):
-        HttpSessions._Instance = HttpSessions(logger)
+    def Init(logger:logging.Logger, maxLocalConnectionsPerHost:int = c_DefaultMaxLocalConnectionsPerHost):
+        HttpSessions._Instance = HttpSessions(logger, maxLocalConnectionsPerHost)
 
 
     @staticmethod
@@ -18,12 +111,34 @@ class HttpSessions:
         return HttpSessions._Instance
 
 
-    def __init__(self, logger:logging.Logger):
+    def __init__(self, logger:logging.Logger, maxLocalConnectionsPerHost:int):
         self.Logger = logger
+        self.MaxLocalConnectionsPerHost = max(1, maxLocalConnectionsPerHost)
         self.Sessions = {}
         self.SessionsLock = threading.Lock()
 
 
+    # Starts timing a request on the current thread, the timing object is filled in as the request is made.
+    # This only captures the queue wait and connect time for local targets, since they use our connection pool.
+    @staticmethod
+    def StartRequestTiming() -> HttpRequestTiming:
+        timing = HttpRequestTiming()
+        HttpSessions._ThreadLocal.Timing = timing
+        return timing
+
+
+    # Stops timing the request on the current thread.
+    @staticmethod
+    def EndRequestTiming() -> None:
+        HttpSessions._ThreadLocal.Timing = None
+
+
+    # Returns the timing object for the request being made on this thread, or None.
+    @staticmethod
+    def GetCurrentRequestTiming() -> HttpRequestTiming:
+        return getattr(HttpSessions._ThreadLocal, "Timing", None)
+
+
     # Returns a Session given the url or host.
     # If the url is relative, it can be passed directly.
     # If the url is absolute, the host will be extracted and used.
@@ -79,6 +194,34 @@ class HttpSessions:
             # We don't need that, so we can just set it to False. Is saves about 20ms per request.
             s.trust_env = False
 
+            # For local targets, which are the printer's own web servers or other devices on the LAN, use our pool so we keep connections alive and limit the concurrency.
+            # Loopback is by far the most common, where the web server is on the same device, in which case there's no reason to ever close the connection.
+            if host == "relative" or HttpSessions._IsLocalHost(host):
+                adapter = _LocalHttpAdapter(pool_connections=1, pool_maxsize=self.MaxLocalConnectionsPerHost)
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+
             # Set the session and return it!
             self.Sessions[host] = s
             return s
+
+
+    # Given a host in the form of protocol://hostname:port, returns True if it's a loopback, private, or link local address, or a .local hostname.
+    @staticmethod
+    def _IsLocalHost(host:str) -> bool:
+        hostname = host[host.find("://") + 3:]
+        if hostname.startswith("["):
+            # IPv6 address, like [::1]:80
+            hostname = hostname[1:hostname.find("]")]
+        else:
+            portStart = hostname.find(":")
+            if portStart != -1:
+                hostname = hostname[:portStart]
+        hostname = hostname.lower()
+        if hostname == "localhost" or hostname.endswith(".local"):
+            return True
+        try:
+            ip = ipaddress.ip_address(hostname)
+            return ip.is_loopback or ip.is_private or ip.is_link_local
+        except ValueError:
+            return False
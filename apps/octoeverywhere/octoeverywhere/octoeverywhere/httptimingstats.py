@@ -0,0 +1,78 @@
+import time
+import threading
+
+from .telemetry import Telemetry
+from .httpsessions import HttpRequestTiming
+
+# Accumulates the timing breakdown of the local http requests we make, and reports the summary to telemetry every so often.
+# This lets us see where the time goes when a frontend loads through the tunnel, waiting on our connection pool, connecting, the server, or the body.
+class HttpTimingStats:
+
+    # How often we report the stats.
+    c_ReportIntervalSec = 60 * 60 * 6
+
+    Lock = threading.Lock()
+    LastReportSec = time.time()
+    Count = 0
+    ConnectCount = 0
+    BodyCount = 0
+    QueueWaitSumSec = 0.0
+    QueueWaitMaxSec = 0.0
+    ConnectSumSec = 0.0
+    TtfbSumSec = 0.0
+    TtfbMaxSec = 0.0
+    BodySumSec = 0.0
+
+
+    # Adds a completed request's timing.
+    @staticmethod
+    def Add(timing:HttpRequestTiming) -> None:
+        report = None
+        with HttpTimingStats.Lock:
+            HttpTimingStats.Count += 1
+            HttpTimingStats.QueueWaitSumSec += timing.QueueWaitSec
+            HttpTimingStats.QueueWaitMaxSec = max(HttpTimingStats.QueueWaitMaxSec, timing.QueueWaitSec)
+            if timing.ConnectSec > 0:
+                HttpTimingStats.ConnectCount += 1
+                HttpTimingStats.ConnectSumSec += timing.ConnectSec
+            HttpTimingStats.TtfbSumSec += timing.TtfbSec
+            HttpTimingStats.TtfbMaxSec = max(HttpTimingStats.TtfbMaxSec, timing.TtfbSec)
+            # The body time is only known for bodies with a known length, since streams can be open for as long as the user is watching.
+            if timing.BodySec is not None:
+                HttpTimingStats.BodyCount += 1
+                HttpTimingStats.BodySumSec += timing.BodySec
+
+            # Check if it's time to report.
+            if time.time() - HttpTimingStats.LastReportSec > HttpTimingStats.c_ReportIntervalSec:
+                report = HttpTimingStats._BuildReportAndReset()
+
+        # Report outside of the lock.
+        if report is not None:
+            Telemetry.Write("PluginLocalHttpTiming", report["Count"], report)
+
+
+    # Must be called under lock.
+    @staticmethod
+    def _BuildReportAndReset() -> dict:
+        count = HttpTimingStats.Count
+        report = {
+            "Count": count,
+            "ConnectCount": HttpTimingStats.ConnectCount,
+            "AvgQueueWaitMs": round(HttpTimingStats.QueueWaitSumSec * 1000.0 / count, 2),
+            "MaxQueueWaitMs": round(HttpTimingStats.QueueWaitMaxSec * 1000.0, 2),
+            "AvgConnectMs": 0 if HttpTimingStats.ConnectCount == 0 else round(HttpTimingStats.ConnectSumSec * 1000.0 / HttpTimingStats.ConnectCount, 2),
+            "AvgTtfbMs": round(HttpTimingStats.TtfbSumSec * 1000.0 / count, 2),
+            "MaxTtfbMs": round(HttpTimingStats.TtfbMaxSec * 1000.0, 2),
+            "AvgBodyMs": 0 if HttpTimingStats.BodyCount == 0 else round(HttpTimingStats.BodySumSec * 1000.0 / HttpTimingStats.BodyCount, 2),
+        }
+        HttpTimingStats.LastReportSec = time.time()
+        HttpTimingStats.Count = 0
+        HttpTimingStats.ConnectCount = 0
+        HttpTimingStats.BodyCount = 0
+        HttpTimingStats.QueueWaitSumSec = 0.0
+        HttpTimingStats.QueueWaitMaxSec = 0.0
+        HttpTimingStats.ConnectSumSec = 0.0
+        HttpTimingStats.TtfbSumSec = 0.0
+        HttpTimingStats.TtfbMaxSec = 0.0
+        HttpTimingStats.BodySumSec = 0.0
+        return report
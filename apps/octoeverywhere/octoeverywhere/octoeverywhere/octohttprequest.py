@@ -1,3 +1,4 @@
+import time
 import platform
 import logging
 
@@ -6,7 +7,8 @@ import requests
 from .mdns import MDns
 from .compat import Compat
 from .localip import LocalIpHelper
-from .httpsessions import HttpSessions
+from .httpsessions import HttpSessions, HttpRequestTiming
+from .httptimingstats import HttpTimingStats
 from .octostreammsgbuilder import OctoStreamMsgBuilder
 
 from .Proto.PathTypes import PathTypes
@@ -81,7 +83,7 @@ class OctoHttpRequest:
     #                   customBodyStreamCallback() -> byteArray : Called to get more bytes. If None is returned, the stream is done.
     #                   customBodyStreamClosedCallback() -> None : MUST BE CALLED when this Result object is closed, to clean up the stream.
     class Result():
-        def __init__(self, statusCode:int, headers:dict, url:str, didFallback:bool, fullBodyBuffer=None, requestLibResponseObj:requests.Response=None, customBodyStreamCallback=None, customBodyStreamClosedCallback=None):
+        def __init__(self, statusCode:int, headers:dict, url:str, didFallback:bool, fullBodyBuffer=None, requestLibResponseObj:requests.Response=None, customBodyStreamCallback=None, customBodyStreamClosedCallback=None, timing:HttpRequestTiming=None):
             # Status code isn't a property because some things need to set it externally to the class. (Result.StatusCode = 302)
             self.StatusCode = statusCode
             self._headers = headers
@@ -94,6 +96,8 @@ class OctoHttpRequest:
             self.SetFullBodyBuffer(fullBodyBuffer)
             self._customBodyStreamCallback = customBodyStreamCallback
             self._customBodyStreamClosedCallback = customBodyStreamClosedCallback
+            # If set, this is the timing of the request that made the response, the body time is set when the result is closed.
+            self._timing = timing
             if (self._customBodyStreamCallback is not None and self._customBodyStreamClosedCallback is None) or (self._customBodyStreamCallback is None and self._customBodyStreamClosedCallback is not None):
                 raise Exception("Both the customBodyStreamCallback and customBodyStreamClosedCallback must be set!")
 
@@ -107,10 +111,10 @@ class OctoHttpRequest:
 
         # Builds a Result object from a requests.Response object.
         @staticmethod
-        def BuildFromRequestLibResponse(response:requests.Response, url:str, isFallback:bool=False) -> "OctoHttpRequest.Result":
+        def BuildFromRequestLibResponse(response:requests.Response, url:str, isFallback:bool=False, timing:HttpRequestTiming=None) -> "OctoHttpRequest.Result":
             if response is None:
                 return None
-            return OctoHttpRequest.Result(response.status_code, response.headers, url, isFallback, requestLibResponseObj=response)
+            return OctoHttpRequest.Result(response.status_code, response.headers, url, isFallback, requestLibResponseObj=response, timing=timing)
 
         @property
         def Headers(self) -> dict:
@@ -229,6 +233,13 @@ class OctoHttpRequest:
         def __exit__(self, t, v, tb):
             if self._requestLibResponseObj is not None:
                 self._requestLibResponseObj.__exit__(t, v, tb)
+                if self._timing is not None:
+                    # Only report the body time for bodies with a known length, streams can be open as long as the user is watching.
+                    if self._requestLibResponseObj.headers.get("Content-Length", None) is not None:
+                        timing = self._timing
+                        timing.BodySec = time.perf_counter() - (timing.StartSec + timing.QueueWaitSec + timing.ConnectSec + timing.TtfbSec)
+                    HttpTimingStats.Add(self._timing)
+                    self._timing = None
             if self._customBodyStreamClosedCallback is not None:
                 self._customBodyStreamClosedCallback()
 
@@ -443,6 +454,8 @@ class OctoHttpRequest:
     @staticmethod
     def MakeHttpCallAttempt(logger, attemptName, method, url, headers, data, mainResult, isFallback, nextFallbackUrl, allowRedirects:bool = False):
         response = None
+        # The timing is filled in by our connection pool as the request is made, see HttpSessions.
+        timing = HttpSessions.StartRequestTiming()
         try:
             # Try to make the http call.
             #
@@ -478,11 +491,15 @@ class OctoHttpRequest:
             except Exception as e:
                 logger.info(attemptName + " http NO HEADERS URL threw an exception: "+str(e))
 
+        # Now that we have the response headers, the rest of the time is the time to first byte.
+        HttpSessions.EndRequestTiming()
+        timing.TtfbSec = max(0.0, time.perf_counter() - timing.StartSec - timing.QueueWaitSec - timing.ConnectSec)
+
         # Check if we got a valid response.
         if response is not None and response.status_code != 404:
             # We got a valid response, we are done.
             # Return true and the result object, so it can be returned.
-            return OctoHttpRequest.AttemptResult(True, OctoHttpRequest.Result.BuildFromRequestLibResponse(response, url, isFallback))
+            return OctoHttpRequest.AttemptResult(True, OctoHttpRequest.Result.BuildFromRequestLibResponse(response, url, isFallback, timing))
 
         # Check if we have another fallback URL to try.
         if nextFallbackUrl is not None:
@@ -0,0 +1,255 @@
+import io
+import math
+import logging
+import threading
+from collections import OrderedDict
+
+from .sentry import Sentry
+from .snapshotresizeparams import SnapshotResizeParams
+
+try:
+    # On some systems this package will install but the import will fail due to a missing system .so.
+    # Since most setups don't use this package, we will import it with a try catch and if it fails we
+    # won't use it.
+    from PIL import Image
+    from PIL import ImageFile
+except Exception as _:
+    pass
+
+
+# Handles the flip, rotate, and resize of snapshots for notifications and Gadget, and caches the results.
+#
+# During a print notifications, Gadget, and the final snap all ask for snapshots, often of the same frame and with the same settings.
+# The decode, transform, and encode is the most expensive part of getting a snapshot on low power devices, so we keep the last
+# frame we saw and a few of the transformed variants of it. If the same frame is asked for with the same settings, the cached result is returned.
+#
+# When the image is being scaled down, PIL's JPEG draft mode is used, so the decoder does the scaling and the full size image is never decoded.
+class SnapshotCache:
+
+    # The max number of transformed variants we keep.
+    c_MaxVariants = 8
+
+
+    def __init__(self, logger:logging.Logger) -> None:
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        # The last raw frame we were given, and the id we gave it. The id changes every time the frame changes.
+        self.LastFrame = None
+        self.LastFrameId = 0
+        # Maps the variant key to the transformed snapshot, in least recently used to most recently used order.
+        self.Variants = OrderedDict()
+
+
+    # Returns the snapshot with the flip, rotation, and resize applied.
+    # If no work is needed or the work fails, the original snapshot is returned.
+    def GetTransformedSnapshot(self, snapshot, rotation:int, flipH:bool, flipV:bool, snapshotResizeParams:SnapshotResizeParams = None):
+        # If there's nothing to do, we don't need to do anything.
+        if rotation == 0 and flipH is False and flipV is False and snapshotResizeParams is None:
+            return snapshot
+
+        resizeKey = None
+        if snapshotResizeParams is not None:
+            resizeKey = (snapshotResizeParams.Size, snapshotResizeParams.ResizeToHeight, snapshotResizeParams.ResizeToWidth, snapshotResizeParams.CropSquareCenterNoPadding)
+        with self.Lock:
+            frameId = self._GetFrameId(snapshot)
+            key = (frameId, rotation, flipH, flipV, resizeKey)
+            result = self.Variants.get(key, None)
+            if result is not None:
+                self.Variants.move_to_end(key)
+                return result
+
+        # Do the work outside of the lock, since it can take a while.
+        result = self._Transform(snapshot, rotation, flipH, flipV, resizeKey)
+
+        with self.Lock:
+            # Only cache the result if the frame hasn't changed while we were working.
+            if frameId == self.LastFrameId:
+                self.Variants[key] = result
+                self.Variants.move_to_end(key)
+                while len(self.Variants) > SnapshotCache.c_MaxVariants:
+                    self.Variants.popitem(last=False)
+        return result
+
+
+    # Must be called under lock.
+    # Returns the id for the frame, if the frame is the same as the last frame, the id is the same.
+    def _GetFrameId(self, snapshot) -> int:
+        # QuickCam returns the same buffer object until there's a new frame, so the identity check is usually enough.
+        # Otherwise the compare is a length check and a memcmp, which is very cheap compared to a decode.
+        if snapshot is not self.LastFrame and snapshot != self.LastFrame:
+            self.LastFrame = snapshot
+            self.LastFrameId += 1
+            # The old variants can't be used anymore, since we only keep the last frame.
+            self.Variants.clear()
+        return self.LastFrameId
+
+
+    # Does the image work. On any failure, the original snapshot is returned.
+    def _Transform(self, snapshot, rotation:int, flipH:bool, flipV:bool, resizeKey):
+        try:
+            if Image is not None:
+
+                # We noticed that on some under powered or otherwise bad systems the image returned
+                # by mjpeg is truncated. We aren't sure why this happens, but setting this flag allows us to sill
+                # manipulate the image even though we didn't get the whole thing. Otherwise, we would use the raw snapshot
+                # buffer, which is still an incomplete image.
+                # Use a try catch incase the import of ImageFile failed
+                try:
+                    ImageFile.LOAD_TRUNCATED_IMAGES = True
+                except Exception as _:
+                    pass
+
+                # In pillow ~9.1.0 these constants moved.
+                # pylint: disable=no-member
+                OE_FLIP_LEFT_RIGHT = 0
+                OE_FLIP_TOP_BOTTOM = 0
+                try:
+                    OE_FLIP_LEFT_RIGHT = Image.FLIP_LEFT_RIGHT
+                    OE_FLIP_TOP_BOTTOM = Image.FLIP_TOP_BOTTOM
+                except Exception:
+                    OE_FLIP_LEFT_RIGHT = Image.Transpose.FLIP_LEFT_RIGHT
+                    OE_FLIP_TOP_BOTTOM = Image.Transpose.FLIP_TOP_BOTTOM
+                # pylint: enable=no-member
+
+                # Break out the resize args, we use locals so we don't edit the caller's params object.
+                size = 0
+                resizeToHeight = False
+                resizeToWidth = False
+                cropSquareCenterNoPadding = False
+                if resizeKey is not None:
+                    size, resizeToHeight, resizeToWidth, cropSquareCenterNoPadding = resizeKey
+
+                # Update the image
+                # Note the order of the flips and the rotates are important!
+                # If they are reordered, when multiple are applied the result will not be correct.
+                didWork = False
+                pilImage = Image.open(io.BytesIO(snapshot))
+
+                # If we are going to scale the image down, let the jpeg decoder do it. The decoder can scale by 1/2, 1/4, or 1/8
+                # while it decodes, and it will always pick a scale that's still at least as big as the size we ask for.
+                # The flips and rotation don't change the image size, so we can figure out the final size before they are applied.
+                if resizeKey is not None:
+                    draftSize = self._GetDraftSize(pilImage.width, pilImage.height, size, resizeToHeight, resizeToWidth, cropSquareCenterNoPadding)
+                    if draftSize is not None and pilImage.format == "JPEG":
+                        originalSize = pilImage.size
+                        pilImage.draft(pilImage.mode, draftSize)
+                        if pilImage.size != originalSize:
+                            didWork = True
+
+                if flipH:
+                    pilImage = pilImage.transpose(OE_FLIP_LEFT_RIGHT)
+                    didWork = True
+                if flipV:
+                    pilImage = pilImage.transpose(OE_FLIP_TOP_BOTTOM)
+                    didWork = True
+                if rotation != 0:
+                    # Our rotation is clockwise while PIL is counter clockwise.
+                    # Subtract from 360 to get the opposite rotation.
+                    rotation = 360 - rotation
+                    pilImage = pilImage.rotate(rotation)
+                    didWork = True
+
+                #
+                # Now apply any resize operations needed.
+                #
+                if resizeKey is not None:
+                    # First, if we want to scale and crop to center, we will use the resize operation to get the image
+                    # scale (preserving the aspect ratio). We will use the smallest side to scale to the desired outcome.
+                    if cropSquareCenterNoPadding:
+                        # We will only do the crop resize if the source image is smaller than or equal to the desired size.
+                        if pilImage.height >= size and pilImage.width >= size:
+                            if pilImage.height < pilImage.width:
+                                resizeToHeight = True
+                                resizeToWidth = False
+                            else:
+                                resizeToHeight = False
+                                resizeToWidth = True
+
+                    # Do any resizing required.
+                    resizeHeight = None
+                    resizeWidth = None
+                    if resizeToHeight:
+                        if pilImage.height > size:
+                            resizeHeight = size
+                            resizeWidth = int((float(size) / float(pilImage.height)) * float(pilImage.width))
+                    if resizeToWidth:
+                        if pilImage.width > size:
+                            resizeHeight = int((float(size) / float(pilImage.width)) * float(pilImage.height))
+                            resizeWidth = size
+                    # If we have things to resize, do it.
+                    if resizeHeight is not None and resizeWidth is not None:
+                        pilImage = pilImage.resize((resizeWidth, resizeHeight))
+                        didWork = True
+
+                    # Now if we want to crop square, use the resized image to crop the remaining side.
+                    if cropSquareCenterNoPadding:
+                        left = 0
+                        upper = 0
+                        right = 0
+                        lower = 0
+                        if resizeToHeight:
+                            # Crop the width - use floor to ensure if there's a remainder we float left.
+                            centerX = math.floor(float(pilImage.width) / 2.0)
+                            halfWidth = math.floor(float(size) / 2.0)
+                            upper = 0
+                            lower = size
+                            left = centerX - halfWidth
+                            right = (size - halfWidth) + centerX
+                        else:
+                            # Crop the height - use floor to ensure if there's a remainder we float left.
+                            centerY = math.floor(float(pilImage.height) / 2.0)
+                            halfHeight = math.floor(float(size) / 2.0)
+                            upper = centerY - halfHeight
+                            lower = (size - halfHeight) + centerY
+                            left = 0
+                            right = size
+
+                        # Sanity check bounds
+                        if left < 0 or left > right or right > pilImage.width or upper > 0 or upper > lower or lower > pilImage.height:
+                            self.Logger.error("Failed to crop image. height: "+str(pilImage.height)+", width: "+str(pilImage.width)+", size: "+str(size))
+                        else:
+                            pilImage = pilImage.crop((left, upper, right, lower))
+                            didWork = True
+
+                #
+                # If we did some operation, save the image buffer back to a jpeg and overwrite the
+                # current snapshot buffer. If we didn't do work, keep the original, to preserve quality.
+                #
+                if didWork:
+                    buffer = io.BytesIO()
+                    pilImage.save(buffer, format="JPEG", quality=95)
+                    snapshot = buffer.getvalue()
+                    buffer.close()
+            else:
+                self.Logger.warn("Can't manipulate image because the Image rotation lib failed to import.")
+        except Exception as e:
+            # Note that in the case of an exception we don't overwrite the original snapshot buffer, so something can still be sent.
+            if "name 'Image' is not defined" in str(e):
+                self.Logger.info("Can't manipulate image because the Image rotation lib failed to import.")
+            if "cannot identify image file" in str(e):
+                self.Logger.info("Can't manipulate image because the Image lib can't figure out the image type.")
+            else:
+                Sentry.Exception("Failed to manipulate image for notifications", e)
+        return snapshot
+
+
+    # Returns the smallest (width, height) the image can be decoded at and still be resized to the requested size, or None if no scale down is needed.
+    @staticmethod
+    def _GetDraftSize(width:int, height:int, size:int, resizeToHeight:bool, resizeToWidth:bool, cropSquareCenterNoPadding:bool):
+        if width <= 0 or height <= 0:
+            return None
+        # This matches how the resize picks the side to scale.
+        if cropSquareCenterNoPadding:
+            if height < size or width < size:
+                return None
+            side = min(width, height)
+        elif resizeToWidth:
+            side = width
+        elif resizeToHeight:
+            side = height
+        else:
+            return None
+        if side <= size:
+            return None
+        scale = float(size) / float(side)
+        return (int(math.ceil(width * scale)), int(math.ceil(height * scale)))
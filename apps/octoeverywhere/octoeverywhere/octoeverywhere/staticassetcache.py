@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from .sentry import Sentry
+from .telemetry import Telemetry
+from .compression import Compression, CompressionContext
+from .zstandarddictionary import ZStandardDictionary
+from .octohttprequest import OctoHttpRequest
+from .Proto.PathTypes import PathTypes
+
+
+# A local disk cache of the static frontend assets (the js, css, and such of Mainsail, Fluidd, OctoPrint) in their compressed form.
+#
+# Every remote load of the frontend reads the same big js and css bundles from the local web server and compresses them again, which is
+# the most expensive part of the page load on low power devices. Instead, the first time we see a static asset we compress it once and
+# store it on disk. For the following loads, we ask the web server if the asset changed with a conditional request. If the web server says
+# it didn't (a 304), the body is never read and the stored compressed body is sent straight into the web stream.
+#
+# The entries are keyed by the origin the request is sent to and the path, see GetEntryKey, so the same path on different web servers
+# never shares an entry. The compressed bodies are content addressed, so if the same file is served from more than one path, it's only stored once.
+# Since the validation is done by the web server, the cache can't serve stale content, but the cache is cleared when the UiInjector
+# detects a new frontend build, so the old files don't build up.
+class StaticAssetCache:
+
+    # Only assets with these content types are cached.
+    c_ContentTypes = ("javascript", "text/css", "text/html", "svg", "json")
+
+    # Assets smaller than this aren't worth caching, assets bigger than this are most likely not frontend assets.
+    c_MinSizeBytes = 4 * 1024
+    c_MaxSizeBytes = 20 * 1024 * 1024
+
+    # The limits of the cache, when they are hit, the least recently used assets are removed.
+    c_MaxEntries = 1000
+    c_MaxTotalSizeBytes = 100 * 1024 * 1024
+
+    # The hop by hop headers we don't store or restore.
+    c_IgnoredHeaders = ("connection", "keep-alive", "transfer-encoding", "date")
+
+    c_CacheDirName = "static-asset-cache"
+    c_IndexFileName = "index.json"
+
+    # Bumped when the index entries change, so an old index is cleared instead of used.
+    c_IndexVersion = 1
+
+    # How long after a change the index is written, so a page load that adds many assets only writes the index once.
+    c_IndexSaveDelaySec = 5.0
+
+    # How often the hit and miss stats are logged and reported to telemetry.
+    c_StatsReportIntervalSec = 60 * 60 * 6
+
+    _Instance = None
+
+
+    @staticmethod
+    def Init(logger:logging.Logger, localFileStoragePath:str):
+        StaticAssetCache._Instance = StaticAssetCache(logger, localFileStoragePath)
+
+
+    # Returns None if the cache isn't used on this platform.
+    @staticmethod
+    def Get():
+        return StaticAssetCache._Instance
+
+
+    # Returns the entry key for a request, which is the origin the request will be sent to and the path.
+    # Absolute urls already have their origin. Relative paths are sent to the local web servers, so the key includes where those are.
+    @staticmethod
+    def GetEntryKey(path:str, pathType) -> str:
+        if pathType == PathTypes.Absolute:
+            return path
+        return f"{OctoHttpRequest.GetLocalhostAddress()}:{OctoHttpRequest.GetLocalOctoPrintPort()},{OctoHttpRequest.GetLocalHttpProxyPort()}{path}"
+
+
+    def __init__(self, logger:logging.Logger, localFileStoragePath:str) -> None:
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        self.CacheDir = os.path.join(localFileStoragePath, StaticAssetCache.c_CacheDirName)
+        self.IndexFilePath = os.path.join(self.CacheDir, StaticAssetCache.c_IndexFileName)
+        # Maps the entry key to the entry dict, in least recently used to most recently used order.
+        self.Entries = OrderedDict()
+        self.TotalSizeBytes = 0
+        self.HitCount = 0
+        self.MissCount = 0
+        self.LastStatsReportSec = time.time()
+        # The index is written on a delay, see _SaveIndexUnderLock.
+        self.IndexSaveTimer = None
+        self._LoadIndex()
+
+
+    # Called before the request is made, the entry key is from GetEntryKey.
+    # If the asset is in the cache, this returns a copy of the headers with the conditional headers for the cached asset added.
+    # Otherwise the same headers are returned.
+    def AddConditionalHeadersIfCached(self, entryKey:str, method:str, headers:dict) -> dict:
+        if method != "GET" or entryKey is None:
+            return headers
+        # If the browser is making its own conditional or range request, let it through as is.
+        for key in headers:
+            keyLower = key.lower()
+            if keyLower == "if-none-match" or keyLower == "if-modified-since" or keyLower == "range":
+                return headers
+        with self.Lock:
+            entry = self.Entries.get(entryKey, None)
+            if entry is None:
+                return headers
+            etag = entry.get("ETag", None)
+            lastModified = entry.get("LastModified", None)
+        headers = headers.copy()
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if lastModified is not None:
+            headers["If-Modified-Since"] = lastModified
+        return headers
+
+
+    # Called after the request is made. addedConditionalHeaders must be True if AddConditionalHeadersIfCached returned new headers.
+    # If the web server reported the cached asset is still valid, the result is updated to be a 200 with the cached compressed body.
+    # If the result is a cacheable asset, the body is read, compressed, and stored, and the result is updated to use the compressed body.
+    # Returns True if the result is now using a compressed body.
+    def UpdateResult(self, entryKey:str, method:str, addedConditionalHeaders:bool, octoHttpResult:OctoHttpRequest.Result) -> bool:
+        if method != "GET" or entryKey is None or octoHttpResult is None or octoHttpResult.ResponseForBodyRead is None:
+            return False
+        try:
+            # If we added the conditional headers and the web server says it's not modified, use the cached body.
+            if octoHttpResult.StatusCode == 304:
+                if addedConditionalHeaders:
+                    return self._TryToUseCachedBody(entryKey, octoHttpResult)
+                return False
+            if octoHttpResult.StatusCode == 200:
+                return self._TryToCacheBody(entryKey, octoHttpResult)
+        except Exception as e:
+            Sentry.Exception("StaticAssetCache failed to update result.", e)
+        finally:
+            self._ReportStatsIfNeeded()
+        return False
+
+
+    # Clears the entire cache.
+    def Invalidate(self, reason:str) -> None:
+        with self.Lock:
+            self.Logger.info(f"StaticAssetCache is being cleared, {len(self.Entries)} assets. Reason: {reason}")
+            self.Entries.clear()
+            self.TotalSizeBytes = 0
+            try:
+                if os.path.exists(self.CacheDir):
+                    shutil.rmtree(self.CacheDir)
+            except Exception as e:
+                Sentry.Exception("StaticAssetCache failed to delete the cache dir.", e)
+
+
+    # Every so often, logs the hit and miss stats and reports them to telemetry, then starts the counts over.
+    def _ReportStatsIfNeeded(self) -> None:
+        with self.Lock:
+            if time.time() - self.LastStatsReportSec < StaticAssetCache.c_StatsReportIntervalSec:
+                return
+            report = {
+                "Hits": self.HitCount,
+                "Misses": self.MissCount,
+                "Entries": len(self.Entries),
+                "TotalSizeBytes": self.TotalSizeBytes,
+            }
+            self.HitCount = 0
+            self.MissCount = 0
+            self.LastStatsReportSec = time.time()
+        # Report outside of the lock.
+        self.Logger.info(f"StaticAssetCache stats; hits: {report['Hits']}, misses: {report['Misses']}, assets: {report['Entries']}, size: {report['TotalSizeBytes']} bytes")
+        Telemetry.Write("PluginStaticAssetCache", report["Hits"], report)
+
+
+    def _TryToUseCachedBody(self, entryKey:str, octoHttpResult:OctoHttpRequest.Result) -> bool:
+        with self.Lock:
+            entry = self.Entries.get(entryKey, None)
+            if entry is not None:
+                self.Entries.move_to_end(entryKey)
+        if entry is None:
+            return False
+        # If a different web server answered than the one the asset was cached from, like the fallback port, the body can't be used.
+        if entry.get("Url", None) != octoHttpResult.Url:
+            return False
+        buffer = self._ReadBlob(entry["Hash"], entry["CompressionType"])
+        if buffer is None:
+            # The blob is gone, so we can't use it. The 304 will be returned to the browser as it is, which it will handle.
+            self._RemoveEntry(entryKey)
+            return False
+
+        # Restore the headers of the original 200, on top of the headers from the 304.
+        resultHeaders = octoHttpResult.Headers
+        for key, value in entry["Headers"].items():
+            resultHeaders[key] = value
+        octoHttpResult.StatusCode = 200
+        octoHttpResult.SetFullBodyBuffer(buffer, entry["CompressionType"], entry["Size"])
+        with self.Lock:
+            self.HitCount += 1
+        return True
+
+
+    def _TryToCacheBody(self, entryKey:str, octoHttpResult:OctoHttpRequest.Result) -> bool:
+        # Only cache static assets, which we know because they have a cache validator, a known length, and a content type we want.
+        etag = None
+        lastModified = None
+        contentLength = None
+        contentTypeLower = None
+        storedHeaders = {}
+        for key, value in octoHttpResult.Headers.items():
+            keyLower = key.lower()
+            if keyLower == "etag":
+                etag = value
+            elif keyLower == "last-modified":
+                lastModified = value
+            elif keyLower == "content-length":
+                contentLength = int(value)
+            elif keyLower == "content-type":
+                contentTypeLower = value.lower()
+            elif keyLower == "content-encoding" or keyLower == "set-cookie" or keyLower == "content-range":
+                return False
+            elif keyLower == "cache-control" and ("no-store" in value or "private" in value):
+                return False
+            if keyLower not in StaticAssetCache.c_IgnoredHeaders:
+                storedHeaders[key] = value
+        if etag is None and lastModified is None:
+            return False
+        if contentLength is None or contentLength < StaticAssetCache.c_MinSizeBytes or contentLength > StaticAssetCache.c_MaxSizeBytes:
+            return False
+        if contentTypeLower is None or not any(t in contentTypeLower for t in StaticAssetCache.c_ContentTypes):
+            return False
+
+        # Read the full body and compress it once, the same way Slipstream does.
+        octoHttpResult.ReadAllContentFromStreamResponse(self.Logger)
+        buffer = octoHttpResult.FullBodyBuffer
+        if buffer is None or len(buffer) != contentLength:
+            # If we didn't read the full body, we can't cache it, but the read body is still sent.
+            return False
+        with CompressionContext(self.Logger) as compressionContext:
+            compressionContext.SetTotalCompressedSizeOfData(contentLength)
+            compressResult = Compression.Get().Compress(compressionContext, buffer, contentTypeLower)
+        octoHttpResult.SetFullBodyBuffer(compressResult.Bytes, compressResult.CompressionType, contentLength)
+
+        # Store it. If this fails, the result is still good to use.
+        contentHash = hashlib.sha1(buffer).hexdigest()
+        self._AddEntry(entryKey, {
+            "Url": octoHttpResult.Url,
+            "Hash": contentHash,
+            "CompressionType": int(compressResult.CompressionType),
+            "Size": contentLength,
+            "CompressedSize": len(compressResult.Bytes),
+            "ETag": etag,
+            "LastModified": lastModified,
+            "Headers": storedHeaders,
+        }, compressResult.Bytes)
+        return True
+
+
+    def _AddEntry(self, entryKey:str, entry:dict, compressedBody) -> None:
+        try:
+            # The blob is written before taking the lock, so a large write doesn't hold up the other requests.
+            # Blobs are named by their content hash, so if two requests write the same one, they write the same bytes.
+            os.makedirs(self.CacheDir, exist_ok=True)
+            blobPath = self._GetBlobPath(entry["Hash"], entry["CompressionType"])
+            if os.path.exists(blobPath) is False:
+                # Write to a temp file and then move it, so a partially written blob is never used.
+                # The temp file is per thread, so two requests writing the same blob don't write into the same file.
+                tempPath = f"{blobPath}.{threading.get_ident()}.tmp"
+                with open(tempPath, "wb") as f:
+                    f.write(compressedBody)
+                os.replace(tempPath, blobPath)
+            with self.Lock:
+                self.MissCount += 1
+                # The blob might have been removed by an eviction or a clear since we wrote it, if so, don't add an entry without a blob.
+                if os.path.exists(blobPath) is False:
+                    return
+                self._RemoveEntryUnderLock(entryKey)
+                self.Entries[entryKey] = entry
+                self.TotalSizeBytes += entry["CompressedSize"]
+                while len(self.Entries) > StaticAssetCache.c_MaxEntries or self.TotalSizeBytes > StaticAssetCache.c_MaxTotalSizeBytes:
+                    self._RemoveEntryUnderLock(next(iter(self.Entries)))
+                self._SaveIndexUnderLock()
+        except Exception as e:
+            Sentry.Exception("StaticAssetCache failed to add an entry.", e)
+
+
+    def _RemoveEntry(self, entryKey:str) -> None:
+        with self.Lock:
+            self._RemoveEntryUnderLock(entryKey)
+            self._SaveIndexUnderLock()
+
+
+    # Must be called under lock.
+    # Removes the entry, and the blob if no other entry is using it.
+    def _RemoveEntryUnderLock(self, entryKey:str) -> None:
+        entry = self.Entries.pop(entryKey, None)
+        if entry is None:
+            return
+        self.TotalSizeBytes -= entry["CompressedSize"]
+        for other in self.Entries.values():
+            if other["Hash"] == entry["Hash"] and other["CompressionType"] == entry["CompressionType"]:
+                return
+        try:
+            os.remove(self._GetBlobPath(entry["Hash"], entry["CompressionType"]))
+        except Exception:
+            pass
+
+
+    def _ReadBlob(self, contentHash:str, compressionType:int):
+        try:
+            with open(self._GetBlobPath(contentHash, compressionType), "rb") as f:
+                return f.read()
+        except Exception as e:
+            self.Logger.warn(f"StaticAssetCache failed to read a cached asset. {e}")
+        return None
+
+
+    def _GetBlobPath(self, contentHash:str, compressionType:int) -> str:
+        return os.path.join(self.CacheDir, f"{contentHash}.{compressionType}")
+
+
+    # The compressed bodies are only valid for the compression setup they were made with.
+    # The zstandard bodies are compressed with our pre-trained dict, so if it changes, they can't be used.
+    @staticmethod
+    def _GetCompressionFormatId() -> str:
+        if Compression.Get().CanUseZStandardLib and ZStandardDictionary.Get().PreTrainedDict is not None:
+            return f"zstd-{ZStandardDictionary.Get().PreTrainedDict.dict_id()}"
+        return "zlib"
+
+
+    # Must be called under lock.
+    # The index isn't written right away, a save is scheduled so a burst of changes only writes the index once.
+    def _SaveIndexUnderLock(self) -> None:
+        if self.IndexSaveTimer is not None:
+            return
+        self.IndexSaveTimer = threading.Timer(StaticAssetCache.c_IndexSaveDelaySec, self._WriteIndex)
+        self.IndexSaveTimer.daemon = True
+        self.IndexSaveTimer.start()
+
+
+    # Writes the index now, on the save timer thread.
+    # It's written under the lock, so it always matches the blobs on disk.
+    def _WriteIndex(self) -> None:
+        try:
+            with self.Lock:
+                self.IndexSaveTimer = None
+                # If the cache was cleared, there's nothing to write.
+                if os.path.exists(self.CacheDir) is False:
+                    return
+                data = {
+                    "Version": StaticAssetCache.c_IndexVersion,
+                    "FormatId": StaticAssetCache._GetCompressionFormatId(),
+                    # The entries are stored as a list to keep the least recently used order.
+                    "Entries": [[entryKey, entry] for entryKey, entry in self.Entries.items()],
+                }
+                tempPath = self.IndexFilePath + ".tmp"
+                with open(tempPath, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tempPath, self.IndexFilePath)
+        except Exception as e:
+            Sentry.Exception("StaticAssetCache failed to save the index.", e)
+
+
+    def _LoadIndex(self) -> None:
+        try:
+            if os.path.exists(self.IndexFilePath) is False:
+                return
+            with open(self.IndexFilePath, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("Version", None) != StaticAssetCache.c_IndexVersion:
+                self.Invalidate("the index version changed")
+                return
+            if data.get("FormatId", None) != StaticAssetCache._GetCompressionFormatId():
+                self.Invalidate("the compression format changed")
+                return
+            for entryKey, entry in data.get("Entries", []):
+                self.Entries[entryKey] = entry
+                self.TotalSizeBytes += entry["CompressedSize"]
+            self.Logger.info(f"StaticAssetCache loaded {len(self.Entries)} cached assets, {self.TotalSizeBytes} bytes.")
+        except Exception as e:
+            self.Logger.warn(f"StaticAssetCache failed to load the index, the cache will be cleared. {e}")
+            self.Invalidate("the index failed to load")
@@ -664,6 +664,42 @@ stepcompress_extract_old(struct stepcompress *sc, struct pull_history_steps *p
     return res;
 }
 
+// Return history of queue_step commands in a clock range (oldest first).
+// The number of commands in the range is returned - if that is larger
+// than 'max' then nothing is stored and the caller should retry with
+// a larger buffer.
+int __visible
+stepcompress_extract_range(struct stepcompress *sc
+                           , struct pull_history_steps *p, int max
+                           , uint64_t start_clock, uint64_t end_clock)
+{
+    int count = 0;
+    struct history_steps *hs;
+    list_for_each_entry(hs, &sc->history_list, node) {
+        if (start_clock >= hs->last_clock)
+            break;
+        if (end_clock > hs->first_clock)
+            count++;
+    }
+    if (count > max)
+        return count;
+    p += count;
+    list_for_each_entry(hs, &sc->history_list, node) {
+        if (start_clock >= hs->last_clock)
+            break;
+        if (end_clock <= hs->first_clock)
+            continue;
+        p--;
+        p->first_clock = hs->first_clock;
+        p->last_clock = hs->last_clock;
+        p->start_position = hs->start_position;
+        p->step_count = hs->step_count;
+        p->interval = hs->interval;
+        p->add = hs->add;
+    }
+    return count;
+}
+
 
 /****************************************************************
  * Step compress synchronization
@@ -254,3 +254,42 @@ trapq_extract_old(struct trapq *tq, struct pull_move *p, int max
     }
     return res;
 }
+
+// Return history of movement queue in a time range (oldest first).  The
+// number of moves in the range is returned - if that is larger than
+// 'max' then nothing is stored and the caller should retry with a
+// larger buffer.
+int __visible
+trapq_extract_range(struct trapq *tq, struct pull_move *p, int max
+                    , double start_time, double end_time)
+{
+    int count = 0;
+    struct move *m;
+    list_for_each_entry(m, &tq->history, node) {
+        if (start_time >= m->print_time + m->move_t)
+            break;
+        if (end_time > m->print_time)
+            count++;
+    }
+    if (count > max)
+        return count;
+    p += count;
+    list_for_each_entry(m, &tq->history, node) {
+        if (start_time >= m->print_time + m->move_t)
+            break;
+        if (end_time <= m->print_time)
+            continue;
+        p--;
+        p->print_time = m->print_time;
+        p->move_t = m->move_t;
+        p->start_v = m->start_v;
+        p->accel = 2. * m->half_accel;
+        p->start_x = m->start_pos.x;
+        p->start_y = m->start_pos.y;
+        p->start_z = m->start_pos.z;
+        p->x_r = m->axes_r.x;
+        p->y_r = m->axes_r.y;
+        p->z_r = m->axes_r.z;
+    }
+    return count;
+}
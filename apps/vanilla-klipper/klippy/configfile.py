@@ -472,6 +472,10 @@ class PrinterConfig:
         self.deprecate_warnings = []
         self.status_raw_config = {}
         self.status_warnings = []
+        self.query_status = printer.lookup_object('query_status')
+        self.query_status.register_change_tracking('configfile')
+    def _note_status_change(self):
+        self.query_status.note_status_change('configfile')
     def get_printer(self):
         return self.printer
     def read_config(self, filename):
@@ -495,12 +499,14 @@ class PrinterConfig:
         self.printer.set_rollover_info("config", "\n".join(lines))
     def check_unused_options(self, config):
         self.validate.check_unused(config.fileconfig)
+        self._note_status_change()
     # Deprecation warnings
     def runtime_warning(self, msg):
         logging.warning(msg)
         res = {'type': 'runtime_warning', 'message': msg}
         self.runtime_warnings.append(res)
         self.status_warnings = self.runtime_warnings + self.deprecate_warnings
+        self._note_status_change()
     def deprecate(self, section, option, value=None, msg=None):
         key = (section, option, value)
         if key in self.deprecated and self.deprecated[key] == msg:
@@ -517,6 +523,7 @@ class PrinterConfig:
             res['option'] = option
             self.deprecate_warnings.append(res)
         self.status_warnings = self.runtime_warnings + self.deprecate_warnings
+        self._note_status_change()
     # Status reporting
     def _build_status_config(self, config):
         self.status_raw_config = {}
@@ -524,6 +531,7 @@ class PrinterConfig:
             self.status_raw_config[section.get_name()] = section_status = {}
             for option in section.get_prefix_options(''):
                 section_status[option] = section.get(option, note_valid=False)
+        self._note_status_change()
     def get_status(self, eventtime):
         status = {'config': self.status_raw_config,
                   'warnings': self.status_warnings}
@@ -533,5 +541,7 @@ class PrinterConfig:
     # Autosave functions
     def set(self, section, option, value):
         self.autosave.set(section, option, value)
+        self._note_status_change()
     def remove_section(self, section):
         self.autosave.remove_section(section)
+        self._note_status_change()
@@ -3,7 +3,8 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, multiprocessing, os
+import logging, time, collections, multiprocessing, os, sys
+import array, bisect, struct
 from . import bus, bulk_sensor
 
 # ADXL345 registers
@@ -30,6 +31,83 @@ SCALE_Z  = 0.003906 * FREEFALL_ACCEL # 1 / 256 (at 3.3V) mg/LSB
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# Binary capture file: a header followed by the sample times (as
+# little-endian doubles) and then the x, y, and z columns (as
+# little-endian floats, which is more than the sensor resolution)
+ACCEL_FILE_TYPES = "dfff"
+ACCEL_FILE_MAGIC = b"KACL"
+ACCEL_FILE_VERSION = 1
+ACCEL_FILE_HEADER = struct.Struct("<4sHHI")
+ACCEL_FILE_FORMATS = ("csv", "bin")
+
+# Columnar storage of accelerometer samples
+class AccelSampleColumns:
+    def __init__(self, times=None, accel_x=None, accel_y=None, accel_z=None):
+        self.times = times if times is not None else array.array('d')
+        self.accel_x = accel_x if accel_x is not None else array.array('d')
+        self.accel_y = accel_y if accel_y is not None else array.array('d')
+        self.accel_z = accel_z if accel_z is not None else array.array('d')
+    def __len__(self):
+        return len(self.times)
+    def get_columns(self):
+        return self.times, self.accel_x, self.accel_y, self.accel_z
+    def add_samples(self, samples):
+        if not samples:
+            return
+        times, accel_x, accel_y, accel_z = zip(*samples)
+        self.times.extend(times)
+        self.accel_x.extend(accel_x)
+        self.accel_y.extend(accel_y)
+        self.accel_z.extend(accel_z)
+    def select_range(self, start_time, end_time):
+        # Samples are stored in time order
+        times = self.times
+        start = bisect.bisect_left(times, start_time)
+        end = bisect.bisect_right(times, end_time, start)
+        if not start and end == len(times):
+            return self
+        return AccelSampleColumns(*[c[start:end] for c in self.get_columns()])
+    def get_measurements(self):
+        return list(map(Accel_Measurement, *self.get_columns()))
+    def write_binary(self, f):
+        f.write(ACCEL_FILE_HEADER.pack(ACCEL_FILE_MAGIC, ACCEL_FILE_VERSION,
+                                       0, len(self)))
+        for typecode, column in zip(ACCEL_FILE_TYPES, self.get_columns()):
+            if column.typecode != typecode or sys.byteorder != 'little':
+                column = array.array(typecode, column)
+                if sys.byteorder != 'little':
+                    column.byteswap()
+            column.tofile(f)
+    def write_csv(self, f):
+        f.write("#time,accel_x,accel_y,accel_z\n")
+        for t, accel_x, accel_y, accel_z in zip(*self.get_columns()):
+            f.write("%.6f,%.6f,%.6f,%.6f\n" % (t, accel_x, accel_y, accel_z))
+
+# Read a capture written by AccelQueryHelper.write_to_file()
+def read_accel_file(filename):
+    if not filename.endswith(".bin"):
+        columns = AccelSampleColumns()
+        with open(filename, "r") as f:
+            columns.add_samples([tuple(map(float, line.split(',')))
+                                 for line in f if not line.startswith('#')])
+        return columns
+    with open(filename, "rb") as f:
+        magic, version, flags, count = ACCEL_FILE_HEADER.unpack(
+            f.read(ACCEL_FILE_HEADER.size))
+        if magic != ACCEL_FILE_MAGIC or version != ACCEL_FILE_VERSION:
+            raise ValueError("Unknown accelerometer capture format in '%s'"
+                             % (filename,))
+        columns = []
+        for typecode in ACCEL_FILE_TYPES:
+            column = array.array(typecode)
+            column.fromfile(f, count)
+            if sys.byteorder != 'little':
+                column.byteswap()
+            if typecode != 'd':
+                column = array.array('d', column)
+            columns.append(column)
+    return AccelSampleColumns(*columns)
+
 # Helper class to obtain measurements
 class AccelQueryHelper:
     def __init__(self, printer):
@@ -37,7 +115,8 @@ class AccelQueryHelper:
         self.is_finished = False
         print_time = printer.lookup_object('toolhead').get_last_move_time()
         self.request_start_time = self.request_end_time = print_time
-        self.msgs = []
+        self.batches = 0
+        self.columns = AccelSampleColumns()
         self.samples = []
     def finish_measurements(self):
         toolhead = self.printer.lookup_object('toolhead')
@@ -47,58 +126,39 @@ class AccelQueryHelper:
     def handle_batch(self, msg):
         if self.is_finished:
             return False
-        if len(self.msgs) >= 10000:
+        if self.batches >= 10000:
             # Avoid filling up memory with too many samples
             return False
-        self.msgs.append(msg)
+        self.batches += 1
+        self.columns.add_samples(msg['data'])
         return True
+    def _select_requested(self):
+        return self.columns.select_range(self.request_start_time,
+                                         self.request_end_time)
+    def get_columns(self):
+        return self._select_requested().get_columns()
     def has_valid_samples(self):
-        for msg in self.msgs:
-            data = msg['data']
-            first_sample_time = data[0][0]
-            last_sample_time = data[-1][0]
-            if (first_sample_time > self.request_end_time
-                    or last_sample_time < self.request_start_time):
-                continue
-            # The time intervals [first_sample_time, last_sample_time]
-            # and [request_start_time, request_end_time] have non-zero
-            # intersection. It is still theoretically possible that none
-            # of the samples from msgs fall into the time interval
-            # [request_start_time, request_end_time] if it is too narrow
-            # or on very heavy data losses. In practice, that interval
-            # is at least 1 second, so this possibility is negligible.
-            return True
-        return False
+        times = self.columns.times
+        pos = bisect.bisect_left(times, self.request_start_time)
+        return pos < len(times) and times[pos] <= self.request_end_time
     def get_samples(self):
-        if not self.msgs:
-            return self.samples
-        total = sum([len(m['data']) for m in self.msgs])
-        count = 0
-        self.samples = samples = [None] * total
-        for msg in self.msgs:
-            for samp_time, x, y, z in msg['data']:
-                if samp_time < self.request_start_time:
-                    continue
-                if samp_time > self.request_end_time:
-                    break
-                samples[count] = Accel_Measurement(samp_time, x, y, z)
-                count += 1
-        del samples[count:]
+        if self.batches:
+            self.samples = self._select_requested().get_measurements()
         return self.samples
     def write_to_file(self, filename):
+        columns = self._select_requested()
         def write_impl():
             try:
                 # Try to re-nice writing process
                 os.nice(20)
             except:
                 pass
-            f = open(filename, "w")
-            f.write("#time,accel_x,accel_y,accel_z\n")
-            samples = self.samples or self.get_samples()
-            for t, accel_x, accel_y, accel_z in samples:
-                f.write("%.6f,%.6f,%.6f,%.6f\n" % (
-                    t, accel_x, accel_y, accel_z))
-            f.close()
+            if filename.endswith(".bin"):
+                with open(filename, "wb") as f:
+                    columns.write_binary(f)
+            else:
+                with open(filename, "w") as f:
+                    columns.write_csv(f)
         write_proc = multiprocessing.Process(target=write_impl)
         write_proc.daemon = True
         write_proc.start()
@@ -142,14 +202,18 @@ class AccelCommandHelper:
         name = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
         if not name.replace('-', '').replace('_', '').isalnum():
             raise gcmd.error("Invalid NAME parameter")
+        file_format = gcmd.get("FORMAT", "csv").lower()
+        if file_format not in ACCEL_FILE_FORMATS:
+            raise gcmd.error("Invalid FORMAT parameter")
         bg_client = self.bg_client
         self.bg_client = None
         bg_client.finish_measurements()
         # Write data to file
         if self.base_name == self.name:
-            filename = "/tmp/%s-%s.csv" % (self.base_name, name)
+            filename = "/tmp/%s-%s.%s" % (self.base_name, name, file_format)
         else:
-            filename = "/tmp/%s-%s-%s.csv" % (self.base_name, self.name, name)
+            filename = "/tmp/%s-%s-%s.%s" % (self.base_name, self.name, name,
+                                             file_format)
         bg_client.write_to_file(filename)
         gcmd.respond_info("Writing raw accelerometer data to %s file"
                           % (filename,))
@@ -158,12 +222,11 @@ class AccelCommandHelper:
         aclient = self.chip.start_internal_client()
         self.printer.lookup_object('toolhead').dwell(1.)
         aclient.finish_measurements()
-        values = aclient.get_samples()
-        if not values:
+        times, accel_x, accel_y, accel_z = aclient.get_columns()
+        if not times:
             raise gcmd.error("No accelerometer measurements found")
-        _, accel_x, accel_y, accel_z = values[-1]
         gcmd.respond_info("accelerometer values (x, y, z): %.6f, %.6f, %.6f"
-                          % (accel_x, accel_y, accel_z))
+                          % (accel_x[-1], accel_y[-1], accel_z[-1]))
     cmd_ACCELEROMETER_DEBUG_READ_help = "Query register (for debugging)"
     def cmd_ACCELEROMETER_DEBUG_READ(self, gcmd):
         reg = gcmd.get("REG", minval=0, maxval=126, parser=lambda x: int(x, 0))
@@ -1272,38 +1272,50 @@ class MoveSplitter:
         self.z_factor = factor
         self.z_offset = self._calc_z_offset(prev_pos)
         self.traverse_complete = False
-        self.distance_checked = 0.
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        self._build_check_points()
     def _calc_z_offset(self, pos):
         z = self.z_mesh.calc_z(pos[0], pos[1])
         offset = self.fade_offset
         return self.z_factor * (z - offset) + offset
-    def _set_next_move(self, distance_from_prev):
-        t = distance_from_prev / self.total_move_length
-        if t > 1. or t < 0.:
-            raise self.gcode.error(
-                "bed_mesh: Slice distance is negative "
-                "or greater than entire move length")
-        for i in range(4):
-            if self.axis_move[i]:
-                self.current_pos[i] = lerp(
-                    t, self.prev_pos[i], self.next_pos[i])
+    def _build_check_points(self):
+        # Evaluate the mesh at every check distance along the move at once
+        self.check_positions = positions = []
+        self.check_offsets = []
+        self.check_index = 0
+        if not (self.axis_move[0] or self.axis_move[1]):
+            return
+        prev_pos = self.prev_pos
+        next_pos = self.next_pos
+        moving = [i for i in range(4) if self.axis_move[i]]
+        check_distance = self.move_check_distance
+        total_move_length = self.total_move_length
+        distance_checked = 0.
+        while distance_checked + check_distance < total_move_length:
+            distance_checked += check_distance
+            t = distance_checked / total_move_length
+            pos = list(prev_pos)
+            for i in moving:
+                pos[i] = lerp(t, prev_pos[i], next_pos[i])
+            positions.append(pos)
+        z_values = self.z_mesh.calc_z_many(positions)
+        factor = self.z_factor
+        offset = self.fade_offset
+        self.check_offsets = [factor * (z - offset) + offset
+                              for z in z_values]
     def split(self):
         if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
-                # X and/or Y axis move, traverse if necessary
-                while self.distance_checked + self.move_check_distance \
-                        < self.total_move_length:
-                    self.distance_checked += self.move_check_distance
-                    self._set_next_move(self.distance_checked)
-                    next_z = self._calc_z_offset(self.current_pos)
-                    if abs(next_z - self.z_offset) >= self.split_delta_z:
-                        self.z_offset = next_z
-                        return self.current_pos[0], self.current_pos[1], \
-                            self.current_pos[2] + self.z_offset, \
-                            self.current_pos[3]
+            check_offsets = self.check_offsets
+            while self.check_index < len(check_offsets):
+                next_z = check_offsets[self.check_index]
+                self.check_index += 1
+                if abs(next_z - self.z_offset) >= self.split_delta_z:
+                    self.z_offset = next_z
+                    pos = self.check_positions[self.check_index - 1]
+                    self.current_pos[:] = pos
+                    return pos[0], pos[1], pos[2] + next_z, pos[3]
             # end of move reached
             self.current_pos[:] = self.next_pos
             self.z_offset = self._calc_z_offset(self.current_pos)
@@ -1321,6 +1333,7 @@ class ZMesh:
     def __init__(self, params, name):
         self.profile_name = name or "adaptive-%X" % (id(self),)
         self.probed_matrix = self.mesh_matrix = None
+        self.cell_coeffs = None
         self.mesh_params = params
         self.mesh_offsets = [0., 0.]
         logging.debug('bed_mesh: probe/mesh parameters:')
@@ -1404,6 +1417,7 @@ class ZMesh:
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
         self._sample(z_matrix)
+        self._build_cell_coeffs()
         self.print_mesh(logging.debug)
     def set_zero_reference(self, xpos, ypos):
         offset = self.calc_z(xpos, ypos)
@@ -1415,6 +1429,7 @@ class ZMesh:
             for yidx in range(len(matrix)):
                 for xidx in range(len(matrix[yidx])):
                     matrix[yidx][xidx] -= offset
+        self._build_cell_coeffs()
     def set_mesh_offsets(self, offsets):
         for i, o in enumerate(offsets):
             if o is not None:
@@ -1423,17 +1438,71 @@ class ZMesh:
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
+    def _build_cell_coeffs(self):
+        # Store the bilinear interpolation of each mesh cell as the
+        # coefficients of z = a + b*tx + c*ty + d*tx*ty in one flat list
+        tbl = self.mesh_matrix
+        if tbl is None:
+            self.cell_coeffs = None
+            return
+        coeffs = []
+        for yidx in range(self.mesh_y_count - 1):
+            row0 = tbl[yidx]
+            row1 = tbl[yidx + 1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00 = row0[xidx]
+                z10 = row0[xidx + 1]
+                z01 = row1[xidx]
+                z11 = row1[xidx + 1]
+                coeffs.extend((z00, z10 - z00, z01 - z00,
+                               z11 - z10 - z01 + z00))
+        self.cell_coeffs = coeffs
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
-            ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
+        if self.cell_coeffs is not None:
+            return self.calc_z_many(((x, y),))[0]
         else:
             # No mesh table generated, no z-adjustment
             return 0.
+    def calc_z_many(self, positions):
+        # Return the mesh z for each (x, y, ...) position in the sequence
+        coeffs = self.cell_coeffs
+        if coeffs is None:
+            return [0.] * len(positions)
+        x_min = self.mesh_x_min - self.mesh_offsets[0]
+        y_min = self.mesh_y_min - self.mesh_offsets[1]
+        x_dist = self.mesh_x_dist
+        y_dist = self.mesh_y_dist
+        x_max_idx = self.mesh_x_count - 2
+        y_max_idx = self.mesh_y_count - 2
+        row_len = (x_max_idx + 1) * 4
+        res = []
+        for pos in positions:
+            tx = (pos[0] - x_min) / x_dist
+            xidx = int(math.floor(tx))
+            if xidx < 0:
+                xidx = 0
+            elif xidx > x_max_idx:
+                xidx = x_max_idx
+            tx -= xidx
+            if tx < 0.:
+                tx = 0.
+            elif tx > 1.:
+                tx = 1.
+            ty = (pos[1] - y_min) / y_dist
+            yidx = int(math.floor(ty))
+            if yidx < 0:
+                yidx = 0
+            elif yidx > y_max_idx:
+                yidx = y_max_idx
+            ty -= yidx
+            if ty < 0.:
+                ty = 0.
+            elif ty > 1.:
+                ty = 1.
+            i = yidx * row_len + xidx * 4
+            res.append(coeffs[i] + coeffs[i+1] * tx
+                       + (coeffs[i+2] + coeffs[i+3] * tx) * ty)
+        return res
     def get_z_range(self):
         if self.mesh_matrix is not None:
             mesh_min = min([min(x) for x in self.mesh_matrix])
@@ -1451,24 +1520,6 @@ class ZMesh:
             return round(avg_z, 2)
         else:
             return 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
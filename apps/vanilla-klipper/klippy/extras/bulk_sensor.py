@@ -3,7 +3,7 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, struct
+import logging, threading, struct, array, itertools, sys
 
 # This "bulk sensor" module facilitates the processing of sensor chip
 # measurements that do not require the host to respond with low
@@ -36,6 +36,7 @@ class BatchBulkHelper:
         self.batch_timer = None
         self.client_cbs = []
         self.webhooks_start_resp = {}
+        self.binary_encoder = None
     # Periodic batch processing
     def _start(self):
         if self.is_started:
@@ -91,25 +92,90 @@ class BatchBulkHelper:
         self._start()
     # Webhooks registration
     def _add_api_client(self, web_request):
-        whbatch = BatchWebhooksClient(web_request)
+        data_format = web_request.get_str('data_format', 'json')
+        if data_format not in ('json', 'binary'):
+            raise web_request.error("Invalid data_format '%s'"
+                                    % (data_format,))
+        start_resp = self.webhooks_start_resp
+        encoder = None
+        if data_format == 'binary':
+            encoder = self.binary_encoder
+            start_resp = dict(start_resp, data_format=data_format)
+        whbatch = BatchWebhooksClient(web_request, encoder)
         self.add_client(whbatch.handle_batch)
-        web_request.send(self.webhooks_start_resp)
-    def add_mux_endpoint(self, path, key, value, webhooks_start_resp):
+        web_request.send(start_resp)
+    def add_mux_endpoint(self, path, key, value, webhooks_start_resp,
+                         binary_typecode='d'):
         self.webhooks_start_resp = webhooks_start_resp
+        self.binary_encoder = BatchBinaryEncoder(binary_typecode)
         wh = self.printer.lookup_object('webhooks')
         wh.register_mux_endpoint(path, key, value, self._add_api_client)
 
+def _flatten_row(row):
+    res = []
+    for v in row:
+        if type(v) in (tuple, list):
+            res.extend(v)
+        else:
+            res.append(v)
+    return res
+
+# Packs the 'data' rows of a batch into a little-endian array for
+# clients that subscribed with data_format=binary.  The rest of the
+# batch is sent as the json header of the frame, with a 'data_format'
+# entry describing the array in place of 'data'.
+class BatchBinaryEncoder:
+    def __init__(self, typecode):
+        self.typecode = typecode
+        kind = 'f' if typecode in 'fd' else 'u' if typecode.isupper() else 'i'
+        self.data_type = "<%s%d" % (kind, array.array(typecode).itemsize)
+        self.last_msg = self.last_result = None
+    def encode(self, msg):
+        # All binary clients of an endpoint receive the same batch
+        if msg is self.last_msg or self.typecode is None:
+            return self.last_result
+        rows = msg.get('data', [])
+        if rows and any([type(v) in (tuple, list) for v in rows[0]]):
+            # Flatten nested values (eg, trapq positions)
+            rows = [_flatten_row(row) for row in rows]
+        try:
+            values = array.array(self.typecode,
+                                 itertools.chain.from_iterable(rows))
+        except (TypeError, OverflowError):
+            # Clients fall back to receiving the batches as json
+            logging.exception("Unable to encode binary batch")
+            self.typecode = self.last_result = None
+            return None
+        if sys.byteorder != 'little':
+            values.byteswap()
+        params = dict(msg)
+        params.pop('data', None)
+        params['data_format'] = {
+            'type': self.data_type,
+            'shape': [len(rows), len(rows[0]) if rows else 0]}
+        self.last_msg = msg
+        self.last_result = (params, values.tobytes())
+        return self.last_result
+
 # A webhooks wrapper for use by BatchBulkHelper
 class BatchWebhooksClient:
-    def __init__(self, web_request):
+    def __init__(self, web_request, binary_encoder=None):
         self.cconn = web_request.get_client_connection()
         self.template = web_request.get_dict('response_template', {})
+        self.binary_encoder = binary_encoder
     def handle_batch(self, msg):
         if self.cconn.is_closed():
             return False
         tmp = dict(self.template)
-        tmp['params'] = msg
-        self.cconn.send(tmp)
+        encoded = None
+        if self.binary_encoder is not None:
+            encoded = self.binary_encoder.encode(msg)
+        if encoded is None:
+            tmp['params'] = msg
+            self.cconn.send(tmp)
+            return True
+        tmp['params'], payload = encoded
+        self.cconn.send_binary(tmp, payload)
         return True
 
 # Helper class to store incoming messages in a queue
@@ -8,7 +8,8 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math
 
-# Coordinates created by this are converted into G1 commands.
+# Coordinates created by this are submitted to gcode_move as a batch of
+# moves (equivalent to a series of G1 commands).
 #
 # supports XY, XZ & YZ planes with remaining axis as helical
 
@@ -23,12 +24,18 @@ Y_AXIS = 1
 Z_AXIS = 2
 E_AXIS = 3
 
+# Number of segments between exact (trig based) position corrections
+ARC_CORRECTION = 25
+
 
 class ArcSupport:
 
     def __init__(self, config):
         self.printer = config.get_printer()
         self.mm_per_arc_segment = config.getfloat('resolution', 1., above=0.0)
+        # Optional chord error tolerance - allows longer segments on large
+        # radius arcs while staying within the tolerance of the true arc
+        self.tolerance = config.getfloat('tolerance', 0., minval=0.)
 
         self.gcode_move = self.printer.load_object(config, 'gcode_move')
         self.gcode = self.printer.lookup_object('gcode')
@@ -104,6 +111,37 @@ class ArcSupport:
     def planArc(self, currentPos, targetPos, offset, clockwise,
                 gcmd, absolut_extrude,
                 alpha_axis, beta_axis, helical_axis):
+        coords = self._plan_arc_coords(currentPos, targetPos, offset,
+                                       clockwise, alpha_axis, beta_axis,
+                                       helical_axis)
+        segments = len(coords)
+
+        asE = gcmd.get_float("E", None)
+        asF = gcmd.get_float("F", None)
+
+        e_per_move = e_base = 0.
+        if asE is not None:
+            if absolut_extrude:
+                e_base = currentPos[3]
+            e_per_move = (asE - e_base) / segments
+
+        # Build [x, y, z, e] positions (as the G1 parameters would be)
+        positions = []
+        for c in coords:
+            e = None
+            if e_per_move:
+                e = e_base + e_per_move
+                if absolut_extrude:
+                    e_base += e_per_move
+            positions.append((c[0], c[1], c[2], e))
+        try:
+            self.gcode_move.move_batch(positions, asF)
+        except self.printer.command_error as e:
+            raise gcmd.error("%s in '%s'" % (str(e), gcmd.get_commandline()))
+
+    # Returns the [x, y, z] end point of every segment of the arc
+    def _plan_arc_coords(self, currentPos, targetPos, offset, clockwise,
+                         alpha_axis, beta_axis, helical_axis):
         # todo: sometimes produces full circles
 
         # Radius vector from center to current location
@@ -137,47 +175,43 @@ class ArcSupport:
             mm_of_travel = math.hypot(flat_mm, linear_travel)
         else:
             mm_of_travel = math.fabs(flat_mm)
-        segments = max(1., math.floor(mm_of_travel / self.mm_per_arc_segment))
-
-        # Generate coordinates
+        mm_per_arc_segment = self.mm_per_arc_segment
+        tolerance = self.tolerance
+        if tolerance and radius > tolerance:
+            # Longest chord that deviates from the arc by at most tolerance
+            chord = 2. * math.sqrt(tolerance * (2. * radius - tolerance))
+            mm_per_arc_segment = max(mm_per_arc_segment, chord)
+        segments = max(1., math.floor(mm_of_travel / mm_per_arc_segment))
+
+        # Generate coordinates - the radius vector is rotated by a fixed
+        # step each segment (a complex multiply) instead of calling the
+        # trig functions per segment, with an exact correction every
+        # ARC_CORRECTION segments to avoid accumulating rounding errors
+        count = int(segments)
         theta_per_segment = angular_travel / segments
         linear_per_segment = linear_travel / segments
-
-        asE = gcmd.get_float("E", None)
-        asF = gcmd.get_float("F", None)
-
-        e_per_move = e_base = 0.
-        if asE is not None:
-            if absolut_extrude:
-                e_base = currentPos[3]
-            e_per_move = (asE - e_base) / segments
-
-        for i in range(1, int(segments) + 1):
-            dist_Helical = i * linear_per_segment
-            c_theta = i * theta_per_segment
-            cos_Ti = math.cos(c_theta)
-            sin_Ti = math.sin(c_theta)
-            r_P = -offset[0] * cos_Ti + offset[1] * sin_Ti
-            r_Q = -offset[0] * sin_Ti - offset[1] * cos_Ti
-
-            c = [None, None, None]
-            c[alpha_axis] = center_P + r_P
-            c[beta_axis] = center_Q + r_Q
-            c[helical_axis] = currentPos[helical_axis] + dist_Helical
-
-
-            if i == segments:
-                c = targetPos
-            # Convert coords into G1 commands
-            g1_params = {'X': c[0], 'Y': c[1], 'Z': c[2]}
-            if e_per_move:
-                g1_params['E'] = e_base + e_per_move
-                if absolut_extrude:
-                    e_base += e_per_move
-            if asF is not None:
-                g1_params['F'] = asF
-            g1_gcmd = self.gcode.create_gcode_command("G1", "G1", g1_params)
-            self.gcode_move.cmd_G1(g1_gcmd)
+        r_start = complex(r_P, r_Q)
+        step = complex(math.cos(theta_per_segment),
+                       math.sin(theta_per_segment))
+        center = complex(center_P, center_Q)
+        helical_start = currentPos[helical_axis]
+        cos, sin = math.cos, math.sin
+        coords = []
+        r = r_start
+        for i in range(1, count):
+            if i % ARC_CORRECTION:
+                r *= step
+            else:
+                c_theta = i * theta_per_segment
+                r = r_start * complex(cos(c_theta), sin(c_theta))
+            p = center + r
+            c = [0., 0., 0.]
+            c[alpha_axis] = p.real
+            c[beta_axis] = p.imag
+            c[helical_axis] = helical_start + i * linear_per_segment
+            coords.append(c)
+        coords.append(list(targetPos))
+        return coords
 
 def load_config(config):
     return ArcSupport(config)
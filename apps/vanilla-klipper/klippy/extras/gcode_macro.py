@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import traceback, logging, ast, copy, json
+import traceback, logging, ast, copy, json, hashlib, time
 import jinja2
 
 
@@ -11,6 +11,79 @@ import jinja2
 # Template handling
 ######################################################################
 
+# Copy of a get_status() result that only copies the values that are used.
+# Each value is copied on first access (nested dicts are wrapped one
+# level at a time) so templates may modify the result without altering
+# printer state, while untouched parts of large status dicts (eg,
+# configfile settings or bed_mesh profiles) are never copied.
+_IMMUTABLE_TYPES = (str, int, float, bool, type(None))
+
+class LazyStatusCopy(dict):
+    def __init__(self, status):
+        dict.__init__(self, status)
+        self._pending = set(self.keys())
+    def _materialize(self, key):
+        val = dict.__getitem__(self, key)
+        self._pending.discard(key)
+        if isinstance(val, dict):
+            val = LazyStatusCopy(val)
+        elif not isinstance(val, _IMMUTABLE_TYPES):
+            val = copy.deepcopy(val)
+        else:
+            return val
+        dict.__setitem__(self, key, val)
+        return val
+    def _materialize_all(self):
+        for key in list(self._pending):
+            self._materialize(key)
+    def __getitem__(self, key):
+        if key in self._pending:
+            return self._materialize(key)
+        return dict.__getitem__(self, key)
+    def __setitem__(self, key, val):
+        self._pending.discard(key)
+        dict.__setitem__(self, key, val)
+    def __delitem__(self, key):
+        self._pending.discard(key)
+        dict.__delitem__(self, key)
+    def __iter__(self):
+        # Not inheriting dict iteration makes dict(x) and {**x} use
+        # __getitem__ (and thus receive copies)
+        return iter(list(dict.keys(self)))
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+    def get(self, key, default=None):
+        if key in self._pending:
+            return self._materialize(key)
+        return dict.get(self, key, default)
+    def setdefault(self, key, default=None):
+        if key in self._pending:
+            return self._materialize(key)
+        return dict.setdefault(self, key, default)
+    def pop(self, key, *args):
+        if key in self._pending:
+            self._materialize(key)
+        return dict.pop(self, key, *args)
+    def popitem(self):
+        self._materialize_all()
+        return dict.popitem(self)
+    def values(self):
+        self._materialize_all()
+        return dict.values(self)
+    def items(self):
+        self._materialize_all()
+        return dict.items(self)
+    def copy(self):
+        self._materialize_all()
+        return dict(self)
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        self._pending.difference_update(other.keys())
+        dict.update(self, other)
+    def clear(self):
+        self._pending.clear()
+        dict.clear(self)
+
 # Wrapper for access to printer object get_status() methods
 class GetStatusWrapper:
     def __init__(self, printer, eventtime=None):
@@ -26,7 +99,7 @@ class GetStatusWrapper:
             raise KeyError(val)
         if self.eventtime is None:
             self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        self.cache[sval] = res = LazyStatusCopy(po.get_status(self.eventtime))
         return res
     def __contains__(self, val):
         try:
@@ -48,7 +121,7 @@ class TemplateWrapper:
         gcode_macro = self.printer.lookup_object('gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
         try:
-            self.template = env.from_string(script)
+            self.template = gcode_macro.compile_template(env, name, script)
         except jinja2.exceptions.TemplateSyntaxError as e:
             lines = script.splitlines()
             msg = "Error loading template '%s'\nline %s: %s # %s" % (
@@ -73,11 +146,69 @@ class TemplateWrapper:
     def run_gcode_from_command(self, context=None):
         self.gcode.run_script_from_command(self.render(context))
 
+# Template loader that looks up templates by the hash of their source, so
+# that compiled templates in the bytecode cache are keyed by macro source
+class TemplateSourceLoader(jinja2.BaseLoader):
+    def __init__(self):
+        self.sources = {}
+    def add_source(self, script):
+        name = hashlib.sha1(script.encode()).hexdigest()
+        self.sources[name] = script
+        return name
+    def get_source(self, environment, template):
+        if template not in self.sources:
+            raise jinja2.TemplateNotFound(template)
+        return self.sources[template], None, (lambda: True)
+
+# On-disk cache of compiled templates (survives RESTART)
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    def __init__(self):
+        jinja2.FileSystemBytecodeCache.__init__(self)
+        self.hits = self.misses = 0
+    def load_bytecode(self, bucket):
+        jinja2.FileSystemBytecodeCache.load_bytecode(self, bucket)
+        if bucket.code is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+
 # Main gcode macro template tracking
 class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
-        self.env = jinja2.Environment('{%', '%}', '{', '}')
+        self.loader = TemplateSourceLoader()
+        self.bytecode_cache = None
+        try:
+            self.bytecode_cache = TemplateBytecodeCache()
+        except Exception:
+            logging.exception("Unable to create template bytecode cache")
+        self.env = jinja2.Environment('{%', '%}', '{', '}',
+                                      loader=self.loader,
+                                      bytecode_cache=self.bytecode_cache,
+                                      auto_reload=False)
+        self.template_times = {}
+        self.printer.register_event_handler("klippy:connect",
+                                            self._handle_connect)
+    def _handle_connect(self):
+        # Report template compile times from config load
+        times = sorted(self.template_times.items(), key=(lambda i: i[1]),
+                       reverse=True)
+        cache_info = "no bytecode cache"
+        bcc = self.bytecode_cache
+        if bcc is not None:
+            cache_info = "bytecode cache hits=%d misses=%d" % (
+                bcc.hits, bcc.misses)
+        logging.info("Compiled %d templates in %.3fs (%s) slowest: %s",
+                     len(times), sum([t for n, t in times]), cache_info,
+                     " ".join(["%s=%.4f" % (n, t) for n, t in times[:10]]))
+    def compile_template(self, env, name, script):
+        starttime = time.perf_counter()
+        if env is self.env:
+            template = env.get_template(self.loader.add_source(script))
+        else:
+            template = env.from_string(script)
+        self.template_times[name] = time.perf_counter() - starttime
+        return template
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
@@ -48,12 +48,14 @@ class GCodeMove:
         # G-Code state
         self.saved_states = {}
         self.move_transform = self.move_with_transform = None
+        self.move_batch_with_transform = None
         self.position_with_transform = (lambda: [0., 0., 0., 0.])
     def _handle_ready(self):
         self.is_printer_ready = True
         if self.move_transform is None:
             toolhead = self.printer.lookup_object('toolhead')
             self.move_with_transform = toolhead.move
+            self.move_batch_with_transform = toolhead.move_batch
             self.position_with_transform = toolhead.get_position
         self.reset_last_position()
     def _handle_shutdown(self):
@@ -84,6 +86,8 @@ class GCodeMove:
             old_transform = self.printer.lookup_object('toolhead', None)
         self.move_transform = transform
         self.move_with_transform = transform.move
+        # Transforms may optionally provide a move_batch(positions, speed)
+        self.move_batch_with_transform = getattr(transform, 'move_batch', None)
         self.position_with_transform = transform.get_position
         return old_transform
     def _get_gcode_position(self):
@@ -141,6 +145,37 @@ class GCodeMove:
             raise gcmd.error("Unable to parse move '%s'"
                              % (gcmd.get_commandline(),))
         self.move_with_transform(self.last_position, self.speed)
+    def move_batch(self, positions, gcode_speed=None):
+        # Equivalent of a G1 for each [x, y, z, e] position, for moves
+        # generated internally (eg, arcs).  The x, y, z values are absolute
+        # g-code coordinates and e follows the current extrude mode (None
+        # for no extrusion).  The optional speed is a g-code F value.
+        if gcode_speed is not None:
+            if gcode_speed <= 0.:
+                raise self.printer.command_error("Invalid speed")
+            self.speed = gcode_speed * self.speed_factor
+        bx, by, bz, be = self.base_position
+        extrude_factor = self.extrude_factor
+        relative_e = not self.absolute_coord or not self.absolute_extrude
+        last_e = self.last_position[3]
+        newpos = []
+        for x, y, z, e in positions:
+            if e is not None:
+                if relative_e:
+                    last_e += e * extrude_factor
+                else:
+                    last_e = e * extrude_factor + be
+            newpos.append([x + bx, y + by, z + bz, last_e])
+        if not newpos:
+            return
+        self.last_position = list(newpos[-1])
+        move_batch = self.move_batch_with_transform
+        if move_batch is not None:
+            move_batch(newpos, self.speed)
+        else:
+            move = self.move_with_transform
+            for pos in newpos:
+                move(pos, self.speed)
     # G-Code coordinate manipulation
     def cmd_G20(self, gcmd):
         # Set units to inches
@@ -3,34 +3,72 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, functools
 import chelper
 from . import bulk_sensor
 
+CTYPE_TYPECODES = {'double': 'd', 'int': 'i', 'int64_t': 'q', 'uint64_t': 'Q'}
+
+# Contiguous buffer filled by the chelper *_extract_range() functions.
+# A time window of history is copied out with one call (oldest entry
+# first) and its fields can be read as strided memoryviews without
+# creating a python object per entry.  The whole buffer is also
+# available as a memoryview (eg, for numpy.frombuffer()).
+class HistoryBuffer:
+    def __init__(self, ctype, size=128):
+        self.ffi_main, ffi_lib = chelper.get_ffi()
+        self.ctype = ctype
+        self.itemsize = self.ffi_main.sizeof(ctype)
+        self.fields = dict(self.ffi_main.typeof(ctype).fields)
+        self.data = self.ffi_main.new(ctype + '[]', size)
+        self.count = 0
+    def extract(self, fill_func, start, end):
+        # fill_func(data, max, start, end) returns the number of entries
+        # in the window - it stores nothing if they don't all fit
+        while 1:
+            count = fill_func(self.data, len(self.data), start, end)
+            if count <= len(self.data):
+                self.count = count
+                return count
+            self.data = self.ffi_main.new(self.ctype + '[]',
+                                          max(count, 2 * len(self.data)))
+    def __len__(self):
+        return self.count
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("history index out of range")
+        return self.data[index]
+    def get_memoryview(self):
+        return memoryview(self.ffi_main.buffer(self.data,
+                                               self.count * self.itemsize))
+    def get_column(self, name):
+        field = self.fields[name]
+        typecode = CTYPE_TYPECODES[field.type.cname]
+        size = self.ffi_main.sizeof(field.type)
+        if field.offset % size or self.itemsize % size:
+            raise ValueError("Unaligned history field '%s'" % (name,))
+        mv = self.get_memoryview().cast(typecode)
+        return mv[field.offset // size::self.itemsize // size]
+
 # Extract stepper queue_step messages
 class DumpStepper:
     def __init__(self, printer, mcu_stepper):
         self.printer = printer
         self.mcu_stepper = mcu_stepper
         self.last_batch_clock = 0
+        self.history = HistoryBuffer('struct pull_history_steps')
         self.batch_bulk = bulk_sensor.BatchBulkHelper(printer,
                                                       self._process_batch)
         api_resp = {'header': ('interval', 'count', 'add')}
         self.batch_bulk.add_mux_endpoint("motion_report/dump_stepper", "name",
-                                         mcu_stepper.get_name(), api_resp)
+                                         mcu_stepper.get_name(), api_resp,
+                                         binary_typecode='q')
     def get_step_queue(self, start_clock, end_clock):
-        mcu_stepper = self.mcu_stepper
-        res = []
-        while 1:
-            data, count = mcu_stepper.dump_steps(128, start_clock, end_clock)
-            if not count:
-                break
-            res.append((data, count))
-            if count < len(data):
-                break
-            end_clock = data[count-1].first_clock
-        res.reverse()
-        return ([d[i] for d, cnt in res for i in range(cnt-1, -1, -1)], res)
+        hb = HistoryBuffer('struct pull_history_steps')
+        hb.extract(self.mcu_stepper.dump_steps_range, start_clock, end_clock)
+        return (list(hb), hb)
     def log_steps(self, data):
         if not data:
             return
@@ -44,19 +82,21 @@ class DumpStepper:
                           s.step_count, s.add))
         logging.info('\n'.join(out))
     def _process_batch(self, eventtime):
-        data, cdata = self.get_step_queue(self.last_batch_clock, 1<<63)
-        if not data:
+        hb = self.history
+        if not hb.extract(self.mcu_stepper.dump_steps_range,
+                          self.last_batch_clock, 1<<63):
             return {}
         clock_to_print_time = self.mcu_stepper.get_mcu().clock_to_print_time
-        first = data[0]
+        first = hb[0]
         first_clock = first.first_clock
         first_time = clock_to_print_time(first_clock)
-        self.last_batch_clock = last_clock = data[-1].last_clock
+        self.last_batch_clock = last_clock = hb[-1].last_clock
         last_time = clock_to_print_time(last_clock)
         mcu_pos = first.start_position
         start_position = self.mcu_stepper.mcu_to_commanded_position(mcu_pos)
         step_dist = self.mcu_stepper.get_step_dist()
-        d = [(s.interval, s.step_count, s.add) for s in data]
+        col = hb.get_column
+        d = list(zip(col('interval'), col('step_count'), col('add')))
         return {"data": d, "start_position": start_position,
                 "start_mcu_position": mcu_pos, "step_distance": step_dist,
                 "first_clock": first_clock, "first_step_time": first_time,
@@ -71,6 +111,10 @@ class DumpTrapQ:
         self.name = name
         self.trapq = trapq
         self.last_batch_msg = (0., 0.)
+        ffi_main, ffi_lib = chelper.get_ffi()
+        self.extract_range = functools.partial(ffi_lib.trapq_extract_range,
+                                               trapq)
+        self.history = HistoryBuffer('struct pull_move')
         self.batch_bulk = bulk_sensor.BatchBulkHelper(printer,
                                                       self._process_batch)
         api_resp = {'header': ('time', 'duration', 'start_velocity',
@@ -78,20 +122,9 @@ class DumpTrapQ:
         self.batch_bulk.add_mux_endpoint("motion_report/dump_trapq",
                                          "name", name, api_resp)
     def extract_trapq(self, start_time, end_time):
-        ffi_main, ffi_lib = chelper.get_ffi()
-        res = []
-        while 1:
-            data = ffi_main.new('struct pull_move[128]')
-            count = ffi_lib.trapq_extract_old(self.trapq, data, len(data),
-                                              start_time, end_time)
-            if not count:
-                break
-            res.append((data, count))
-            if count < len(data):
-                break
-            end_time = data[count-1].print_time
-        res.reverse()
-        return ([d[i] for d, cnt in res for i in range(cnt-1, -1, -1)], res)
+        hb = HistoryBuffer('struct pull_move')
+        hb.extract(self.extract_range, start_time, end_time)
+        return (list(hb), hb)
     def log_trapq(self, data):
         if not data:
             return
@@ -117,10 +150,13 @@ class DumpTrapQ:
         return pos, velocity
     def _process_batch(self, eventtime):
         qtime = self.last_batch_msg[0] + min(self.last_batch_msg[1], 0.100)
-        data, cdata = self.extract_trapq(qtime, NEVER_TIME)
-        d = [(m.print_time, m.move_t, m.start_v, m.accel,
-              (m.start_x, m.start_y, m.start_z), (m.x_r, m.y_r, m.z_r))
-             for m in data]
+        hb = self.history
+        hb.extract(self.extract_range, qtime, NEVER_TIME)
+        col = hb.get_column
+        start_pos = zip(col('start_x'), col('start_y'), col('start_z'))
+        axes_r = zip(col('x_r'), col('y_r'), col('z_r'))
+        d = list(zip(col('print_time'), col('move_t'), col('start_v'),
+                     col('accel'), start_pos, axes_r))
         if d and d[0] == self.last_batch_msg:
             d.pop(0)
         if not d:
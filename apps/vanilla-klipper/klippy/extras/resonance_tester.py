@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging, math, os, time
-from . import shaper_calibrate
+from . import adxl345, shaper_calibrate
 
 class TestAxis:
     def __init__(self, axis=None, vib_dir=None):
@@ -229,7 +229,7 @@ class ResonanceTester:
                 for chip_axis, chip_name in self.accel_chip_names]
 
     def _run_test(self, gcmd, axes, helper, raw_name_suffix=None,
-                  accel_chips=None, test_point=None):
+                  accel_chips=None, test_point=None, raw_format="csv"):
         toolhead = self.printer.lookup_object('toolhead')
         calibration_data = {axis: None for axis in axes}
 
@@ -268,7 +268,8 @@ class ResonanceTester:
                         raw_name = self.get_filename(
                                 'raw_data', raw_name_suffix, axis,
                                 point if len(test_points) > 1 else None,
-                                chip_name if accel_chips is not None else None,)
+                                chip_name if accel_chips is not None else None,
+                                ext=raw_format)
                         aclient.write_to_file(raw_name)
                         gcmd.respond_info(
                                 "Writing raw accelerometer data to "
@@ -326,6 +327,9 @@ class ResonanceTester:
             raise gcmd.error("Invalid NAME parameter")
         csv_output = 'resonances' in outputs
         raw_output = 'raw_data' in outputs
+        raw_format = gcmd.get("RAW_FORMAT", "csv").lower()
+        if raw_format not in adxl345.ACCEL_FILE_FORMATS:
+            raise gcmd.error("Unsupported RAW_FORMAT '%s'" % (raw_format,))
 
         # Setup calculation of resonances
         if csv_output:
@@ -336,7 +340,8 @@ class ResonanceTester:
         data = self._run_test(
                 gcmd, [axis], helper,
                 raw_name_suffix=name_suffix if raw_output else None,
-                accel_chips=accel_chips, test_point=test_point)[axis]
+                accel_chips=accel_chips, test_point=test_point,
+                raw_format=raw_format)[axis]
         if csv_output:
             csv_name = self.save_calibration_data(
                     'resonances', name_suffix, helper, axis, data,
@@ -431,7 +436,7 @@ class ResonanceTester:
         return name_suffix.replace('-', '').replace('_', '').isalnum()
 
     def get_filename(self, base, name_suffix, axis=None,
-                     point=None, chip_name=None):
+                     point=None, chip_name=None, ext="csv"):
         name = base
         if axis:
             name += '_' + axis.get_name()
@@ -440,7 +445,7 @@ class ResonanceTester:
         if point:
             name += "_%.3f_%.3f_%.3f" % (point[0], point[1], point[2])
         name += '_' + name_suffix
-        return os.path.join("/tmp", name + ".csv")
+        return os.path.join("/tmp", name + "." + ext)
 
     def save_calibration_data(self, base_name, name_suffix, shaper_calibrate,
                               axis, calibration_data,
@@ -15,6 +15,14 @@ TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
 
 AUTOTUNE_SHAPERS = ['zv', 'mzv', 'ei', '2hump_ei', '3hump_ei']
 
+# Just some empirically chosen value which produces good projections
+# for max_accel without much smoothing
+TARGET_SMOOTHING = 0.12
+
+# Limit on the number of elements in the intermediate arrays of the
+# vectorized shaper fitting (keeps memory use of each fit process low)
+MAX_FIT_ELEMENTS = 1 << 18
+
 ######################################################################
 # Frequency response calculation and shaper auto-tuning
 ######################################################################
@@ -72,40 +80,64 @@ class ShaperCalibrate:
                     "docs/Measuring_Resonances.md for more details).")
 
     def background_process_exec(self, method, args):
+        return self.background_process_exec_all(method, [args])[0]
+
+    def background_process_exec_all(self, method, args_list):
+        # Run method(*args) for each entry of args_list, each in its own
+        # process (at most one per cpu at a time), and return the results
         if self.printer is None:
-            return method(*args)
+            return [method(*args) for args in args_list]
         import queuelogger
-        parent_conn, child_conn = multiprocessing.Pipe()
-        def wrapper():
-            queuelogger.clear_bg_logging()
-            try:
-                res = method(*args)
-            except:
-                child_conn.send((True, traceback.format_exc()))
+        def start_process(args):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            def wrapper():
+                queuelogger.clear_bg_logging()
+                try:
+                    res = method(*args)
+                except:
+                    child_conn.send((True, traceback.format_exc()))
+                    child_conn.close()
+                    return
+                child_conn.send((False, res))
                 child_conn.close()
-                return
-            child_conn.send((False, res))
-            child_conn.close()
-        # Start a process to perform the calculation
-        calc_proc = multiprocessing.Process(target=wrapper)
-        calc_proc.daemon = True
-        calc_proc.start()
-        # Wait for the process to finish
+            # Start a process to perform the calculation
+            calc_proc = multiprocessing.Process(target=wrapper)
+            calc_proc.daemon = True
+            calc_proc.start()
+            return calc_proc, parent_conn
+        max_procs = multiprocessing.cpu_count()
+        pending = list(enumerate(args_list))
+        running = []
+        results = [None] * len(args_list)
+        # Wait for the processes to finish
         reactor = self.printer.get_reactor()
         gcode = self.printer.lookup_object("gcode")
         eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
+        while pending or running:
+            while pending and len(running) < max_procs:
+                i, args = pending.pop(0)
+                running.append((i,) + start_process(args))
+            for i, calc_proc, parent_conn in list(running):
+                if parent_conn.poll():
+                    results[i] = parent_conn.recv()
+                elif calc_proc.is_alive() or parent_conn.poll():
+                    continue
+                else:
+                    results[i] = (True, "Calculation process exited")
+                calc_proc.join()
+                parent_conn.close()
+                running.remove((i, calc_proc, parent_conn))
+            if not running and not pending:
+                break
             if eventtime > last_report_time + 5.:
                 last_report_time = eventtime
                 gcode.respond_info("Wait for calculations..", log=False)
             eventtime = reactor.pause(eventtime + .1)
         # Return results
-        is_err, res = parent_conn.recv()
-        if is_err:
-            raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
-        return res
+        for is_err, res in results:
+            if is_err:
+                raise self.error("Error in remote calculation: %s" % (res,))
+        return [res for is_err, res in results]
 
     def _split_into_windows(self, x, window_size, overlap):
         # Memory-efficient algorithm to split an input 'x' into a series
@@ -152,15 +184,22 @@ class ShaperCalibrate:
         if raw_values is None:
             return None
         if isinstance(raw_values, np.ndarray):
-            data = raw_values
+            t, x, y, z = raw_values.T
+        elif hasattr(raw_values, 'get_columns'):
+            # Use the columnar sample arrays without copying them
+            columns = raw_values.get_columns()
+            if not columns[0]:
+                return None
+            t, x, y, z = [np.frombuffer(c, dtype=np.float64)
+                          for c in columns]
         else:
             samples = raw_values.get_samples()
             if not samples:
                 return None
-            data = np.array(samples)
+            t, x, y, z = np.array(samples).T
 
-        N = data.shape[0]
-        T = data[-1,0] - data[0,0]
+        N = t.shape[0]
+        T = t[-1] - t[0]
         SAMPLING_FREQ = N / T
         # Round up to the nearest power of 2 for faster FFT
         M = 1 << int(SAMPLING_FREQ * WINDOW_T_SEC - 1).bit_length()
@@ -169,9 +208,9 @@ class ShaperCalibrate:
 
         # Calculate PSD (power spectral density) of vibrations per
         # frequency bins (the same bins for X, Y, and Z)
-        fx, px = self._psd(data[:,1], SAMPLING_FREQ, M)
-        fy, py = self._psd(data[:,2], SAMPLING_FREQ, M)
-        fz, pz = self._psd(data[:,3], SAMPLING_FREQ, M)
+        fx, px = self._psd(x, SAMPLING_FREQ, M)
+        fy, py = self._psd(y, SAMPLING_FREQ, M)
+        fz, pz = self._psd(z, SAMPLING_FREQ, M)
         return CalibrationData(fx, px+py+pz, px, py, pz)
 
     def process_accelerometer_data(self, data):
@@ -229,6 +268,66 @@ class ShaperCalibrate:
         offset_180 *= inv_D
         return max(offset_90, offset_180)
 
+    def _estimate_shapers(self, A, T, test_damping_ratios, freq_bins):
+        # Same as _estimate_shaper() for a set of shapers (A and T are
+        # indexed by [shaper, impulse]) and damping ratios, the result is
+        # indexed by [damping ratio, shaper, frequency bin]
+        np = self.numpy
+        inv_D = 1. / A.sum(axis=-1)
+        dr = np.asarray(test_damping_ratios)[:, None]
+        omega = 2. * math.pi * freq_bins
+        damping = (dr * omega)[:, None, :, None]
+        omega_d = (omega * np.sqrt(1. - dr**2))[:, None, :, None]
+        T_delay = (T[:, -1:] - T)[None, :, None, :]
+        W = A[None, :, None, :] * np.exp(-damping * T_delay)
+        phase = omega_d * T[None, :, None, :]
+        S = (W * np.sin(phase)).sum(axis=-1)
+        C = (W * np.cos(phase)).sum(axis=-1)
+        return np.sqrt(S**2 + C**2) * inv_D[None, :, None]
+
+    def _estimate_shapers_remaining_vibrations(self, A, T, test_damping_ratios,
+                                               freq_bins, psd):
+        # Pessimized (over the damping ratios) remaining vibrations and
+        # shaper response for each of the shapers in A and T
+        np = self.numpy
+        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+        all_vibrations = np.maximum(psd - vibr_threshold, 0).sum()
+        num_shapers = A.shape[0]
+        vibrations = np.zeros(num_shapers)
+        vals = np.zeros((num_shapers, freq_bins.shape[0]))
+        chunk = max(1, MAX_FIT_ELEMENTS // (
+            len(test_damping_ratios) * freq_bins.shape[0] * A.shape[1]))
+        for start in range(0, num_shapers, chunk):
+            end = start + chunk
+            dr_vals = self._estimate_shapers(A[start:end], T[start:end],
+                                             test_damping_ratios, freq_bins)
+            remaining_vibrations = np.maximum(
+                    dr_vals * psd - vibr_threshold, 0).sum(axis=-1)
+            vibrations[start:end] = remaining_vibrations.max(axis=0)
+            vals[start:end] = dr_vals.max(axis=0)
+        return vibrations / all_vibrations, vals
+
+    def _get_shapers_smoothing_coeffs(self, A, T, scv):
+        # The smoothing of _get_shaper_smoothing() is a linear function of
+        # the acceleration: max(c_90 + accel * k_90, accel * k_180)
+        np = self.numpy
+        inv_D = 1. / A.sum(axis=-1)
+        ts = (A * T).sum(axis=-1) * inv_D
+        dt = T - ts[:, None]
+        A_90 = np.where(dt >= 0., A, 0.)
+        c_90 = (A_90 * scv * dt).sum(axis=-1) * inv_D * math.sqrt(2.)
+        k_90 = (A_90 * .5 * dt**2).sum(axis=-1) * inv_D * math.sqrt(2.)
+        k_180 = (A * .5 * dt**2).sum(axis=-1) * inv_D
+        return c_90, k_90, k_180
+
+    def _find_shapers_max_accel(self, c_90, k_90, k_180):
+        # Solve the smoothing limit of find_shaper_max_accel() directly
+        np = self.numpy
+        with np.errstate(divide='ignore'):
+            max_accel = np.minimum((TARGET_SMOOTHING - c_90) / k_90,
+                                   TARGET_SMOOTHING / k_180)
+        return np.where(c_90 + 1e-9 * k_90 <= TARGET_SMOOTHING, max_accel, 0.)
+
     def fit_shaper(self, shaper_cfg, calibration_data, shaper_freqs,
                    damping_ratio, scv, max_smoothing, test_damping_ratios,
                    max_freq):
@@ -254,24 +353,32 @@ class ShaperCalibrate:
         psd = calibration_data.psd_sum[freq_bins <= max_freq]
         freq_bins = freq_bins[freq_bins <= max_freq]
 
+        # Evaluate all the test frequencies at once, from the highest one
+        test_freqs = test_freqs[::-1]
+        shapers = [shaper_cfg.init_func(test_freq, damping_ratio)
+                   for test_freq in test_freqs]
+        A = np.array([shaper[0] for shaper in shapers])
+        T = np.array([shaper[1] for shaper in shapers])
+        c_90, k_90, k_180 = self._get_shapers_smoothing_coeffs(A, T, scv)
+        smoothings = np.maximum(c_90 + 5000. * k_90, 5000. * k_180)
+        max_accels = self._find_shapers_max_accel(c_90, k_90, k_180)
+        # Stop at the first frequency with too much smoothing
+        num_freqs = len(test_freqs)
+        if max_smoothing:
+            too_smooth = np.nonzero(smoothings[1:] > max_smoothing)[0]
+            if len(too_smooth):
+                num_freqs = too_smooth[0] + 1
+        # Exact damping ratio of the printer is unknown, pessimizing
+        # remaining vibrations over possible damping values
+        vibrations, vals = self._estimate_shapers_remaining_vibrations(
+                A[:num_freqs], T[:num_freqs], test_damping_ratios,
+                freq_bins, psd)
+
         best_res = None
         results = []
-        for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(test_freq, damping_ratio)
-            shaper_smoothing = self._get_shaper_smoothing(shaper, scv=scv)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
-            # Exact damping ratio of the printer is unknown, pessimizing
-            # remaining vibrations over possible damping values
-            for dr in test_damping_ratios:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            max_accel = self.find_shaper_max_accel(shaper, scv)
+        for i in range(num_freqs):
+            shaper_vibrations = float(vibrations[i])
+            shaper_smoothing = float(smoothings[i])
             # The score trying to minimize vibrations, but also accounting
             # the growth of smoothing. The formula itself does not have any
             # special meaning, it simply shows good results on real user data
@@ -279,12 +386,14 @@ class ShaperCalibrate:
                                                shaper_vibrations * .2 + .01)
             results.append(
                     CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
+                        name=shaper_cfg.name, freq=test_freqs[i], vals=vals[i],
                         vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
+                        score=shaper_score, max_accel=float(max_accels[i])))
             if best_res is None or best_res.vibrs > results[-1].vibrs:
                 # The current frequency is better for the shaper.
                 best_res = results[-1]
+        if num_freqs < len(test_freqs):
+            return best_res
         # Try to find an 'optimal' shapper configuration: the one that is not
         # much worse than the 'best' one, but gives much less smoothing
         selected = best_res
@@ -312,9 +421,6 @@ class ShaperCalibrate:
         return left
 
     def find_shaper_max_accel(self, shaper, scv):
-        # Just some empirically chosen value which produces good projections
-        # for max_accel without much smoothing
-        TARGET_SMOOTHING = 0.12
         max_accel = self._bisect(lambda test_accel: self._get_shaper_smoothing(
             shaper, test_accel, scv) <= TARGET_SMOOTHING)
         return max_accel
@@ -326,12 +432,13 @@ class ShaperCalibrate:
         best_shaper = None
         all_shapers = []
         shapers = shapers or AUTOTUNE_SHAPERS
-        for shaper_cfg in shaper_defs.INPUT_SHAPERS:
-            if shaper_cfg.name not in shapers:
-                continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
-                scv, max_smoothing, test_damping_ratios, max_freq))
+        # Fit the shapers in parallel
+        fitted_shapers = self.background_process_exec_all(self.fit_shaper, [
+            (shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
+             scv, max_smoothing, test_damping_ratios, max_freq)
+            for shaper_cfg in shaper_defs.INPUT_SHAPERS
+            if shaper_cfg.name in shapers])
+        for shaper in fitted_shapers:
             if logger is not None:
                 logger("Fitted shaper '%s' frequency = %.1f Hz "
                        "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
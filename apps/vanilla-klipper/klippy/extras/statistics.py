@@ -59,6 +59,7 @@ class PrinterStats:
     def handle_ready(self):
         self.stats_cb = [o.stats for n, o in self.printer.lookup_objects()
                          if hasattr(o, 'stats')]
+        self.stats_cb.append(self.printer.get_reactor().stats)
         if self.printer.get_start_args().get('debugoutput') is None:
             reactor = self.printer.get_reactor()
             reactor.update_timer(self.stats_timer, reactor.NOW)
@@ -67,6 +68,12 @@ class PrinterStats:
         if max([s[0] for s in stats]):
             logging.info("Stats %.1f: %s", eventtime,
                          ' '.join([s[1] for s in stats]))
+            # The per callback costs are only useful when debugging
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                top = self.printer.get_reactor().get_stats_top()
+                if top:
+                    logging.debug("Reactor top callbacks %.1f: %s",
+                                  eventtime, top)
         return eventtime + 1.
 
 def load_config(config):
@@ -3,16 +3,122 @@
 # Copyright (C) 2018-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, sys, logging, io
+import os, logging, io, mmap, threading, itertools
 
 VALID_GCODE_EXTS = ['gcode', 'g', 'gco']
 
+READ_WINDOW = 32 * 1024
+READ_AHEAD = 1024 * 1024
+PREFETCH_CHUNK = 64 * 1024
+
 DEFAULT_ERROR_GCODE = """
 {% if 'heaters' in printer %}
    TURN_OFF_HEATERS
 {% endif %}
 """
 
+# Memory mapped g-code file reader with background read-ahead
+class GCodeFileReader:
+    def __init__(self, filename):
+        self.name = filename
+        self.file = io.open(filename, 'rb')
+        self.file_size = os.fstat(self.file.fileno()).st_size
+        self.map = None
+        if self.file_size:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        self.position = 0
+        # Read-ahead thread
+        self.lock = threading.Condition()
+        self.prefetch_pos = self.prefetch_end = 0
+        self.is_closed = False
+        self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
+        self.bg_thread.start()
+        self._prefetch(0)
+    def _bg_thread(self):
+        fd = self.file.fileno()
+        while 1:
+            with self.lock:
+                while (not self.is_closed
+                       and self.prefetch_pos >= self.prefetch_end):
+                    self.lock.wait()
+                if self.is_closed:
+                    break
+                pos = self.prefetch_pos
+                count = min(self.prefetch_end - pos, PREFETCH_CHUNK)
+            # os.pread() releases the GIL, so the page cache is filled
+            # here without stalling the reactor thread
+            try:
+                data = os.pread(fd, count, pos)
+            except:
+                logging.exception("virtual_sdcard read-ahead")
+                break
+            with self.lock:
+                if self.prefetch_pos == pos:
+                    if data:
+                        self.prefetch_pos = pos + len(data)
+                    else:
+                        self.prefetch_pos = self.prefetch_end
+    def _prefetch(self, pos):
+        with self.lock:
+            if self.prefetch_pos < pos or self.prefetch_pos > pos + READ_AHEAD:
+                self.prefetch_pos = pos
+            self.prefetch_end = min(pos + READ_AHEAD, self.file_size)
+            self.lock.notify()
+    def close(self):
+        with self.lock:
+            if self.is_closed:
+                return
+            self.is_closed = True
+            self.lock.notify()
+        self.bg_thread.join()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+    def seek(self, pos):
+        self.position = pos
+        self._prefetch(pos)
+    def tell(self):
+        return self.position
+    def read(self, count):
+        if self.map is None:
+            return ""
+        data = self.map[self.position:self.position + count]
+        self.position += len(data)
+        return data.decode(errors='replace')
+    def read_lines(self):
+        # Return the complete lines of the next window along with the
+        # file position that follows each line
+        pos = self.position
+        if self.map is None or pos >= self.file_size:
+            return [], []
+        end = min(pos + READ_WINDOW, self.file_size)
+        eol = self.map.rfind(b'\n', pos, end)
+        if eol < 0:
+            # Line is longer than the window
+            eol = self.map.find(b'\n', end)
+            if eol < 0:
+                # Unterminated data at end of file is not processed
+                return [], []
+        end = eol + 1
+        data = self.map[pos:end]
+        self.position = end
+        self._prefetch(end)
+        if data.isascii():
+            lines = data.decode().split('\n')
+            lines.pop()
+            lengths = map(len, lines)
+        else:
+            blines = data.split(b'\n')
+            blines.pop()
+            lengths = map(len, blines)
+            lines = [bline.decode() for bline in blines]
+        positions = list(itertools.accumulate(
+            lengths, lambda p, l: p + l + 1, initial=pos))
+        positions.pop(0)
+        return lines, positions
+
 class VirtualSD:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -183,10 +289,8 @@ class VirtualSD:
             if fname not in flist:
                 fname = files_by_lower[fname.lower()]
             fname = os.path.join(self.sdcard_dirname, fname)
-            f = io.open(fname, 'r', newline='')
-            f.seek(0, os.SEEK_END)
-            fsize = f.tell()
-            f.seek(0)
+            f = GCodeFileReader(fname)
+            fsize = f.file_size
         except:
             logging.exception("virtual_sdcard file open")
             raise gcmd.error("Unable to open file")
@@ -219,6 +323,10 @@ class VirtualSD:
         return self.next_file_position
     def set_file_position(self, pos):
         self.next_file_position = pos
+    def note_line_done(self, next_file_position):
+        self.file_position = self.next_file_position
+        return (self.next_file_position == next_file_position
+                and not self.must_pause_work)
     def is_cmd_from_sd(self):
         return self.cmd_from_sd
     # Background work timer
@@ -233,44 +341,33 @@ class VirtualSD:
             return self.reactor.NEVER
         self.print_stats.note_start()
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
-        lines = []
+        lines, positions = [], []
         error_message = None
         while not self.must_pause_work:
             if not lines:
                 # Read more data
                 try:
-                    data = self.current_file.read(8192)
+                    lines, positions = self.current_file.read_lines()
                 except:
                     logging.exception("virtual_sdcard read")
                     break
-                if not data:
+                if not lines:
                     # End of file
                     self.current_file.close()
                     self.current_file = None
                     logging.info("Finished SD card print")
                     self.gcode.respond_raw("Done printing file")
                     break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
                 self.reactor.pause(self.reactor.NOW)
                 continue
             # Pause if any other request is pending in the gcode class
             if gcode_mutex.test():
                 self.reactor.pause(self.reactor.monotonic() + 0.100)
                 continue
-            # Dispatch command
+            # Dispatch commands
             self.cmd_from_sd = True
-            line = lines.pop()
-            if sys.version_info.major >= 3:
-                next_file_position = self.file_position + len(line.encode()) + 1
-            else:
-                next_file_position = self.file_position + len(line) + 1
-            self.next_file_position = next_file_position
             try:
-                self.gcode.run_script(line)
+                count = self.gcode.run_script_lines(lines, positions, self)
             except self.gcode.error as e:
                 error_message = str(e)
                 try:
@@ -282,17 +379,18 @@ class VirtualSD:
                 logging.exception("virtual_sdcard dispatch")
                 break
             self.cmd_from_sd = False
-            self.file_position = self.next_file_position
+            next_file_position = positions[count - 1]
+            del lines[:count]
+            del positions[:count]
             # Do we need to skip around?
-            if self.next_file_position != next_file_position:
+            if self.file_position != next_file_position:
                 try:
                     self.current_file.seek(self.file_position)
                 except:
                     logging.exception("virtual_sdcard seek")
                     self.work_timer = None
                     return self.reactor.NEVER
-                lines = []
-                partial_input = ""
+                lines, positions = [], []
         logging.info("Exiting SD card print (position %d)", self.file_position)
         self.work_timer = None
         self.cmd_from_sd = False
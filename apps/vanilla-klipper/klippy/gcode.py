@@ -11,6 +11,8 @@ class CommandError(Exception):
 Coord = collections.namedtuple('Coord', ('x', 'y', 'z', 'e'))
 
 class GCodeCommand:
+    __slots__ = ('_command', '_commandline', '_params', '_need_ack',
+                 'respond_info', 'respond_raw')
     error = CommandError
     def __init__(self, gcode, command, commandline, params, need_ack):
         self._command = command
@@ -84,6 +86,33 @@ class GCodeCommand:
         return self.get(name, default, parser=float, minval=minval,
                         maxval=maxval, above=above, below=below)
 
+# Parse a g-code line (with comments removed) into a command and params
+args_r = re.compile('([A-Z_]+|[A-Z*])')
+def parse_line_generic(line):
+    # Break line into parts and determine command
+    parts = args_r.split(line.upper())
+    if ''.join(parts[:2]) == 'N':
+        # Skip line number at start of command
+        cmd = ''.join(parts[3:5]).strip()
+    else:
+        cmd = ''.join(parts[:3]).strip()
+    # Build gcode "params" dictionary
+    params = { parts[i]: parts[i+1].strip()
+               for i in range(1, len(parts), 2) }
+    return cmd, params
+
+# Traditional commands made of space separated single letter parameters
+# (eg, "G1 X10 Y20 E.5") without line numbers or checksums
+traditional_r = re.compile(r'[A-MO-Z][^A-Z_*\s]*(?:\s+[A-Z][^A-Z_*\s]*)*\s*')
+def parse_line(line):
+    uline = line.upper()
+    if traditional_r.fullmatch(uline) is None:
+        if not uline:
+            return '', {}
+        return parse_line_generic(uline)
+    words = uline.split()
+    return words[0], {w[0]: w[1:] for w in words}
+
 # Parse and dispatch G-Code commands
 class GCodeDispatch:
     error = CommandError
@@ -187,7 +216,6 @@ class GCodeDispatch:
         self._build_status_commands()
         self._respond_state("Ready")
     # Parse input into commands
-    args_r = re.compile('([A-Z_]+|[A-Z*])')
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
             # Ignore comments and leading/trailing spaces
@@ -195,16 +223,7 @@ class GCodeDispatch:
             cpos = line.find(';')
             if cpos >= 0:
                 line = line[:cpos]
-            # Break line into parts and determine command
-            parts = self.args_r.split(line.upper())
-            if ''.join(parts[:2]) == 'N':
-                # Skip line number at start of command
-                cmd = ''.join(parts[3:5]).strip()
-            else:
-                cmd = ''.join(parts[:3]).strip()
-            # Build gcode "params" dictionary
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(1, len(parts), 2) }
+            cmd, params = parse_line(line)
             gcmd = GCodeCommand(self, cmd, origline, params, need_ack)
             # Invoke handler for command
             handler = self.gcode_handlers.get(cmd, self.cmd_default)
@@ -228,6 +247,24 @@ class GCodeDispatch:
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
+    def run_script_lines(self, lines, positions, tracker):
+        # Run a block of pre-split lines (eg, from a file being printed)
+        # with a single acquire of the gcode mutex.  Before each line the
+        # tracker is given the file position following that line (via
+        # set_file_position()) and after it completes note_line_done() is
+        # called, which may return False to stop the block early.  The
+        # block also stops when another client is waiting on the mutex.
+        # Returns the number of lines completed.
+        mutex = self.mutex
+        count = 0
+        with mutex:
+            for line, pos in zip(lines, positions):
+                tracker.set_file_position(pos)
+                self._process_commands((line,), need_ack=False)
+                count += 1
+                if not tracker.note_line_done(pos) or mutex.has_waiters():
+                    break
+        return count
     def get_mutex(self):
         return self.mutex
     def create_gcode_command(self, command, commandline, params):
@@ -35,6 +35,7 @@ class Printer:
         self.run_result = None
         self.event_handlers = {}
         self.objects = collections.OrderedDict()
+        self.config_load_times = {}
         # Init printer components that must be setup prior to config
         for m in [gcode, webhooks]:
             m.add_early_printer_objects(self)
@@ -109,9 +110,13 @@ class Printer:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
+        starttime = time.perf_counter()
         self.objects[section] = init_func(config.getsection(section))
+        self.config_load_times[section] = time.perf_counter() - starttime
         return self.objects[section]
     def _read_config(self):
+        starttime = time.perf_counter()
+        self.config_load_times = {}
         self.objects['configfile'] = pconfig = configfile.PrinterConfig(self)
         config = pconfig.read_main_config()
         if self.bglogger is not None:
@@ -125,6 +130,12 @@ class Printer:
             m.add_printer_objects(config)
         # Validate that there are no undefined parameters in the config file
         pconfig.check_unused_options(config)
+        # Report the slowest sections (times include any objects they load)
+        times = sorted(self.config_load_times.items(), key=(lambda i: i[1]),
+                       reverse=True)
+        logging.info("Config load time %.3fs slowest: %s",
+                     time.perf_counter() - starttime,
+                     " ".join(["%s=%.4f" % (n, t) for n, t in times[:10]]))
     def _connect(self, eventtime):
         try:
             self._read_config()
@@ -213,6 +224,11 @@ class Printer:
                 logging.exception("Exception during shutdown handler")
         logging.info("Reactor garbage collection: %s",
                      self.reactor.get_gc_stats())
+        tstats = sorted(self.reactor.get_timer_stats().items(),
+                        key=(lambda i: i[1][1]), reverse=True)
+        logging.info("Reactor timer costs (count/total/max): %s",
+                     " ".join(["%s=%d/%.3f/%.6f" % (n, c, t, m)
+                               for n, (c, t, m) in tstats[:10]]))
         self.send_event("klippy:notify_mcu_shutdown", msg, details)
     def invoke_async_shutdown(self, msg, details={}):
         self.reactor.register_async_callback(
@@ -267,6 +283,9 @@ def main():
                     help="api server unix domain socket filename")
     opts.add_option("-l", "--logfile", dest="logfile",
                     help="write log to file instead of stderr")
+    opts.add_option("--binary-log", action="store_true", dest="binarylog",
+                    help="write log file in compact binary format"
+                    " (see scripts/binlog_to_text.py)")
     opts.add_option("-v", action="store_true", dest="verbose",
                     help="enable debug messages")
     opts.add_option("-o", "--debugoutput", dest="debugoutput",
@@ -281,6 +300,8 @@ def main():
         import_test()
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
+    if options.binarylog and not options.logfile:
+        opts.error("The --binary-log option requires a log file")
     start_args = {'config_file': args[0], 'apiserver': options.apiserver,
                   'start_reason': 'startup'}
 
@@ -299,7 +320,8 @@ def main():
     bglogger = None
     if options.logfile:
         start_args['log_file'] = options.logfile
-        bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel)
+        bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel,
+                                                options.binarylog)
     else:
         logging.getLogger().setLevel(debuglevel)
     logging.info("Starting Klippy...")
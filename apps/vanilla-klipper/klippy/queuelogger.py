@@ -3,7 +3,10 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, logging.handlers, threading, queue, time
+import logging, logging.handlers, threading, queue, time, struct, zlib
+
+# Argument types that may be formatted later from the background thread
+DEFER_TYPES = {str, int, float, bool, type(None), bytes}
 
 # Class to forward all messages through a queue to a background thread
 class QueueHandler(logging.Handler):
@@ -12,10 +15,16 @@ class QueueHandler(logging.Handler):
         self.queue = queue
     def emit(self, record):
         try:
-            self.format(record)
-            record.msg = record.message
-            record.args = None
-            record.exc_info = None
+            # Records whose arguments can't change are formatted by the
+            # background thread - others are formatted here
+            args = record.args
+            if (type(record.msg) is not str or record.exc_info
+                or record.stack_info or type(args) is not tuple
+                or [1 for a in args if type(a) not in DEFER_TYPES]):
+                self.format(record)
+                record.msg = record.message
+                record.args = None
+                record.exc_info = None
             self.queue.put_nowait(record)
         except Exception:
             self.handleError(record)
@@ -29,9 +38,11 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
         self.bg_thread = threading.Thread(target=self._bg_thread)
         self.bg_thread.start()
         self.rollover_info = {}
+    def _get_record(self):
+        return self.bg_queue.get(True)
     def _bg_thread(self):
         while 1:
-            record = self.bg_queue.get(True)
+            record = self._get_record()
             if record is None:
                 break
             self.handle(record)
@@ -55,11 +66,230 @@ class QueueListener(logging.handlers.TimedRotatingFileHandler):
         self.emit(logging.makeLogRecord(
             {'msg': "\n".join(lines), 'level': logging.INFO}))
 
+
+######################################################################
+# Compact binary log
+######################################################################
+
+# File layout: a header (repeated each time the file is opened), then
+# a sequence of zlib compressed blocks of entries.  Message templates
+# are stored once per header and later referenced by id, with the
+# arguments stored in binary.
+BINLOG_MAGIC = b"KLOG"
+BINLOG_VERSION = 1
+BINLOG_HEADER = struct.Struct("<4sH")
+BINLOG_BLOCK = struct.Struct("<BI")       # 'Z', compressed length
+BINLOG_TEMPLATE = struct.Struct("<BII")   # 'T', template id, length
+BINLOG_MESSAGE = struct.Struct("<BdBHB")  # 'M', time, level, id, arg count
+BINLOG_TEXT = struct.Struct("<BdBI")      # 'L', time, level, length
+BINLOG_INT32 = struct.Struct("<Bi")
+BINLOG_INT = struct.Struct("<Bq")
+BINLOG_FLOAT = struct.Struct("<Bd")
+BINLOG_BYTES = struct.Struct("<BI")
+BINLOG_MAX_TEMPLATES = 4096
+BINLOG_BATCH_SIZE = 64 * 1024
+BINLOG_FLUSH_TIME = 1.
+
+class BinaryLogError(Exception):
+    pass
+
+def _encode_arg(out, val):
+    vtype = type(val)
+    if vtype is int and -(1<<31) <= val < (1<<31):
+        out += BINLOG_INT32.pack(ord('i'), val)
+    elif vtype is int and -(1<<63) <= val < (1<<63):
+        out += BINLOG_INT.pack(ord('q'), val)
+    elif vtype is float:
+        out += BINLOG_FLOAT.pack(ord('f'), val)
+    elif vtype is bool:
+        out += b'T' if val else b'F'
+    elif val is None:
+        out += b'N'
+    elif vtype is bytes:
+        out += BINLOG_BYTES.pack(ord('y'), len(val))
+        out += val
+    else:
+        tag = 'I' if vtype is int else 's'
+        data = str(val).encode('utf-8', 'surrogateescape')
+        out += BINLOG_BYTES.pack(ord(tag), len(data))
+        out += data
+
+# Write log records in the compact binary format.  Entries are batched
+# in memory and written as one compressed block once the batch is full,
+# after a short delay, or immediately for warnings and errors.
+class BinaryQueueListener(QueueListener):
+    def __init__(self, filename, batch_size=BINLOG_BATCH_SIZE,
+                 flush_time=BINLOG_FLUSH_TIME):
+        self.batch = bytearray()
+        self.batch_size = batch_size
+        self.flush_time = flush_time
+        self.templates = {}
+        QueueListener.__init__(self, filename)
+    def _open(self):
+        stream = open(self.baseFilename, 'ab')
+        stream.write(BINLOG_HEADER.pack(BINLOG_MAGIC, BINLOG_VERSION))
+        self.templates.clear()
+        return stream
+    def _get_record(self):
+        # Wait for the next record, writing the batch if it goes idle
+        timeout = self.flush_time if self.batch else None
+        try:
+            return self.bg_queue.get(True, timeout)
+        except queue.Empty:
+            self.flush()
+            return self.bg_queue.get(True)
+    def _encode(self, record, level):
+        out = self.batch
+        args = record.args
+        if (type(record.msg) is str and type(args) is tuple
+            and 0 < len(args) < 256
+            and not record.exc_info and not record.stack_info):
+            templates = self.templates
+            template_id = templates.get(record.msg)
+            if template_id is None and len(templates) < BINLOG_MAX_TEMPLATES:
+                template_id = templates[record.msg] = len(templates)
+                data = record.msg.encode('utf-8', 'surrogateescape')
+                out += BINLOG_TEMPLATE.pack(ord('T'), template_id, len(data))
+                out += data
+            if template_id is not None:
+                out += BINLOG_MESSAGE.pack(ord('M'), record.created, level,
+                                           template_id, len(args))
+                for val in args:
+                    _encode_arg(out, val)
+                return
+        data = self.format(record).encode('utf-8', 'surrogateescape')
+        out += BINLOG_TEXT.pack(ord('L'), record.created, level, len(data))
+        out += data
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.shouldRollover(record):
+                self._write_batch()
+                self.doRollover()
+            # The rollover message is created without a levelno
+            level = min(record.levelno or 0, 0xff)
+            self._encode(record, level)
+            if len(self.batch) >= self.batch_size or level >= logging.WARNING:
+                self._write_batch()
+        except Exception:
+            self.handleError(record)
+    def stop(self):
+        QueueListener.stop(self)
+        self.flush()
+    def _write_batch(self):
+        if self.batch and self.stream is not None:
+            data = zlib.compress(self.batch, 1)
+            self.stream.write(BINLOG_BLOCK.pack(ord('Z'), len(data)) + data)
+            self.stream.flush()
+        self.batch.clear()
+    def flush(self):
+        self.acquire()
+        try:
+            self._write_batch()
+        finally:
+            self.release()
+
+# Parse a binary log file, generating (time, level, message) entries
+def read_binary_log(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    templates = {}
+    pos = 0
+    while pos < len(data):
+        tag = chr(data[pos])
+        try:
+            if tag == 'K':
+                magic, version = BINLOG_HEADER.unpack_from(data, pos)
+                if magic != BINLOG_MAGIC:
+                    raise BinaryLogError("Invalid binary log header")
+                if version != BINLOG_VERSION:
+                    raise BinaryLogError("Unsupported binary log version %d"
+                                         % (version,))
+                templates = {}
+                pos += BINLOG_HEADER.size
+                continue
+            if tag != 'Z':
+                raise BinaryLogError("Invalid binary log block")
+            t, length = BINLOG_BLOCK.unpack_from(data, pos)
+            block = zlib.decompress(data[pos + BINLOG_BLOCK.size:
+                                         pos + BINLOG_BLOCK.size + length])
+            entries = list(_parse_block(block, templates))
+        except (struct.error, zlib.error, KeyError, ValueError,
+                BinaryLogError) as e:
+            raise BinaryLogError("Corrupt binary log at offset %d: %s"
+                                 % (pos, e))
+        pos += BINLOG_BLOCK.size + length
+        for entry in entries:
+            yield entry
+
+def _parse_block(data, templates):
+    pos = 0
+    while pos < len(data):
+        tag = chr(data[pos])
+        if tag == 'T':
+            t, template_id, length = BINLOG_TEMPLATE.unpack_from(data, pos)
+            pos += BINLOG_TEMPLATE.size
+            templates[template_id] = data[pos:pos+length].decode(
+                'utf-8', 'surrogateescape')
+            pos += length
+        elif tag == 'M':
+            t, ptime, level, template_id, count = (
+                BINLOG_MESSAGE.unpack_from(data, pos))
+            pos += BINLOG_MESSAGE.size
+            args = []
+            for i in range(count):
+                val, pos = _decode_arg(data, pos)
+                args.append(val)
+            yield ptime, level, _format_message(templates[template_id],
+                                                tuple(args))
+        elif tag == 'L':
+            t, ptime, level, length = BINLOG_TEXT.unpack_from(data, pos)
+            pos += BINLOG_TEXT.size
+            yield ptime, level, data[pos:pos+length].decode(
+                'utf-8', 'surrogateescape')
+            pos += length
+        else:
+            raise BinaryLogError("Invalid binary log entry")
+
+def _format_message(template, args):
+    try:
+        return template % args
+    except (TypeError, ValueError) as e:
+        # The text log would have reported a logging error instead
+        return "%s (unable to format %s: %s)" % (template, repr(args), e)
+
+def _decode_arg(data, pos):
+    tag = chr(data[pos])
+    if tag == 'i':
+        return BINLOG_INT32.unpack_from(data, pos)[1], pos + BINLOG_INT32.size
+    if tag == 'q':
+        return BINLOG_INT.unpack_from(data, pos)[1], pos + BINLOG_INT.size
+    if tag == 'f':
+        return BINLOG_FLOAT.unpack_from(data, pos)[1], pos + BINLOG_FLOAT.size
+    if tag in 'TFN':
+        return {'T': True, 'F': False, 'N': None}[tag], pos + 1
+    t, length = BINLOG_BYTES.unpack_from(data, pos)
+    pos += BINLOG_BYTES.size
+    val = data[pos:pos+length]
+    pos += length
+    if tag == 'y':
+        return val, pos
+    val = val.decode('utf-8', 'surrogateescape')
+    if tag == 'I':
+        return int(val), pos
+    if tag == 's':
+        return val, pos
+    raise BinaryLogError("Invalid binary log argument type '%s'" % (tag,))
+
 MainQueueHandler = None
 
-def setup_bg_logging(filename, debuglevel):
+def setup_bg_logging(filename, debuglevel, binary=False):
     global MainQueueHandler
-    ql = QueueListener(filename)
+    if binary:
+        ql = BinaryQueueListener(filename)
+    else:
+        ql = QueueListener(filename)
     MainQueueHandler = QueueHandler(ql.bg_queue)
     root = logging.getLogger()
     root.addHandler(MainQueueHandler)
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, gc, select, math, time, logging, queue
+import os, gc, select, math, time, logging, queue, heapq
 import greenlet
 import chelper, util
 
@@ -14,6 +14,13 @@ class ReactorTimer:
     def __init__(self, callback, waketime):
         self.callback = callback
         self.waketime = waketime
+        # Sequence number of this timer's live heap entry (if any)
+        self.heap_seq = None
+        self.registered = True
+        # Names are logged as a single token (no whitespace)
+        name = getattr(callback, '__qualname__', None) or str(
+            type(callback).__name__)
+        self.stats_name = '_'.join(name.split()) or 'unknown'
 
 class ReactorCompletion:
     class sentinel: pass
@@ -72,6 +79,8 @@ class ReactorMutex:
         self.unlock = self.__exit__
     def test(self):
         return self.is_locked
+    def has_waiters(self):
+        return bool(self.queue)
     def __enter__(self):
         if not self.is_locked:
             self.is_locked = True
@@ -101,9 +110,22 @@ class SelectReactor:
         # Python garbage collection
         self._check_gc = gc_checking
         self._last_gc_times = [0., 0., 0.]
-        # Timers
+        # Timers - a heap of (waketime, seq, timer) entries.  An entry is
+        # only live if seq matches timer.heap_seq; stale entries left by
+        # update_timer() are discarded when they reach the top of the heap.
         self._timers = []
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._timer_deferred = []
         self._next_timer = self.NEVER
+        # Timer statistics
+        self._timer_cb_count = 0
+        self._timer_cb_max = 0.
+        self._timer_costs = {}
+        self._last_stats_time = 0.
+        self._last_stats_count = 0
+        self._last_stats_costs = {}
+        self._last_stats_top = ""
         # Callbacks
         self._pipe_fds = None
         self._async_queue = queue.Queue()
@@ -116,22 +138,75 @@ class SelectReactor:
         self._all_greenlets = []
     def get_gc_stats(self):
         return tuple(self._last_gc_times)
+    def get_timer_stats(self):
+        # Returns {callback_name: (count, total_time, max_time)}
+        return {name: tuple(st) for name, st in self._timer_costs.items()}
+    def get_stats_top(self):
+        # Most expensive callbacks found by the last stats() call
+        return self._last_stats_top
+    def stats(self, eventtime):
+        count = self._timer_cb_count
+        elapsed = eventtime - self._last_stats_time
+        rate = 0.
+        if self._last_stats_time and elapsed > 0.:
+            rate = (count - self._last_stats_count) / elapsed
+        # Report the most expensive callbacks over the last interval
+        last_costs = self._last_stats_costs
+        costs = []
+        for name, st in self._timer_costs.items():
+            prev = last_costs.get(name)
+            cost = st[1] - (prev[1] if prev is not None else 0.)
+            if cost > 0.:
+                costs.append((cost, name))
+        costs.sort(reverse=True)
+        self._last_stats_top = " ".join(["%s=%.6f" % (name, cost)
+                                         for cost, name in costs[:3]])
+        msg = "reactor: timers=%.0f max_cb=%.6f" % (
+            rate, self._timer_cb_max)
+        self._last_stats_time = eventtime
+        self._last_stats_count = count
+        self._last_stats_costs = {name: tuple(st)
+                                  for name, st in self._timer_costs.items()}
+        self._timer_cb_max = 0.
+        return (False, msg)
     # Timers
+    def _push_timer(self, timer_handler, waketime):
+        if waketime >= self.NEVER or not timer_handler.registered:
+            timer_handler.heap_seq = None
+            return
+        seq = self._timer_seq
+        self._timer_seq = seq + 1
+        timer_handler.heap_seq = seq
+        heap = self._timer_heap
+        heapq.heappush(heap, (waketime, seq, timer_handler))
+        if len(heap) > 4 * len(self._timers) + 64:
+            # Too many stale entries - rebuild the heap from live entries
+            heap[:] = [e for e in heap if e[2].heap_seq == e[1]]
+            heapq.heapify(heap)
     def update_timer(self, timer_handler, waketime):
         timer_handler.waketime = waketime
+        self._push_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
     def register_timer(self, callback, waketime=NEVER):
         timer_handler = ReactorTimer(callback, waketime)
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
+        self._timers.append(timer_handler)
+        self._push_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
         return timer_handler
     def unregister_timer(self, timer_handler):
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
+        timer_handler.registered = False
+        timer_handler.heap_seq = None
+        timers = self._timers
         timers.pop(timers.index(timer_handler))
-        self._timers = timers
+    def _update_next_timer(self):
+        if self._timer_deferred:
+            self._next_timer = self.NOW
+            return
+        heap = self._timer_heap
+        while heap and heap[0][2].heap_seq != heap[0][1]:
+            heapq.heappop(heap)
+        self._next_timer = heap[0][0] if heap else self.NEVER
     def _check_timers(self, eventtime, busy):
         if eventtime < self._next_timer:
             if busy:
@@ -150,17 +225,53 @@ class SelectReactor:
                     return 0.
             return min(1., max(.001, self._next_timer - eventtime))
         self._next_timer = self.NEVER
+        heap = self._timer_heap
+        heappop = heapq.heappop
+        # Entries that became due during an earlier pass run now
+        deferred = self._timer_deferred
+        if deferred:
+            for entry in deferred:
+                heapq.heappush(heap, entry)
+            del deferred[:]
+        # Entries pushed during this pass wait for the next pass, so a
+        # timer that reschedules itself in the past runs once per pass
+        start_seq = self._timer_seq
         g_dispatch = self._g_dispatch
-        for t in self._timers:
-            waketime = t.waketime
-            if eventtime >= waketime:
-                t.waketime = self.NEVER
-                t.waketime = waketime = t.callback(eventtime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
+        perf_counter = time.perf_counter
+        costs = self._timer_costs
+        while heap:
+            entry = heap[0]
+            waketime, seq, t = entry
+            if t.heap_seq != seq:
+                heappop(heap)
+                continue
+            if eventtime < waketime:
+                break
+            heappop(heap)
+            if seq >= start_seq:
+                deferred.append(entry)
+                continue
+            t.heap_seq = None
+            t.waketime = self.NEVER
+            start = perf_counter()
+            t.waketime = waketime = t.callback(eventtime)
+            self._push_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                self._update_next_timer()
+                self._end_greenlet(g_dispatch)
+                return 0.
+            cb_time = perf_counter() - start
+            self._timer_cb_count += 1
+            if cb_time > self._timer_cb_max:
+                self._timer_cb_max = cb_time
+            st = costs.get(t.stats_name)
+            if st is None:
+                st = costs[t.stats_name] = [0, 0., 0.]
+            st[0] += 1
+            st[1] += cb_time
+            if cb_time > st[2]:
+                st[2] = cb_time
+        self._update_next_timer()
         return 0.
     # Callbacks and Completions
     def completion(self):
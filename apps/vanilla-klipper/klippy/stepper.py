@@ -162,6 +162,10 @@ class MCU_stepper:
         count = ffi_lib.stepcompress_extract_old(self._stepqueue, data, count,
                                                  start_clock, end_clock)
         return (data, count)
+    def dump_steps_range(self, data, count, start_clock, end_clock):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        return ffi_lib.stepcompress_extract_range(self._stepqueue, data, count,
+                                                  start_clock, end_clock)
     def get_stepper_kinematics(self):
         return self._stepper_kinematics
     def set_stepper_kinematics(self, sk):
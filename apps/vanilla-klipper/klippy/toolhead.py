@@ -481,6 +481,22 @@ class ToolHead:
         self.lookahead.add_move(move)
         if self.print_time > self.need_check_pause:
             self._check_pause()
+    def move_batch(self, positions, speed):
+        # Same as calling move() for each position
+        lookahead_add_move = self.lookahead.add_move
+        commanded_pos = self.commanded_pos
+        for newpos in positions:
+            move = Move(self, commanded_pos, newpos, speed)
+            if not move.move_d:
+                continue
+            if move.is_kinematic_move:
+                self.kin.check_move(move)
+            if move.axes_d[3]:
+                self.extruder.check_move(move)
+            commanded_pos[:] = move.end_pos
+            lookahead_add_move(move)
+            if self.print_time > self.need_check_pause:
+                self._check_pause()
     def manual_move(self, coord, speed):
         curpos = list(self.commanded_pos)
         for i in range(len(coord)):
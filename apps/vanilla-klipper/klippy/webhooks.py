@@ -3,11 +3,14 @@
 # Copyright (C) 2020 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license
-import logging, socket, os, sys, errno, json, collections
+import logging, socket, os, sys, errno, json, collections, struct
 import gcode
 
 REQUEST_LOG_SIZE = 20
 
+BINARY_FRAME_START = b"\x02"
+BINARY_FRAME_HEADER = struct.Struct("<II")
+
 # Json decodes strings as unicode types in Python 2.x.  This doesn't
 # play well with some parts of Klipper (particuarly displays), so we
 # need to create an object hook. This solution borrowed from:
@@ -267,15 +270,33 @@ class ClientConnection:
             return
         self.send(result)
 
-    def send(self, data):
+    def _encode(self, data):
         try:
-            jmsg = json.dumps(data, separators=(',', ':'))
-            self.send_buffer += jmsg.encode() + b"\x03"
+            return json.dumps(data, separators=(',', ':')).encode()
         except (TypeError, ValueError) as e:
             msg = ("json encoding error: %s" % (str(e),))
             logging.exception(msg)
             self.printer.invoke_shutdown(msg)
+            return None
+
+    def send(self, data):
+        jmsg = self._encode(data)
+        if jmsg is None:
             return
+        self.send_buffer += jmsg + b"\x03"
+        if not self.is_blocking:
+            self._do_send()
+
+    def send_binary(self, data, payload):
+        # Binary frame (only sent to clients that requested it): STX, the
+        # json header and payload lengths, the json header, the payload
+        jmsg = self._encode(data)
+        if jmsg is None:
+            return
+        self.send_buffer += b"".join([
+            BINARY_FRAME_START,
+            BINARY_FRAME_HEADER.pack(len(jmsg), len(payload)),
+            jmsg, payload])
         if not self.is_blocking:
             self._do_send()
 
@@ -463,18 +484,62 @@ class QueryStatusHelper:
         self.pending_queries = []
         self.query_timer = None
         self.last_query = {}
+        # Objects that report their own status changes (name -> is_dirty)
+        self.change_tracking = {}
+        # Per object get_status() cost tracking
+        self.query_stats = {}
         # Register webhooks
         webhooks = printer.lookup_object('webhooks')
         webhooks.register_endpoint("objects/list", self._handle_list)
         webhooks.register_endpoint("objects/query", self._handle_query)
         webhooks.register_endpoint("objects/subscribe", self._handle_subscribe)
+        webhooks.register_endpoint("objects/query_stats",
+                                   self._handle_query_stats)
+    def register_change_tracking(self, obj_name):
+        # Opt-in for objects that call note_status_change() whenever their
+        # get_status() result changes - subscriptions then only re-query
+        # and compare the object after such a notification
+        self.change_tracking[obj_name] = True
+    def note_status_change(self, obj_name):
+        if obj_name in self.change_tracking:
+            self.change_tracking[obj_name] = True
     def _handle_list(self, web_request):
         objects = [n for n, o in self.printer.lookup_objects()
                    if hasattr(o, 'get_status')]
         web_request.send({'objects': objects})
+    def _handle_query_stats(self, web_request):
+        objects = {}
+        for obj_name, (count, skipped, total, max_time) in sorted(
+                self.query_stats.items()):
+            objects[obj_name] = {'queries': count, 'skipped': skipped,
+                                 'total_time': total, 'max_time': max_time}
+        web_request.send({'objects': objects})
+    def _get_query_stats(self, obj_name):
+        stats = self.query_stats.get(obj_name)
+        if stats is None:
+            # [query count, skipped count, total time, max time]
+            stats = self.query_stats[obj_name] = [0, 0, 0., 0.]
+        return stats
+    def _query_object(self, obj_name, eventtime):
+        po = self.printer.lookup_object(obj_name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            return {}
+        if obj_name in self.change_tracking:
+            self.change_tracking[obj_name] = False
+        monotonic = self.printer.get_reactor().monotonic
+        starttime = monotonic()
+        res = po.get_status(eventtime)
+        query_time = monotonic() - starttime
+        stats = self._get_query_stats(obj_name)
+        stats[0] += 1
+        stats[2] += query_time
+        stats[3] = max(stats[3], query_time)
+        return res
     def _do_query(self, eventtime):
         last_query = self.last_query
         query = self.last_query = {}
+        unchanged = {}
+        change_tracking = self.change_tracking
         msglist = self.pending_queries
         self.pending_queries = []
         msglist.extend(self.clients.values())
@@ -489,15 +554,21 @@ class QueryStatusHelper:
             for obj_name, req_items in subscription.items():
                 res = query.get(obj_name, None)
                 if res is None:
-                    po = self.printer.lookup_object(obj_name, None)
-                    if po is None or not hasattr(po, 'get_status'):
-                        res = query[obj_name] = {}
+                    if (change_tracking.get(obj_name, True)
+                        or obj_name not in last_query):
+                        res = self._query_object(obj_name, eventtime)
                     else:
-                        res = query[obj_name] = po.get_status(eventtime)
+                        # Object reported no change - reuse last result
+                        res = last_query[obj_name]
+                        unchanged[obj_name] = True
+                        self._get_query_stats(obj_name)[1] += 1
+                    query[obj_name] = res
                 if req_items is None:
                     req_items = list(res.keys())
                     if req_items:
                         subscription[obj_name] = req_items
+                if not is_query and obj_name in unchanged:
+                    continue
                 lres = last_query.get(obj_name, {})
                 cres = {}
                 for ri in req_items:
@@ -551,4 +622,4 @@ class QueryStatusHelper:
 def add_early_printer_objects(printer):
     printer.add_object('webhooks', WebHooks(printer))
     GCodeHelper(printer)
-    QueryStatusHelper(printer)
+    printer.add_object('query_status', QueryStatusHelper(printer))
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# Convert a binary accelerometer capture to the csv format
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import adxl345
+
+def main():
+    usage = "%prog [options] <capture.bin> [<output.csv>]"
+    opts = optparse.OptionParser(usage)
+    options, args = opts.parse_args()
+    if len(args) not in (1, 2):
+        opts.error("Incorrect number of arguments")
+    if len(args) == 2:
+        outname = args[1]
+    else:
+        outname = os.path.splitext(args[0])[0] + ".csv"
+    columns = adxl345.read_accel_file(args[0])
+    with open(outname, "w") as f:
+        columns.write_csv(f)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Benchmark bed_mesh move splitting on a dense mesh
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, math, random, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import bed_mesh
+
+class BenchConfig:
+    def getfloat(self, option, default, **kwargs):
+        return default
+
+# Per point lookup and split loop as implemented before the cell
+# coefficient table (used as the "before" reference)
+def legacy_calc_z(zmesh, x, y):
+    def linear_index(coord, mesh_min, mesh_cnt, mesh_dist):
+        idx = int(math.floor((coord - mesh_min) / mesh_dist))
+        idx = bed_mesh.constrain(idx, 0, mesh_cnt - 2)
+        t = (coord - (mesh_min + mesh_dist * idx)) / mesh_dist
+        return bed_mesh.constrain(t, 0., 1.), idx
+    tbl = zmesh.mesh_matrix
+    tx, xidx = linear_index(x + zmesh.mesh_offsets[0], zmesh.mesh_x_min,
+                            zmesh.mesh_x_count, zmesh.mesh_x_dist)
+    ty, yidx = linear_index(y + zmesh.mesh_offsets[1], zmesh.mesh_y_min,
+                            zmesh.mesh_y_count, zmesh.mesh_y_dist)
+    z0 = bed_mesh.lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
+    z1 = bed_mesh.lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
+    return bed_mesh.lerp(ty, z0, z1)
+
+def legacy_split_move(zmesh, splitter, prev_pos, next_pos, factor):
+    offset = splitter.fade_offset
+    def calc_z_offset(pos):
+        z = legacy_calc_z(zmesh, pos[0], pos[1])
+        return factor * (z - offset) + offset
+    z_offset = calc_z_offset(prev_pos)
+    axes_d = [next_pos[i] - prev_pos[i] for i in range(4)]
+    total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
+    axis_move = [not bed_mesh.isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+    current_pos = list(prev_pos)
+    moves = []
+    distance_checked = 0.
+    if axis_move[0] or axis_move[1]:
+        while (distance_checked + splitter.move_check_distance
+               < total_move_length):
+            distance_checked += splitter.move_check_distance
+            t = distance_checked / total_move_length
+            for i in range(4):
+                if axis_move[i]:
+                    current_pos[i] = bed_mesh.lerp(t, prev_pos[i],
+                                                   next_pos[i])
+            next_z = calc_z_offset(current_pos)
+            if abs(next_z - z_offset) >= splitter.split_delta_z:
+                z_offset = next_z
+                moves.append((current_pos[0], current_pos[1],
+                              current_pos[2] + z_offset, current_pos[3]))
+    current_pos[:] = next_pos
+    current_pos[2] += calc_z_offset(current_pos)
+    moves.append(current_pos)
+    return moves
+
+def split_move(splitter, prev_pos, next_pos, factor):
+    splitter.build_move(prev_pos, next_pos, factor)
+    moves = []
+    while not splitter.traverse_complete:
+        moves.append(tuple(splitter.split()))
+    return moves
+
+def build_mesh(count, pps, algo, size):
+    params = {'min_x': 0., 'max_x': size, 'min_y': 0., 'max_y': size,
+              'x_count': count, 'y_count': count, 'mesh_x_pps': pps,
+              'mesh_y_pps': pps, 'algo': algo, 'tension': .2}
+    zmesh = bed_mesh.ZMesh(params, "bench")
+    rnd = random.Random(1)
+    probed = [[.3 * math.sin(x * .7) * math.cos(y * .5) + rnd.uniform(-.02, .02)
+               for x in range(count)] for y in range(count)]
+    zmesh.build_mesh(probed)
+    return zmesh
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=50,
+                    help="probe points per axis")
+    opts.add_option("-p", "--pps", type="int", dest="pps", default=0,
+                    help="interpolated points per segment")
+    opts.add_option("-a", "--algo", type="string", dest="algo",
+                    default="direct", help="mesh interpolation algorithm")
+    opts.add_option("-m", "--moves", type="int", dest="moves", default=20000,
+                    help="number of random moves to split")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    size = 250.
+    zmesh = build_mesh(options.count, options.pps, options.algo, size)
+    splitter = bed_mesh.MoveSplitter(BenchConfig(), None)
+    splitter.initialize(zmesh, 0.)
+    rnd = random.Random(2)
+    moves = []
+    pos = [size / 2., size / 2., .2, 0.]
+    for i in range(options.moves):
+        next_pos = [rnd.uniform(0., size), rnd.uniform(0., size), .2,
+                    pos[3] + 1.]
+        moves.append((pos, next_pos))
+        pos = next_pos
+    print("Mesh %dx%d (%s), %d moves" % (zmesh.mesh_x_count,
+                                         zmesh.mesh_y_count, options.algo,
+                                         len(moves)))
+    # Verify both implementations produce the same segments
+    for prev_pos, next_pos in moves[:200]:
+        ref = legacy_split_move(zmesh, splitter, prev_pos, next_pos, 1.)
+        res = split_move(splitter, prev_pos, next_pos, 1.)
+        if len(ref) != len(res) or any(
+                abs(a - b) > 1e-9 for r1, r2 in zip(ref, res)
+                for a, b in zip(r1, r2)):
+            sys.stderr.write("Segment mismatch on move %s -> %s\n"
+                             % (prev_pos, next_pos))
+            sys.exit(1)
+    results = []
+    for name, func in [
+            ("before", lambda p, n: legacy_split_move(zmesh, splitter,
+                                                      p, n, 1.)),
+            ("after", lambda p, n: split_move(splitter, p, n, 1.))]:
+        segments = 0
+        start = time.perf_counter()
+        for prev_pos, next_pos in moves:
+            segments += len(func(prev_pos, next_pos))
+        duration = time.perf_counter() - start
+        results.append(duration)
+        print("%-7s %8.3fs %10.0f segments/s" % (name, duration,
+                                                 segments / duration))
+    print("speedup %.2fx" % (results[0] / results[1],))
+
+if __name__ == '__main__':
+    main()
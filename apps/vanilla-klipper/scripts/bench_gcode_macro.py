@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Benchmark g-code macro template rendering against printer status
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time, copy
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import jinja2
+from extras import gcode_macro
+
+PRINT_START = """
+{% set bed = params.BED|default(60)|float %}
+{% set hotend = params.HOTEND|default(210)|float %}
+{% set x_max = printer.configfile.settings.stepper_x.position_max %}
+{% set y_max = printer.configfile.settings.stepper_y.position_max %}
+{% set nozzle = printer.configfile.settings.extruder.nozzle_diameter %}
+{% set profile = printer.bed_mesh.profile_name %}
+M140 S{bed}
+M104 S{hotend * 0.7}
+{% if "xyz" not in printer.toolhead.homed_axes %}
+G28
+{% endif %}
+{% if printer.bed_mesh.profiles.default is defined %}
+BED_MESH_PROFILE LOAD=default
+{% else %}
+BED_MESH_CALIBRATE
+{% endif %}
+M190 S{bed}
+M109 S{hotend}
+G90
+G1 Z2 F3000
+G1 X{x_max * 0.1} Y{y_max * 0.05} F{printer.toolhead.max_velocity * 60}
+G1 X{x_max * 0.9} E{(x_max * 0.8 * nozzle * 0.2) / 2.4} F1500
+SET_GCODE_VARIABLE MACRO=PRINT_STATE VARIABLE=started VALUE={
+    printer["gcode_macro PRINT_STATE"].started + 1}
+"""
+
+LAYER_CHANGE = """
+{% set layer = params.LAYER|default(0)|int %}
+{% if layer == 1 %}
+M106 S{printer.configfile.settings.fan.max_power * 255}
+{% endif %}
+SET_PRINT_STATS_INFO CURRENT_LAYER={layer}
+{% if printer.extruder.temperature < printer.extruder.target - 5 %}
+M109 S{printer.extruder.target}
+{% endif %}
+"""
+
+class DummyReactor:
+    def monotonic(self):
+        return 0.
+
+class DummyObject:
+    def __init__(self, status):
+        self.status = status
+    def get_status(self, eventtime):
+        return self.status
+
+class DummyPrinter:
+    def __init__(self, objects):
+        self.objects = objects
+        self.reactor = DummyReactor()
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def lookup_objects(self, module=None):
+        return list(self.objects.items())
+    def get_reactor(self):
+        return self.reactor
+
+def build_printer(sections, mesh_size):
+    settings = {}
+    config = {}
+    for i in range(sections):
+        name = "section_%d" % (i,)
+        settings[name] = {"option_%d" % (j,): float(j) for j in range(20)}
+        config[name] = {"option_%d" % (j,): str(j) for j in range(20)}
+    for axis in "xyz":
+        settings["stepper_" + axis] = {"position_max": 235., "rotation_distance": 40.}
+    settings["extruder"] = {"nozzle_diameter": 0.4, "max_extrude_only_distance": 50.}
+    settings["fan"] = {"max_power": 1.}
+    matrix = [[0.01 * (x - y) for x in range(mesh_size)]
+              for y in range(mesh_size)]
+    profiles = {}
+    for name in ("default", "hot", "cold"):
+        profiles[name] = {"points": copy.deepcopy(matrix),
+                          "mesh_params": {"min_x": 10., "max_x": 225.,
+                                          "min_y": 10., "max_y": 225.,
+                                          "x_count": mesh_size,
+                                          "y_count": mesh_size}}
+    objects = {
+        "configfile": DummyObject({"config": config, "settings": settings,
+                                   "warnings": [], "save_config_pending": False,
+                                   "save_config_pending_items": {}}),
+        "bed_mesh": DummyObject({"profile_name": "default",
+                                 "mesh_min": (10., 10.),
+                                 "mesh_max": (225., 225.),
+                                 "probed_matrix": matrix,
+                                 "mesh_matrix": matrix,
+                                 "profiles": profiles}),
+        "toolhead": DummyObject({"homed_axes": "xyz", "max_velocity": 300.,
+                                 "position": [0., 0., 0., 0.]}),
+        "extruder": DummyObject({"temperature": 210., "target": 210.,
+                                 "power": 0.5}),
+        "gcode_macro PRINT_STATE": DummyObject({"started": 0}),
+    }
+    return DummyPrinter(objects)
+
+class DeepCopyStatusWrapper(gcode_macro.GetStatusWrapper):
+    # The original wrapper, which copied the full status on first access
+    def __getitem__(self, val):
+        sval = str(val).strip()
+        if sval in self.cache:
+            return self.cache[sval]
+        po = self.printer.lookup_object(sval, None)
+        if po is None or not hasattr(po, 'get_status'):
+            raise KeyError(val)
+        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        return res
+
+def render(template, printer, wrapper_class, params):
+    context = {'printer': wrapper_class(printer), 'params': params}
+    return str(template.render(context))
+
+def run(templates, printer, wrapper_class, count):
+    start = time.perf_counter()
+    for i in range(count):
+        for template, params in templates:
+            render(template, printer, wrapper_class, params)
+    return time.perf_counter() - start
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of passes (best is reported)")
+    opts.add_option("-c", "--count", type="int", dest="count", default=500,
+                    help="renders of each template per pass")
+    opts.add_option("-s", "--sections", type="int", dest="sections",
+                    default=60, help="number of config sections")
+    opts.add_option("-m", "--mesh", type="int", dest="mesh", default=7,
+                    help="bed mesh points per axis")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    printer = build_printer(options.sections, options.mesh)
+    env = jinja2.Environment('{%', '%}', '{', '}')
+    templates = [(env.from_string(PRINT_START), {"BED": "65", "HOTEND": "215"}),
+                 (env.from_string(LAYER_CHANGE), {"LAYER": "1"})]
+    # Verify both wrappers render the same output before timing them
+    for template, params in templates:
+        if (render(template, printer, DeepCopyStatusWrapper, params)
+            != render(template, printer, gcode_macro.GetStatusWrapper, params)):
+            sys.stderr.write("Render mismatch\n")
+            sys.exit(1)
+    results = []
+    for name, wrapper_class in [("deepcopy", DeepCopyStatusWrapper),
+                                ("lazy", gcode_macro.GetStatusWrapper)]:
+        best = min(run(templates, printer, wrapper_class, options.count)
+                   for i in range(options.repeat))
+        results.append(best)
+        renders = options.count * len(templates)
+        print("%-8s %8.3fs %8.1f us/render" % (
+            name, best, best * 1000000. / renders))
+    print("speedup  %.2fx" % (results[0] / results[1],))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Benchmark g-code line parsing by replaying a g-code file
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import gcode
+
+class DummyResponder:
+    def respond_info(self, msg, log=True):
+        pass
+    def respond_raw(self, msg):
+        pass
+
+def load_lines(filename, limit):
+    lines = []
+    with open(filename, 'r') as f:
+        for line in f:
+            # Mirror the comment handling of GCodeDispatch._process_commands
+            line = origline = line.strip()
+            cpos = line.find(';')
+            if cpos >= 0:
+                line = line[:cpos]
+            lines.append((line, origline))
+            if limit and len(lines) >= limit:
+                break
+    return lines
+
+def run(lines, parse_func, responder):
+    GCodeCommand = gcode.GCodeCommand
+    start = time.perf_counter()
+    for line, origline in lines:
+        cmd, params = parse_func(line)
+        GCodeCommand(responder, cmd, origline, params, False)
+    return time.perf_counter() - start
+
+def main():
+    usage = "%prog [options] <gcode file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of passes over the file (best is reported)")
+    opts.add_option("-l", "--limit", type="int", dest="limit", default=0,
+                    help="maximum number of lines to load")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    lines = load_lines(args[0], options.limit)
+    # Verify both parsers agree before timing them
+    for line, origline in lines:
+        if gcode.parse_line(line) != gcode.parse_line_generic(line):
+            sys.stderr.write("Parser mismatch on line: %r\n" % (origline,))
+            sys.exit(1)
+    responder = DummyResponder()
+    results = []
+    for name, func in [("generic", gcode.parse_line_generic),
+                       ("fast", gcode.parse_line)]:
+        best = min(run(lines, func, responder)
+                   for i in range(options.repeat))
+        results.append(best)
+        print("%-8s %8.3fs %10.0f lines/s" % (name, best, len(lines) / best))
+    print("speedup  %.2fx over %d lines" % (results[0] / results[1],
+                                             len(lines)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Benchmark motion_report batch generation from step and trapq history
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time, math
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import chelper
+from extras import motion_report
+
+MCU_FREQ = 16000000.
+
+# Queue a zig-zag (infill like) path and generate its steps
+def build_history(options):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    sc = ffi_main.gc(ffi_lib.stepcompress_alloc(0), ffi_lib.stepcompress_free)
+    ffi_lib.stepcompress_fill(sc, int(.000025 * MCU_FREQ), 1, 2)
+    ss = ffi_main.gc(ffi_lib.steppersync_alloc(ffi_main.NULL, [sc], 1, 16),
+                     ffi_lib.steppersync_free)
+    ffi_lib.steppersync_set_time(ss, 0., MCU_FREQ)
+    tq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+    sk = ffi_main.gc(ffi_lib.cartesian_stepper_alloc(b'x'), ffi_lib.free)
+    ffi_lib.itersolve_set_trapq(sk, tq)
+    ffi_lib.itersolve_set_stepcompress(sk, sc, 1. / options.steps_per_mm)
+    velocity, accel, dist = options.velocity, options.accel, options.length
+    accel_t = min(velocity / accel, math.sqrt(dist / accel))
+    cruise_v = accel * accel_t
+    cruise_t = (dist - cruise_v * accel_t) / cruise_v
+    print_time = .100
+    pos = 0.
+    direction = 1.
+    while print_time < options.seconds + .100:
+        ffi_lib.trapq_append(tq, print_time, accel_t, cruise_t, accel_t,
+                             pos, 0., 0., direction, 0., 0.,
+                             0., cruise_v, accel)
+        print_time += 2. * accel_t + cruise_t
+        pos += direction * dist
+        direction = -direction
+    ffi_lib.itersolve_generate_steps(sk, print_time)
+    ffi_lib.stepcompress_reset(sc, 0)
+    ffi_lib.trapq_finalize_moves(tq, print_time + 1., 0.)
+    return sc, ss, tq, sk, print_time
+
+# The original extraction, which pulled 128 entries at a time (newest
+# first) and built the rows from a cdata struct per entry
+def loop_step_batch(sc, start_clock, end_clock):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    res = []
+    while 1:
+        data = ffi_main.new('struct pull_history_steps[]', 128)
+        count = ffi_lib.stepcompress_extract_old(sc, data, 128,
+                                                 start_clock, end_clock)
+        if not count:
+            break
+        res.append((data, count))
+        if count < len(data):
+            break
+        end_clock = data[count-1].first_clock
+    res.reverse()
+    data = [d[i] for d, cnt in res for i in range(cnt-1, -1, -1)]
+    return [(s.interval, s.step_count, s.add) for s in data]
+
+# Paging trapq_extract_old by print_time would drop moves that share a
+# print_time across a page boundary, so pull the whole window at once
+def loop_trapq_batch(tq, start_time, end_time):
+    ffi_main, ffi_lib = chelper.get_ffi()
+    size = ffi_lib.trapq_extract_range(tq, ffi_main.NULL, 0,
+                                       start_time, end_time)
+    buf = ffi_main.new('struct pull_move[]', max(size, 1))
+    count = ffi_lib.trapq_extract_old(tq, buf, len(buf),
+                                      start_time, end_time)
+    data = [buf[i] for i in range(count-1, -1, -1)]
+    return [(m.print_time, m.move_t, m.start_v, m.accel,
+             (m.start_x, m.start_y, m.start_z), (m.x_r, m.y_r, m.z_r))
+            for m in data]
+
+def range_step_batch(hb, fill_func, start_clock, end_clock):
+    hb.extract(fill_func, start_clock, end_clock)
+    col = hb.get_column
+    return list(zip(col('interval'), col('step_count'), col('add')))
+
+def range_trapq_batch(hb, fill_func, start_time, end_time):
+    hb.extract(fill_func, start_time, end_time)
+    col = hb.get_column
+    start_pos = zip(col('start_x'), col('start_y'), col('start_z'))
+    axes_r = zip(col('x_r'), col('y_r'), col('z_r'))
+    return list(zip(col('print_time'), col('move_t'), col('start_v'),
+                    col('accel'), start_pos, axes_r))
+
+def best_time(func, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=20,
+                    help="number of passes (best is reported)")
+    opts.add_option("-s", "--seconds", type="float", dest="seconds",
+                    default=.5, help="length of the batch window")
+    opts.add_option("--velocity", type="float", dest="velocity",
+                    default=500., help="cruise velocity (mm/s)")
+    opts.add_option("--accel", type="float", dest="accel", default=20000.,
+                    help="acceleration (mm/s^2)")
+    opts.add_option("--length", type="float", dest="length", default=5.,
+                    help="length of each zig-zag move (mm)")
+    opts.add_option("--steps_per_mm", type="float", dest="steps_per_mm",
+                    default=160., help="steps per mm")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    ffi_main, ffi_lib = chelper.get_ffi()
+    sc, ss, tq, sk, end_time = build_history(options)
+    step_fill = lambda *args: ffi_lib.stepcompress_extract_range(sc, *args)
+    trapq_fill = lambda *args: ffi_lib.trapq_extract_range(tq, *args)
+    step_hb = motion_report.HistoryBuffer('struct pull_history_steps')
+    trapq_hb = motion_report.HistoryBuffer('struct pull_move')
+    # Verify both extractions produce the same batches
+    step_batch = loop_step_batch(sc, 0, 1<<63)
+    trapq_batch = loop_trapq_batch(tq, 0., motion_report.NEVER_TIME)
+    if (step_batch != range_step_batch(step_hb, step_fill, 0, 1<<63)
+        or trapq_batch != range_trapq_batch(trapq_hb, trapq_fill, 0.,
+                                            motion_report.NEVER_TIME)):
+        sys.stderr.write("Batch mismatch\n")
+        sys.exit(1)
+    steps = sum([abs(s[1]) for s in step_batch])
+    print("%d steps (%.0f steps/s), %d queue_step, %d moves" % (
+        steps, steps / options.seconds, len(step_batch), len(trapq_batch)))
+    results = []
+    for name, step_func, trapq_func in [
+            ("loop", lambda: loop_step_batch(sc, 0, 1<<63),
+             lambda: loop_trapq_batch(tq, 0., motion_report.NEVER_TIME)),
+            ("range", lambda: range_step_batch(step_hb, step_fill, 0, 1<<63),
+             lambda: range_trapq_batch(trapq_hb, trapq_fill, 0.,
+                                       motion_report.NEVER_TIME))]:
+        step_time = best_time(step_func, options.repeat)
+        trapq_time = best_time(trapq_func, options.repeat)
+        results.append(step_time + trapq_time)
+        print("%-8s steps %8.3fms  trapq %8.3fms" % (
+            name, step_time * 1000., trapq_time * 1000.))
+    print("speedup  %.2fx" % (results[0] / results[1],))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# Benchmark input shaper fitting on recorded accelerometer data
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time, math, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import numpy as np
+from extras import adxl345, shaper_calibrate, shaper_defs
+
+class LoopShaperCalibrate(shaper_calibrate.ShaperCalibrate):
+    # The original fitting, which evaluated one frequency and damping
+    # ratio at a time
+    def fit_shaper(self, shaper_cfg, calibration_data, shaper_freqs,
+                   damping_ratio, scv, max_smoothing, test_damping_ratios,
+                   max_freq):
+        damping_ratio = damping_ratio or shaper_defs.DEFAULT_DAMPING_RATIO
+        test_damping_ratios = (test_damping_ratios
+                               or shaper_calibrate.TEST_DAMPING_RATIOS)
+        if not shaper_freqs:
+            shaper_freqs = (None, None, None)
+        if isinstance(shaper_freqs, tuple):
+            freq_end = shaper_freqs[1] or shaper_calibrate.MAX_SHAPER_FREQ
+            freq_start = min(shaper_freqs[0] or shaper_cfg.min_freq,
+                             freq_end - 1e-7)
+            freq_step = shaper_freqs[2] or .2
+            test_freqs = np.arange(freq_start, freq_end, freq_step)
+        else:
+            test_freqs = np.array(shaper_freqs)
+        max_freq = max(max_freq or shaper_calibrate.MAX_FREQ, test_freqs.max())
+        freq_bins = calibration_data.freq_bins
+        psd = calibration_data.psd_sum[freq_bins <= max_freq]
+        freq_bins = freq_bins[freq_bins <= max_freq]
+        best_res = None
+        results = []
+        for test_freq in test_freqs[::-1]:
+            shaper_vibrations = 0.
+            shaper_vals = np.zeros(shape=freq_bins.shape)
+            shaper = shaper_cfg.init_func(test_freq, damping_ratio)
+            shaper_smoothing = self._get_shaper_smoothing(shaper, scv=scv)
+            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
+                return best_res
+            for dr in test_damping_ratios:
+                vibrations, vals = self._estimate_remaining_vibrations(
+                        shaper, dr, freq_bins, psd)
+                shaper_vals = np.maximum(shaper_vals, vals)
+                if vibrations > shaper_vibrations:
+                    shaper_vibrations = vibrations
+            max_accel = self.find_shaper_max_accel(shaper, scv)
+            shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
+                                               shaper_vibrations * .2 + .01)
+            results.append(
+                    shaper_calibrate.CalibrationResult(
+                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
+                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
+                        score=shaper_score, max_accel=max_accel))
+            if best_res is None or best_res.vibrs > results[-1].vibrs:
+                best_res = results[-1]
+        selected = best_res
+        for res in results[::-1]:
+            if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
+                selected = res
+        return selected
+
+def synthetic_capture(resonance, seconds):
+    # Decaying resonance excited by a frequency sweep, at 3200 samples/sec
+    columns = adxl345.AccelSampleColumns()
+    samples = []
+    rate = 3200.
+    for i in range(int(seconds * rate)):
+        t = i / rate
+        sweep = 5. + 120. * t / seconds
+        phase = 2. * math.pi * (5. * t + 60. * t * t / seconds)
+        accel = 1000. * math.sin(phase) / (1. + ((sweep - resonance) / 4.)**2)
+        samples.append((t, accel + random.gauss(0., 40.),
+                        random.gauss(0., 40.), 9806. + random.gauss(0., 40.)))
+    columns.add_samples(samples)
+    return columns
+
+def fit(helper, calibration_data, options):
+    return helper.find_best_shaper(calibration_data,
+                                   max_smoothing=options.max_smoothing,
+                                   scv=options.scv)
+
+def main():
+    usage = "%prog [options] [<raw_data.csv|raw_data.bin> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                    help="number of passes (best is reported)")
+    opts.add_option("--scv", type="float", dest="scv", default=5.,
+                    help="square corner velocity")
+    opts.add_option("--max_smoothing", type="float", dest="max_smoothing",
+                    default=None, help="maximum shaper smoothing")
+    opts.add_option("--resonance", type="float", dest="resonance",
+                    default=48., help="synthetic data resonance frequency")
+    options, args = opts.parse_args()
+    helper = shaper_calibrate.ShaperCalibrate(None)
+    loop_helper = LoopShaperCalibrate(None)
+    if args:
+        captures = [adxl345.read_accel_file(fname) for fname in args]
+    else:
+        captures = [synthetic_capture(options.resonance, 10.)]
+    calibration_data = None
+    for capture in captures:
+        data = helper.process_accelerometer_data(capture)
+        if calibration_data is None:
+            calibration_data = data
+        else:
+            calibration_data.add_data(data)
+    # Verify both implementations select the same shapers
+    best, all_shapers = fit(helper, calibration_data, options)
+    loop_best, loop_all_shapers = fit(loop_helper, calibration_data, options)
+    for res, loop_res in zip(all_shapers, loop_all_shapers):
+        if (res.freq != loop_res.freq
+            or not np.allclose(res.vals, loop_res.vals)
+            or not math.isclose(res.vibrs, loop_res.vibrs, rel_tol=1e-6)
+            or not math.isclose(res.max_accel, loop_res.max_accel,
+                                rel_tol=1e-6)):
+            sys.stderr.write("Fit mismatch for %s\n" % (res.name,))
+            sys.exit(1)
+        print("%-8s %6.1f Hz vibrations=%.1f%% smoothing=%.3f"
+              " max_accel=%.0f" % (res.name, res.freq, res.vibrs * 100.,
+                                   res.smoothing, res.max_accel))
+    print("best     %s" % (best.name,))
+    results = []
+    for name, h in [("loop", loop_helper), ("numpy", helper)]:
+        times = []
+        for i in range(options.repeat):
+            start = time.perf_counter()
+            fit(h, calibration_data, options)
+            times.append(time.perf_counter() - start)
+        results.append(min(times))
+        print("%-8s %8.3fs" % (name, results[-1]))
+    print("speedup  %.2fx" % (results[0] / results[1],))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# Convert a binary klippy log (klippy.py --binary-log) to the text format
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, os, sys, time, logging
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import queuelogger
+
+def main():
+    usage = "%prog [options] <klippy.log> [<output.log>]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-t", "--timestamps", action="store_true",
+                    dest="timestamps", help="prefix messages with their time")
+    opts.add_option("-w", "--warnings", action="store_true", dest="warnings",
+                    help="only output warnings and errors")
+    options, args = opts.parse_args()
+    if len(args) not in (1, 2):
+        opts.error("Incorrect number of arguments")
+    out = sys.stdout
+    if len(args) == 2:
+        out = open(args[1], "w")
+    min_level = logging.WARNING if options.warnings else 0
+    try:
+        for ptime, level, msg in queuelogger.read_binary_log(args[0]):
+            if level < min_level:
+                continue
+            if options.timestamps:
+                msg = "%s.%03d %s" % (
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ptime)),
+                    int(ptime * 1000.) % 1000, msg)
+            out.write(msg + "\n")
+    except queuelogger.BinaryLogError as e:
+        out.flush()
+        sys.stderr.write("%s\n" % (e,))
+        sys.exit(1)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()